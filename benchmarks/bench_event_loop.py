@@ -0,0 +1,152 @@
+"""
+    Event loop benchmark: tracker commands per second and latency under each loop implementation
+    Usage: python3 benchmarks/bench_event_loop.py [--clients N] [--procs N] [--duration S] [--loop LOOP ...]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import event_loops
+from tracker_client import TrackerClient
+
+SERVER_PORT = 12090
+PUBLISHED_FILES = 20  # Files per client: small replies keep the loop, not list building, on the hot path
+COMMANDS = ("sch", "lpf", "lap", "get")
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+################################################################################
+#################################### SERVER ####################################
+################################################################################
+
+def write_credentials(workdir: str, users: int):
+    with open(os.path.join(workdir, "credentials.txt"), "w") as file:
+        for i in range(users):
+            file.write(f"bench{i} pw{i}\n")
+
+def start_server(workdir: str, loop: str):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "server_async.py"), str(SERVER_PORT),
+         "--loop", loop, "--rate-limit-scale", "0"],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", SERVER_PORT)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+################################################################################
+################################## LOAD DRIVER #################################
+################################################################################
+
+async def drive(first_user: int, clients: int, duration: float) -> list:
+    """Run clients connections issuing commands back to back; return per-command latencies"""
+    trackers = [TrackerClient("127.0.0.1", SERVER_PORT) for _ in range(clients)]
+    for offset, tracker in enumerate(trackers):
+        user = first_user + offset
+        await tracker.connect()
+        await tracker.auth(f"bench{user}", f"pw{user}")
+        await tracker.register_port(20000 + user)  # Lets get resolve to a peer; nothing connects to it
+        for i in range(PUBLISHED_FILES):
+            await tracker.pub(f"u{user}_file{i}.dat")
+    
+    latencies = []
+    deadline = time.perf_counter() + duration
+    
+    async def worker(index: int, tracker: TrackerClient):
+        other = first_user + (index + 1) % clients
+        requests = {
+            "sch": lambda: tracker.sch("file1"),
+            "lpf": tracker.lpf,
+            "lap": tracker.lap,
+            "get": lambda: tracker.get(f"u{other}_file7.dat"),
+        }
+        sequence = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await requests[COMMANDS[sequence % len(COMMANDS)]]()
+            latencies.append(time.perf_counter() - started)
+            sequence += 1
+    
+    await asyncio.gather(*(worker(i, tracker) for i, tracker in enumerate(trackers)))
+    for tracker in trackers:
+        await tracker.close()
+    return latencies
+
+def driver_process(first_user: int, clients: int, duration: float, results):
+    # Drivers always use the fastest loop available so the server is what is being measured
+    results.put(event_loops.run(drive(first_user, clients, duration), "auto"))
+
+def bench(workdir: str, loop: str, clients: int, procs: int, duration: float) -> dict:
+    proc = start_server(workdir, loop)
+    try:
+        results = multiprocessing.Queue()
+        per_proc = max(1, clients // procs)
+        drivers = [
+            multiprocessing.Process(target=driver_process, args=(i * per_proc, per_proc, duration, results))
+            for i in range(procs)
+        ]
+        for driver in drivers:
+            driver.start()
+        latencies = sorted(sample for _ in drivers for sample in results.get())
+        for driver in drivers:
+            driver.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {
+        "loop": loop,
+        "rate": len(latencies) / duration,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+    }
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32, help="concurrent tracker connections")
+    parser.add_argument("--procs", type=int, default=2, help="driver processes sharing the clients")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of load per loop")
+    parser.add_argument("--loop", choices=["asyncio", "uvloop"], nargs="+", default=event_loops.available())
+    args = parser.parse_args()
+    
+    missing = [loop for loop in args.loop if loop not in event_loops.available()]
+    if missing:
+        print(f"Skipping {', '.join(missing)}: not installed")
+    
+    results = []
+    for loop in args.loop:
+        if loop in missing:
+            continue
+        with tempfile.TemporaryDirectory() as workdir:
+            write_credentials(workdir, args.clients)
+            results.append(bench(workdir, loop, args.clients, args.procs, args.duration))
+    
+    print(f"{args.clients} clients over {args.procs} driver processes, {args.duration:g}s per loop, "
+          f"commands: {' '.join(COMMANDS)} (loopback, rate limits off)\n")
+    print(f"{'loop':<8} {'cmds/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for row in results:
+        print(f"{row['loop']:<8} {row['rate']:>9.0f} {row['p50']:>8.2f} {row['p99']:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+    Memory benchmark: tracker bytes per connected peer and per published file, compact vs dict layout
+    Usage: python3 benchmarks/bench_memory.py [--peers N] [--files N] [--shared FRACTION]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import server_async
+from protocol import Decoder
+from server_async import ClientHandler, FileIndex, PeerRecord, PublicationIndex, Session
+
+# One stand-in for every connection's StreamWriter: asyncio's own objects cost the same in both layouts
+WRITER = SimpleNamespace(transport=SimpleNamespace(set_write_buffer_limits=lambda **limits: None))
+
+def wire(text: str) -> str:
+    """A fresh copy of text, as a string decoded from a client's command would be"""
+    return text.encode().decode()
+
+def traced_bytes(build) -> int:
+    """Bytes still allocated once build() returns, keeping its result alive while measuring"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()  # noqa: F841 -- held so its memory is still traced
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+################################################################################
+################################# DICT LAYOUT ##################################
+################################################################################
+
+class DictHandler:
+    """ClientHandler's fields without __slots__"""
+    
+    def __init__(self, reader, writer, address):
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.client_alive = True
+        self.client_username = None
+        self.client_upload_port = None
+        self.decoder = Decoder()
+        self.connected_at = 0.0
+        self.bytes_in = self.bytes_out = self.commands = 0
+
+class DictPublicationIndex(PublicationIndex):
+    """PublicationIndex keeping {"filename": set(usernames)} and the filename strings as received"""
+    
+    def publish(self, filename: str, username: str, size: int = None):
+        self.by_user.setdefault(username, set()).add(filename)
+        self._move(username, None, self.live if username in self.live_users else self.dormant, [filename])
+    
+    def _move(self, username: str, source, target, filenames):
+        for filename in filenames:
+            owners = target.get(filename)
+            if owners is None:
+                owners = target[filename] = set()
+                if target is self.live:
+                    self.names.add(filename)
+            owners.add(username)
+
+################################################################################
+#################################### PEERS #####################################
+################################################################################
+
+def connect_peers(peers: int, compact: bool) -> tuple:
+    """Build what an authenticated connection leaves in the tracker: handler, client record, session"""
+    handlers, clients, sessions = [], {}, {}
+    for i in range(peers):
+        address = (wire("127.0.0.1"), 40000 + i)
+        username = wire(f"user{i}")
+        token = wire(f"{i:032x}")
+        if compact:
+            handler = ClientHandler(None, WRITER, address)
+            username = sys.intern(username)
+            clients[username] = PeerRecord(WRITER, address, 20000 + i)
+            sessions[token] = Session(username, wire(f"{i:016x}"))
+        else:
+            handler = DictHandler(None, WRITER, address)
+            clients[username] = {"address": address, "reader": None, "writer": WRITER, "heartbeat": 0.0,
+                                 "interval": server_async.HEARTBEAT_INTERVAL, "upload_port": 20000 + i}
+            sessions[token] = {"username": username, "upload_port": 20000 + i, "expires": None,
+                               "udp_key": wire(f"{i:016x}")}
+        handler.client_username = username
+        handlers.append(handler)
+    return handlers, clients, sessions
+
+def publish_files(peers: int, files: int, shared: float, compact: bool):
+    """files publications spread over peers; a shared fraction also gets a second owner"""
+    index = PublicationIndex() if compact else DictPublicationIndex()
+    usernames = [sys.intern(f"user{i}") for i in range(peers)]
+    for username in usernames:
+        index.activate(username)
+    second_owners = int(files * shared)
+    for i in range(files):
+        index.publish(wire(f"dataset_{i:08d}.bin"), usernames[i % peers])
+        if i < second_owners:
+            index.publish(wire(f"dataset_{i:08d}.bin"), usernames[(i + 1) % peers])
+    return index
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--peers", type=int, default=10000, help="connected peers")
+    parser.add_argument("--files", type=int, default=100000, help="published files")
+    parser.add_argument("--shared", type=float, default=0.1, help="fraction of files with a second owner")
+    args = parser.parse_args()
+    
+    # Warm the intern table and FileIndex code paths so neither layout pays one-off costs
+    publish_files(2, 2, 0.5, True)
+    FileIndex()
+    
+    print(f"{args.peers} peers, {args.files} files ({args.shared:.0%} with two owners), tracemalloc bytes\n")
+    print(f"{'layout':<8} {'B/peer':>8} {'B/file':>8}")
+    for compact in (False, True):
+        per_peer = traced_bytes(lambda: connect_peers(args.peers, compact)) / args.peers
+        per_file = traced_bytes(lambda: publish_files(args.peers, args.files, args.shared, compact)) / args.files
+        print(f"{'compact' if compact else 'dict':<8} {per_peer:>8.0f} {per_file:>8.0f}")
+
+if __name__ == "__main__":
+    main()
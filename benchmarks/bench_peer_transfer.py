@@ -0,0 +1,219 @@
+"""
+    Peer transfer benchmark: seeder and leechers from client_async.py over loopback
+    Usage: python3 benchmarks/bench_peer_transfer.py [--size SIZE ...] [--concurrency N ...]
+                                                     [--mode MODE ...] [--chunk-kb N ...] [--allocations]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import client_async
+from client_async import PeerServer, create_peer_ssl_contexts, handle_file_download
+
+MODES = {
+    # mode: (tls, use_sendfile)
+    "plain": (False, False),
+    "sendfile": (False, True),
+    "tls": (True, False),
+}
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+ROW_BYTES = 256 * 2**20  # Small files repeat until a row moves about this much data
+MAX_ROUNDS = 1000
+FILL_BLOCK = 2**20  # Payloads repeat one random block, so multi-GB files are quick to create
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def syscalls() -> int:
+    """File read + write syscalls so far, from /proc/self/io (Linux only).
+    
+    Socket send/recv and sendfile do not go through these counters, so this
+    measures disk-side calls: how often the chunk size makes us hit the file.
+    """
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["syscr"]) + int(counters["syscw"])
+    except (OSError, KeyError):
+        return 0
+
+def parse_size(text: str) -> int:
+    match = re.fullmatch(r"(\d+)([kmg]?)b?", text.lower())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"bad size {text!r}, expected e.g. 1k, 64m or 4g")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def format_size(size: int) -> str:
+    for unit in ("g", "m", "k"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit.upper()}"
+    return str(size)
+
+def write_payload(path: str, size: int):
+    block = os.urandom(min(size, FILL_BLOCK))
+    with open(path, "wb") as file:
+        for _ in range(size // len(block)):
+            file.write(block)
+        file.write(block[:size % len(block)])
+
+################################################################################
+#################################### SEEDER ####################################
+################################################################################
+
+async def serve(mode: str, chunk_size: int, allocations: bool):
+    """Seed the payloads in the current directory until stdin closes, then report what it cost"""
+    tls, use_sendfile = MODES[mode]
+    server_context = create_peer_ssl_contexts()[0] if tls else None
+    files = {name for name in os.listdir() if name.startswith("payload")}
+    peer_server = PeerServer(files, host="127.0.0.1", ssl_context=server_context, use_sendfile=use_sendfile)
+    peer_server.chunk_size = chunk_size
+    port = await peer_server.start()
+    if allocations:
+        tracemalloc.start()
+    cpu_ready, syscalls_ready = cpu_seconds(), syscalls()
+    print(port, flush=True)
+    await asyncio.get_event_loop().run_in_executor(None, sys.stdin.read)
+    await peer_server.close()
+    print(json.dumps({
+        "cpu": cpu_seconds() - cpu_ready,
+        "syscalls": syscalls() - syscalls_ready,
+        "peak": tracemalloc.get_traced_memory()[1] if allocations else 0,
+    }), flush=True)
+
+def start_seeder(workdir: str, mode: str, chunk_size: int, allocations: bool):
+    command = [sys.executable, os.path.abspath(__file__), "--serve", mode, "--chunk-kb", str(chunk_size // 1024)]
+    if allocations:
+        command.append("--allocations")
+    proc = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return proc, int(proc.stdout.readline())
+
+def stop_seeder(proc) -> dict:
+    """Stop the seeder and return the CPU, syscalls and peak allocations it spent uploading"""
+    proc.stdin.close()
+    cost = json.loads(proc.stdout.readline())
+    proc.wait()
+    return cost
+
+################################################################################
+################################### LEECHERS ###################################
+################################################################################
+
+async def run_downloads(workdir: str, port: int, mode: str, payload: str, concurrency: int, rounds: int):
+    """rounds times, download payload with concurrency leechers at once, reusing TLS sessions"""
+    client_context = create_peer_ssl_contexts(
+        os.path.join(workdir, client_async.PEER_CERT_FILE), os.path.join(workdir, client_async.PEER_KEY_FILE)
+    )[1] if MODES[mode][0] else None
+    dests = [os.path.join(workdir, f"download{i}.bin") for i in range(concurrency)]
+    for _ in range(rounds):
+        results = await asyncio.gather(*(
+            handle_file_download("127.0.0.1", port, payload, dest, client_context) for dest in dests
+        ))
+        if not all(results):
+            raise RuntimeError(f"{mode} transfer of {payload} failed")
+    for dest in dests:
+        os.remove(dest)
+
+def bench(workdir: str, mode: str, chunk_size: int, size: int, concurrency: int, allocations: bool) -> dict:
+    rounds = max(1, min(MAX_ROUNDS, ROW_BYTES // (size * concurrency)))
+    proc, port = start_seeder(workdir, mode, chunk_size, allocations)
+    if allocations:
+        tracemalloc.start()
+    started, cpu_started, syscalls_started = time.perf_counter(), cpu_seconds(), syscalls()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(run_downloads(workdir, port, mode, f"payload{size}.bin", concurrency, rounds))
+    elapsed, client_cpu = time.perf_counter() - started, cpu_seconds() - cpu_started
+    client_syscalls = syscalls() - syscalls_started
+    client_peak = 0
+    if allocations:
+        client_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    seeder = stop_seeder(proc)
+    transfers = rounds * concurrency
+    gigabytes = size * transfers / 2**30
+    return {
+        "variant": mode if mode == "sendfile" else f"{mode}-{chunk_size // 1024}k",
+        "size": format_size(size),
+        "concurrency": concurrency,
+        "transfers": transfers,
+        "mbps": gigabytes * 1024 / elapsed,
+        "rate": transfers / elapsed,
+        "seeder_cpu": seeder["cpu"] / gigabytes,
+        "client_cpu": client_cpu / gigabytes,
+        "seeder_syscalls": seeder["syscalls"] / transfers,
+        "client_syscalls": client_syscalls / transfers,
+        "seeder_peak": seeder["peak"],
+        "client_peak": client_peak,
+    }
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=parse_size, nargs="+", default=[parse_size(s) for s in ("1k", "1m", "64m")],
+                        help="payload sizes, e.g. 1k 1m 64m 4g")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="leechers downloading at once")
+    parser.add_argument("--mode", choices=list(MODES), nargs="+", default=list(MODES))
+    parser.add_argument("--chunk-kb", type=int, nargs="+",
+                        default=[client_async.TRANSFER_CHUNK_SIZE // 1024, client_async.TLS_CHUNK_SIZE // 1024],
+                        help="upload write sizes for plain and tls (sendfile ignores it)")
+    # Peak bytes stand in for allocation counts: tracemalloc counts only blocks still live, and once
+    # a transfer ends its chunk buffers are freed, so a snapshot's count would read near zero
+    parser.add_argument("--allocations", action="store_true",
+                        help="trace peak Python allocated bytes (slows transfers; compare rows only with each other)")
+    parser.add_argument("--serve", choices=list(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.serve:
+        asyncio.run(serve(args.serve, args.chunk_kb[0] * 1024, args.allocations))
+        return
+    
+    variants = [(mode, chunk_kb * 1024) for mode in args.mode
+                for chunk_kb in (args.chunk_kb[:1] if mode == "sendfile" else args.chunk_kb)]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.size:
+            write_payload(os.path.join(workdir, f"payload{size}.bin"), size)
+        # Generate the peer certificate once so no seeder pays for it while timed
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_peer_ssl_contexts(os.path.join(workdir, client_async.PEER_CERT_FILE),
+                                     os.path.join(workdir, client_async.PEER_KEY_FILE))
+        for mode, chunk_size in variants:
+            for size in args.size:
+                for concurrency in args.concurrency:
+                    results.append(bench(workdir, mode, chunk_size, size, concurrency, args.allocations))
+    
+    print("Loopback, warm page cache. cpu/GB is CPU seconds per GB moved; fio is file read+write\n"
+          "syscalls per transfer from /proc/self/io (socket calls and sendfile are not counted)\n")
+    header = (f"{'variant':<12} {'size':>5} {'conc':>4} {'xfers':>6} {'xfer/s':>7} {'MB/s':>7} {'seed cpu/GB':>11} "
+              f"{'leech cpu/GB':>12} {'seed fio':>9} {'leech fio':>9}")
+    if args.allocations:
+        header += f" {'seed peak KiB':>13} {'leech peak KiB':>14}"
+    print(header)
+    for row in results:
+        line = (f"{row['variant']:<12} {row['size']:>5} {row['concurrency']:>4} {row['transfers']:>6} "
+                f"{row['rate']:>7.0f} {row['mbps']:>7.1f} {row['seeder_cpu']:>11.2f} {row['client_cpu']:>12.2f} "
+                f"{row['seeder_syscalls']:>9.0f} {row['client_syscalls']:>9.0f}")
+        if args.allocations:
+            line += f" {row['seeder_peak'] / 1024:>13.0f} {row['client_peak'] / 1024:>14.0f}"
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+    Parser microbenchmark: the tracker's old prefix-check dispatch vs protocol.parse_command and a dispatch table
+    Usage: python3 benchmarks/bench_protocol.py [--rounds N]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from protocol import ARITY, parse_command
+
+# A control-channel mix: mostly searches, lookups and heartbeats, with the odd login and refused command
+WORKLOAD = (
+    ["hbt"] * 20
+    + ["sch report*", "sch re:^data_[0-9]+ size:>1m", "sch notes owner:hans limit:20", "sch holiday 100 -"] * 8
+    + ["get dataset_00001234.bin", "src dataset_00001234.bin"] * 6
+    + ["pub dataset_00001234.bin 1048576", "unp dataset_00001234.bin"] * 3
+    + ["lap", "lpf 100 -", "have part.iso 1048576 262144 f0", "tok", "rsm 5f2c9e0d", "hbi"] * 2
+    + ["auth hans falcon*solo", "port 20000", "foo bar"]
+)
+PREFIXES = ("auth", "port", "hbt", "hbi", "get", "lap", "lpf", "pub", "sch", "unp", "xit", "have", "src",
+            "tok", "rsm")  # The order server_async.py tested them in
+
+################################################################################
+################################### DISPATCH ###################################
+################################################################################
+
+def old_dispatch(message: str):
+    """What server_async.py did per command: a label split, throttle's split, prefixes, the handler's split"""
+    label = message.split(" ", 1)[0]
+    parts = message.split()
+    command_class = parts[0] if parts else ""
+    for prefix in PREFIXES:
+        if message.startswith(prefix):
+            return label, command_class, message.split()  # Every handler split the message again
+    return label, command_class, None
+
+def handle(args):
+    return args
+
+HANDLERS = {name: handle for name in ARITY}
+
+def new_dispatch(message: str):
+    """What it does now: one split, one table lookup, the arity check, then the handler gets the args"""
+    command = parse_command(message)
+    handler = HANDLERS.get(command.name)
+    if handler is None or not command.well_formed():
+        return command.name, None
+    return command.name, handler(command.args)
+
+################################################################################
+################################### MEASURING ##################################
+################################################################################
+
+def nanoseconds_per_command(dispatch, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in WORKLOAD:
+            dispatch(message)
+    return (time.perf_counter() - started) / (rounds * len(WORKLOAD)) * 1e9
+
+def peak_bytes_per_command(dispatch) -> float:
+    """Mean of the most memory each command has allocated at once while it is dispatched"""
+    total = 0
+    tracemalloc.start()
+    try:
+        for message in WORKLOAD:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            dispatch(message)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / len(WORKLOAD)
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20000, help="passes over the command mix")
+    args = parser.parse_args()
+    
+    print(f"{len(WORKLOAD)} commands per round, {args.rounds} rounds\n")
+    print(f"{'dispatch':<10} {'ns/cmd':>8} {'peak B/cmd':>11}")
+    for label, dispatch in (("prefixes", old_dispatch), ("protocol", new_dispatch)):
+        dispatch(WORKLOAD[0])  # Warm up
+        print(f"{label:<10} {nanoseconds_per_command(dispatch, args.rounds):>8.0f} "
+              f"{peak_bytes_per_command(dispatch):>11.0f}")
+
+if __name__ == "__main__":
+    main()
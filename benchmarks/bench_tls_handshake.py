@@ -0,0 +1,135 @@
+"""
+    TLS handshake benchmark for the tracker's SSL context: full vs resumed handshakes
+    Usage: python3 benchmarks/bench_tls_handshake.py [--handshakes N] [--key rsa|ecdsa|both] [--tls 1.2|1.3]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import asyncio
+import os
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from tracker_client import ResumableSSLContext, open_connection
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+################################################################################
+#################################### SERVER ####################################
+################################################################################
+
+async def serve():
+    """Accept TLS connections with server_async's context until stdin closes"""
+    from server_async import create_ssl_context
+    
+    async def handle(reader, writer):
+        try:
+            await reader.readline()
+            writer.write(b"ok\n")
+            await writer.drain()
+        finally:
+            writer.close()
+    
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, ssl=create_ssl_context())
+    cpu_ready = cpu_seconds()
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await asyncio.get_event_loop().run_in_executor(None, sys.stdin.read)
+    server.close()
+    print(cpu_seconds() - cpu_ready, flush=True)
+
+def start_server(workdir: str):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve"],
+        cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    return proc, int(proc.stdout.readline())
+
+def stop_server(proc) -> float:
+    """Stop the server and return the CPU seconds it spent serving"""
+    proc.stdin.close()
+    server_cpu = float(proc.stdout.readline())
+    proc.wait()
+    return server_cpu
+
+################################################################################
+#################################### CLIENT ####################################
+################################################################################
+
+async def run_handshakes(port: int, cert: str, count: int, resume: bool, tls: str):
+    """Open count connections, resuming the previous session if asked"""
+    ssl_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.load_verify_locations(cert)
+    if tls == "1.2":
+        ssl_context.maximum_version = ssl.TLSVersion.TLSv1_2
+    
+    reused = 0
+    for _ in range(count):
+        reader, writer = await open_connection("127.0.0.1", port, ssl_context)
+        writer.write(b"ping\n")
+        await writer.drain()
+        await reader.readline()
+        reused += writer.get_extra_info("ssl_object").session_reused
+        if resume:
+            ssl_context.remember(("127.0.0.1", port), writer)
+        writer.close()
+        await writer.wait_closed()
+    return reused
+
+def bench(workdir: str, key_type: str, resume: bool, count: int, tls: str) -> dict:
+    proc, port = start_server(workdir)
+    started, cpu_started = time.perf_counter(), cpu_seconds()
+    reused = asyncio.run(run_handshakes(port, os.path.join(workdir, "server.crt"), count, resume, tls))
+    elapsed, client_cpu = time.perf_counter() - started, cpu_seconds() - cpu_started
+    server_cpu = stop_server(proc)
+    return {
+        "key": key_type,
+        "mode": "resumed" if resume else "full",
+        "reused": reused,
+        "wall": count / elapsed,
+        "server": count / server_cpu if server_cpu else float("inf"),
+        "client": count / client_cpu if client_cpu else float("inf"),
+    }
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--handshakes", type=int, default=500)
+    parser.add_argument("--key", choices=["rsa", "ecdsa", "both"], default="both")
+    parser.add_argument("--tls", choices=["1.2", "1.3"], default="1.3")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.serve:
+        asyncio.run(serve())
+        return
+    
+    results = []
+    for key_type in (["rsa", "ecdsa"] if args.key == "both" else [args.key]):
+        with tempfile.TemporaryDirectory() as workdir:
+            flags = ["--ecdsa"] if key_type == "ecdsa" else []
+            subprocess.run(["bash", os.path.join(REPO_ROOT, "scripts", "generate_certs.sh"), *flags],
+                           cwd=workdir, check=True, capture_output=True)
+            for resume in (False, True):
+                results.append(bench(workdir, key_type, resume, args.handshakes, args.tls))
+    
+    print(f"TLS {args.tls}, {args.handshakes} sequential handshakes per row (loopback)\n")
+    print(f"{'key':<6} {'mode':<8} {'reused':>7} {'hs/s wall':>10} {'server hs/cpu-s':>16} {'client hs/cpu-s':>16}")
+    for row in results:
+        print(f"{row['key']:<6} {row['mode']:<8} {row['reused']:>7} {row['wall']:>10.0f} "
+              f"{row['server']:>16.0f} {row['client']:>16.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+    Tracker load generator: thousands of simulated clients against server.py and server_async.py
+    Usage: python3 benchmarks/bench_tracker_load.py [--clients N] [--procs N] [--duration S] [--think S]
+                                                    [--mix auth=1,hbt=5,...] [--server SERVER ...] [--workers N]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    # server: script, then extra arguments after the port
+    "server.py": ["server.py"],  # A thread per client
+    "server.py-pool": ["server.py", "--workers", "16"],  # selectors loop and a bounded pool; see --workers
+    "server_async.py": ["server_async.py", "--rate-limit-scale", "0"],  # Measure capacity, not the rate limiter
+}
+COMMANDS = ("auth", "hbt", "pub", "sch", "get", "lap")
+DEFAULT_MIX = "auth=1,hbt=5,pub=10,sch=30,get=44,lap=10"
+FILES_PER_CLIENT = 5  # Published by every client before the timed window, so get always has targets
+HEARTBEAT_INTERVAL = 1.0  # Every client beats at least this often, like the real CLI
+REQUEST_TIMEOUT = 5.0
+CONNECT_CONCURRENCY = 256  # Logins in flight per driver during the connection storm
+RESPONSE_BUFFER_SIZE = 1 << 20
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def parse_mix(text: str) -> dict:
+    """Parse "cmd=weight,..." into {cmd: weight}"""
+    mix = {}
+    for term in text.split(","):
+        name, _, weight = term.partition("=")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad mix term {term!r}, expected cmd=weight")
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {name!r}, expected one of {' '.join(COMMANDS)}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("mix needs at least one positive weight")
+    return mix
+
+def raise_fd_limit(needed: int):
+    """Lift the open-file soft limit to the hard limit; servers inherit it from this process"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < needed:
+        print(f"Warning: open-file limit {hard} is below the {needed} sockets this run needs")
+
+def process_status(pid: int, field: str):
+    """A number from /proc/<pid>/status (Linux only), or None"""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def peak_rss(pid: int):
+    """Peak resident set size of pid in bytes, or None"""
+    kib = process_status(pid, "VmHWM")
+    return None if kib is None else kib * 1024
+
+################################################################################
+#################################### SERVER ####################################
+################################################################################
+
+def free_port() -> int:
+    """A port nothing is bound to; server.py has no SO_REUSEADDR, so a reused port can sit in TIME_WAIT"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def write_credentials(workdir: str, users: int):
+    with open(os.path.join(workdir, "credentials.txt"), "w") as file:
+        for i in range(users):
+            file.write(f"load{i} pw{i}\n")
+
+def start_server(workdir: str, server: str, port: int):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, SERVERS[server][0]), str(port), *SERVERS[server][1:]],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{server} did not start")
+
+################################################################################
+################################ SIMULATED CLIENT ##############################
+################################################################################
+
+class SimulatedClient:
+    """One tracker connection speaking the raw text protocol, one command in flight at a time"""
+    
+    def __init__(self, port: int, user: int):
+        self.port = port
+        self.user = user
+        self.peers = []  # Logged-in users in the same driver, whose files get and sch ask for
+        self.reader = self.writer = None
+        self.last_beat = 0.0
+        self.published = 0
+    
+    async def login(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port, limit=RESPONSE_BUFFER_SIZE)
+        reply = await self.request(f"auth load{self.user} pw{self.user}")
+        if reply != "auth OK":
+            raise ConnectionError(f"auth refused: {reply!r}")
+        await self.request(f"port {20000 + self.user % 40000}")  # Lets get resolve to this client
+        self.last_beat = time.perf_counter()
+    
+    async def logout(self):
+        """Exit and wait for the tracker to close, so the next login cannot race its cleanup"""
+        await self.request("xit")
+        while await asyncio.wait_for(self.reader.read(RESPONSE_BUFFER_SIZE), REQUEST_TIMEOUT):
+            pass
+        self.close()
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+    
+    async def request(self, message: str) -> str:
+        """Send one command and read its reply; hbt has none"""
+        self.writer.write(f"{message}\n".encode())
+        await self.writer.drain()
+        if message == "hbt":
+            self.last_beat = time.perf_counter()
+            return ""
+        data = await asyncio.wait_for(self.reader.readline(), REQUEST_TIMEOUT)  # Framed commands get framed replies
+        if not data:
+            raise ConnectionResetError("tracker closed the connection")
+        return data.decode().rstrip("\n")
+    
+    def command(self, name: str) -> str:
+        if name == "pub":
+            self.published += 1
+            return f"pub u{self.user}_extra{self.published}.dat"
+        if name == "sch":
+            return f"sch u{random.choice(self.peers)}_"  # One peer's files
+        if name == "get":
+            return f"get u{random.choice(self.peers)}_f{random.randrange(FILES_PER_CLIENT)}.dat"
+        return name
+
+################################################################################
+################################## LOAD DRIVER #################################
+################################################################################
+
+async def keep_alive(client: SimulatedClient):
+    """Heartbeat while the other clients connect"""
+    while True:
+        await client.request("hbt")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+async def simulate(client: SimulatedClient, mix: dict, think: float, stop: float, samples: dict, errors: dict):
+    """Issue commands from mix with exponential think time until stop"""
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < stop:
+        await asyncio.sleep(random.expovariate(1 / think))
+        if time.perf_counter() - client.last_beat >= HEARTBEAT_INTERVAL:
+            name = "hbt"
+        else:
+            name = random.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            if name == "auth":
+                await client.logout()
+                await client.login()  # Session churn: a fresh connect plus auth
+            else:
+                reply = await client.request(client.command(name))
+                if name != "hbt" and not reply.startswith(name):
+                    raise ValueError(f"unexpected reply {reply[:40]!r}")
+        except (OSError, ValueError, asyncio.TimeoutError):
+            errors[name] += 1
+            client.close()  # The stream may be out of step with its replies
+            try:
+                await client.login()
+            except (OSError, ValueError, asyncio.TimeoutError):
+                errors["login"] += 1
+                return
+            continue
+        finished = time.perf_counter()
+        if finished <= stop:  # Commands still in flight at the end fall outside the window
+            samples[name].append(finished - started)
+
+async def drive(port: int, users: range, mix: dict, think: float, duration: float, barrier) -> dict:
+    clients = [SimulatedClient(port, user) for user in users]
+    samples, errors = collections.defaultdict(list), collections.Counter()
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    beating = {}
+    
+    async def connect(client: SimulatedClient):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await client.login()
+                for k in range(FILES_PER_CLIENT):
+                    await client.request(f"pub u{client.user}_f{k}.dat")
+            except (OSError, ValueError, asyncio.TimeoutError):
+                errors["login"] += 1
+                client.close()
+                return
+            samples["login"].append(time.perf_counter() - started)
+            beating[client] = asyncio.ensure_future(keep_alive(client))
+    
+    await asyncio.gather(*(connect(client) for client in clients))
+    online = list(beating)
+    # Start the timed window in every driver at once
+    await asyncio.get_event_loop().run_in_executor(None, barrier.wait)
+    for task in beating.values():
+        task.cancel()
+    await asyncio.gather(*beating.values(), return_exceptions=True)
+    
+    peers = [client.user for client in online]
+    for client in online:
+        client.peers = peers
+    stop = time.perf_counter() + duration
+    await asyncio.gather(*(simulate(client, mix, think, stop, samples, errors) for client in online))
+    for client in clients:
+        client.close()
+    return {"samples": dict(samples), "errors": dict(errors)}
+
+def driver_process(port: int, users: range, mix: dict, think: float, duration: float, barrier, results):
+    results.put(asyncio.run(drive(port, users, mix, think, duration, barrier)))
+
+def bench(workdir: str, server: str, args) -> dict:
+    port = free_port()
+    proc = start_server(workdir, server, port)
+    try:
+        results = multiprocessing.Queue()
+        barrier = multiprocessing.Barrier(args.procs)
+        share = -(-args.clients // args.procs)
+        drivers = [
+            multiprocessing.Process(target=driver_process, args=(
+                port, range(i * share, min(args.clients, (i + 1) * share)), args.mix, args.think,
+                args.duration, barrier, results
+            ))
+            for i in range(args.procs)
+        ]
+        for driver in drivers:
+            driver.start()
+        runs, threads = [], 0
+        while len(runs) < len(drivers):
+            # Clients disconnect before their driver reports, so count the server's threads while they run
+            threads = max(threads, process_status(proc.pid, "Threads") or 0)
+            try:
+                runs.append(results.get(timeout=0.2))
+            except queue.Empty:
+                pass
+        for driver in drivers:
+            driver.join()
+        rss = peak_rss(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    samples, errors = collections.defaultdict(list), collections.Counter()
+    for run in runs:
+        for name, values in run["samples"].items():
+            samples[name].extend(values)
+        errors.update(run["errors"])
+    return {
+        "server": server,
+        "samples": {name: sorted(values) for name, values in samples.items()},
+        "errors": errors,
+        "elapsed": args.duration,
+        "rss": rss,
+        "threads": threads,
+    }
+
+################################################################################
+##################################### REPORT ###################################
+################################################################################
+
+def report(result: dict):
+    samples, errors, elapsed = result["samples"], result["errors"], result["elapsed"]
+    rss = f"{result['rss'] / 2**20:.1f} MiB" if result["rss"] else "n/a"
+    print(f"\n{result['server']}: peak RSS {rss}, peak threads {result['threads'] or 'n/a'}")
+    print(f"{'command':<8} {'count':>8} {'per sec':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'errors':>7}")
+    total = 0
+    for name in ("login",) + COMMANDS:
+        values = samples.get(name, [])
+        if not values and not errors.get(name):
+            continue
+        # Logins happen before the timed window, so they get no rate; hbt has no reply to time
+        rate = "" if name == "login" else f"{len(values) / elapsed:.0f}"
+        if values and name != "hbt":
+            latencies = " ".join(f"{percentile(values, p) * 1000:>8.2f}" for p in (0.5, 0.99, 0.999))
+        else:
+            latencies = " ".join(f"{'-':>8}" for _ in range(3))
+        print(f"{name:<8} {len(values):>8} {rate:>9} {latencies} {errors.get(name, 0):>7}")
+        if name != "login":
+            total += len(values)
+    print(f"{'total':<8} {total:>8} {total / elapsed:>9.0f}")
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=2000, help="simulated clients, each on its own connection")
+    parser.add_argument("--procs", type=int, default=4, help="driver processes sharing the clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds in the timed window")
+    parser.add_argument("--think", type=float, default=0.1, help="mean seconds between a client's commands")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"command weights (default {DEFAULT_MIX})")
+    parser.add_argument("--server", choices=list(SERVERS), nargs="+", default=list(SERVERS))
+    parser.add_argument("--workers", type=int, default=16, help="pool size for server.py-pool")
+    args = parser.parse_args()
+    SERVERS["server.py-pool"][-1] = str(args.workers)
+    
+    raise_fd_limit(args.clients * 2 + 100)  # Both ends of every connection live on this host
+    mix = " ".join(f"{name}={weight:g}" for name, weight in args.mix.items())
+    print(f"{args.clients} clients over {args.procs} driver processes, {args.duration:g}s window, "
+          f"{args.think:g}s mean think time, mix {mix}")
+    for server in args.server:
+        with tempfile.TemporaryDirectory() as workdir:
+            write_credentials(workdir, args.clients)
+            report(bench(workdir, server, args))
+
+if __name__ == "__main__":
+    main()
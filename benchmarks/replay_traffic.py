@@ -0,0 +1,188 @@
+"""
+    Replay a recorded tracker workload (server_async.py --record) against a local tracker
+    Usage: python3 benchmarks/replay_traffic.py RECORDING [--speed X] [--server SERVER ...]
+    coding: utf-8
+    Author: Danny Li
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench_tracker_load import SERVERS, free_port, percentile, raise_fd_limit, start_server, write_credentials
+from recording import load_recording
+
+REQUEST_TIMEOUT = 5.0
+RESPONSE_BUFFER_SIZE = 1 << 20
+SEED_HEARTBEAT = 1.0
+LATE_SLACK = 0.001  # Sends later than this count as behind schedule
+NAME_LOOKUPS = ("get", "src")
+
+def rebuild(record: dict) -> str:
+    """The command to send for a record; users map to the load<N> accounts write_credentials creates"""
+    command, args, user = record["cmd"], record["args"], record["user"]
+    if command == "auth":
+        # Only logins that succeeded carry a user; replay the failures as a wrong password
+        return f"auth load{user} pw{user}" if user is not None else "auth load0 wrong"
+    if command == "rsm":
+        return "rsm 0"  # Resume tokens are never recorded; this exercises the rejection path
+    if command == "sch":
+        args = [f"owner:load{arg[6:]}" if arg.startswith("owner:") else arg for arg in args]
+    return " ".join([command, *args])
+
+def unpublished_names(records: list) -> set:
+    """Names looked up but never published during the recording: they were published before it began"""
+    published = {record["args"][0] for record in records if record["cmd"] == "pub" and record["args"]}
+    return {
+        record["args"][0] for record in records
+        if record["cmd"] in NAME_LOOKUPS and record["args"] and record["args"][0] not in published
+    }
+
+################################################################################
+#################################### REPLAY ####################################
+################################################################################
+
+async def request(reader, writer, message: str) -> bytes:
+    writer.write(f"{message}\n".encode())
+    await writer.drain()
+    data = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)  # Framed commands get framed replies
+    if not data:
+        raise ConnectionResetError("tracker closed the connection")
+    return data.rstrip(b"\n")
+
+async def seed(port: int, user: int, names: set):
+    """Log in as user and publish the names the recording assumes already exist; returns the connection"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=RESPONSE_BUFFER_SIZE)
+    if await request(reader, writer, f"auth load{user} pw{user}") != b"auth OK":
+        raise RuntimeError("the seeding account was refused")
+    await request(reader, writer, "port 20000")  # Lets get resolve the seeded names
+    for name in names:
+        await request(reader, writer, f"pub {name}")
+    return writer
+
+async def keep_alive(writer):
+    while True:
+        writer.write(b"hbt\n")
+        await writer.drain()
+        await asyncio.sleep(SEED_HEARTBEAT)
+
+async def replay_connection(port: int, records: list, speed: float, origin: float, samples: dict, errors: dict,
+                            late: list):
+    """Send one recorded connection's commands on schedule, timing each reply"""
+    reader = writer = None
+    try:
+        for record in records:
+            command = record["cmd"]
+            delay = origin + record["t"] / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > LATE_SLACK:
+                late.append(-delay)
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=RESPONSE_BUFFER_SIZE)
+            started = time.perf_counter()
+            if command == "hbt":
+                writer.write(b"hbt\n")  # No reply to time
+                await writer.drain()
+                continue
+            await request(reader, writer, rebuild(record))
+            samples[command].append(time.perf_counter() - started)
+            if command == "xit":
+                break
+    except (OSError, asyncio.TimeoutError):
+        errors[command] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def replay(port: int, records: list, speed: float, seed_user: int) -> dict:
+    connections = collections.defaultdict(list)
+    for record in records:
+        connections[record["conn"]].append(record)
+    samples, errors, late = collections.defaultdict(list), collections.Counter(), []
+    
+    seeder = await seed(port, seed_user, unpublished_names(records))
+    beating = asyncio.ensure_future(keep_alive(seeder))
+    origin = time.perf_counter() - records[0]["t"] / speed
+    await asyncio.gather(*(
+        replay_connection(port, conn_records, speed, origin, samples, errors, late)
+        for conn_records in connections.values()
+    ))
+    elapsed = time.perf_counter() - origin - records[0]["t"] / speed
+    beating.cancel()
+    seeder.close()
+    return {
+        "samples": {command: sorted(values) for command, values in samples.items()},
+        "errors": errors,
+        "late": sorted(late),
+        "elapsed": elapsed,
+    }
+
+################################################################################
+##################################### REPORT ###################################
+################################################################################
+
+def report(server: str, records: list, result: dict, speed: float):
+    recorded = collections.defaultdict(list)
+    for record in records:
+        recorded[record["cmd"]].append(record["ms"])
+    span = (records[-1]["t"] - records[0]["t"]) / speed
+    late = result["late"]
+    print(f"\n{server}: {len(records)} commands in {result['elapsed']:.1f}s (schedule {span:.1f}s)")
+    if late:
+        print(f"{len(late)} commands sent behind schedule, p99 {percentile(late, 0.99) * 1000:.1f} ms late")
+    # replies falls short of recorded when an error ends a connection before its remaining commands
+    print(f"{'command':<8} {'recorded':>8} {'replies':>7} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'errors':>7} "
+          f"{'rec p50':>8} {'rec p99':>8}")
+    for command in sorted(recorded, key=lambda name: -len(recorded[name])):
+        values = result["samples"].get(command, [])
+        if values:
+            latencies = " ".join(f"{percentile(values, p) * 1000:>8.2f}" for p in (0.5, 0.99, 0.999))
+        else:
+            latencies = " ".join(f"{'-':>8}" for _ in range(3))
+        replies = "-" if command == "hbt" else len(values)
+        history = sorted(recorded[command])
+        print(f"{command or '(empty)':<8} {len(history):>8} {replies:>7} {latencies} "
+              f"{result['errors'].get(command, 0):>7} {percentile(history, 0.5):>8.2f} {percentile(history, 0.99):>8.2f}")
+
+################################################################################
+##################################### MAIN #####################################
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", help="JSON lines written by server_async.py --record")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than recorded")
+    parser.add_argument("--server", choices=list(SERVERS), nargs="+", default=["server_async.py"])
+    args = parser.parse_args()
+    
+    records = load_recording(args.recording)
+    if not records:
+        sys.exit(f"{args.recording} has no commands")
+    users = max((record["user"] for record in records if record["user"] is not None), default=-1) + 1
+    users = max(users, max((int(arg[6:]) for record in records if record["cmd"] == "sch"
+                            for arg in record["args"] if arg.startswith("owner:")), default=-1) + 1)
+    connections = len({record["conn"] for record in records})
+    raise_fd_limit(connections * 2 + 100)
+    print(f"Replaying {len(records)} commands from {connections} connections and {users} users "
+          f"at {args.speed:g}x. Latencies are round trips here; rec columns are the recorded server-side times")
+    for server in args.server:
+        with tempfile.TemporaryDirectory() as workdir:
+            write_credentials(workdir, users + 1)  # The last account seeds files published before recording
+            port = free_port()
+            proc = start_server(workdir, server, port)
+            try:
+                result = asyncio.run(replay(port, records, args.speed, users))
+            finally:
+                proc.terminate()
+                proc.wait()
+            report(server, records, result, args.speed)
+
+if __name__ == "__main__":
+    main()
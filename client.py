@@ -9,6 +9,7 @@ import sys
 import threading
 import time
 import os 
+from protocol import parse_command, parse_get, parse_list
 
 ################################################################################
 ################################ STARTING CLIENT ###############################
@@ -162,26 +163,23 @@ def command_auth():
             print("Unexpected response from server")
 
 def command_get(fileinfo):
-    try:
-        _, peer_host, peer_port, filename = fileinfo.split()
-    except ValueError:
+    peer = parse_get(fileinfo)
+    if peer is None:
         print("File not found")
         return
     
     try:
-        transfer_thread = threading.Thread(target=handle_file_download,
-                                           args=(peer_host, int(peer_port), filename))
+        transfer_thread = threading.Thread(target=handle_file_download, args=peer)
         transfer_thread.daemon = True
         transfer_thread.start()
     except:
         print("File not found")
     
 def command_lap(message):
-    peers = ' '.join(message.split()[1:])
-    if peers == "No active peers":
-        print(peers)
+    peers_list = parse_list(message)
+    if not peers_list:
+        print("No active peers")
     else:
-        peers_list = peers.split()
         peer_count = len(peers_list)
         if peer_count == 1:
             print(f"1 active peer:")
@@ -192,11 +190,10 @@ def command_lap(message):
     return
 
 def command_lpf(message):
-    files = ' '.join(message.split()[1:])
-    if files == "No files published":
-        print(files)
+    files_list = parse_list(message)
+    if not files_list:
+        print("No files published")
     else:
-        files_list = files.split()
         file_count = len(files_list)
         if file_count == 1:
             print(f"1 published file:")
@@ -218,11 +215,10 @@ def command_pub(message):
     return
 
 def command_sch(message):
-    files = ' '.join(message.split()[1:])
-    if not files or files == "No files found" or files == "INPUT_ERR":
+    files_list = parse_list(message)
+    if not files_list or files_list == ["INPUT_ERR"]:
         print("No files found")
     else:
-        files_list = files.split()
         file_count = len(files_list)
         if file_count == 1:
             print(f"1 file found:")
@@ -243,6 +239,15 @@ def command_unp(message):
         print("Unexpected response from server")
     return
 
+def command_xit(message):
+    print("Goodbye!")
+
+# Replies by name, looked up once each instead of through a chain of prefix checks
+REPLY_HANDLERS = {
+    "get": command_get, "lap": command_lap, "lpf": command_lpf, "pub": command_pub,
+    "sch": command_sch, "unp": command_unp, "xit": command_xit,
+}
+
 ################################################################################
 ################################## RUN CLIENT ##################################
 ################################################################################
@@ -252,24 +257,14 @@ while authenticated:
     client_socket.sendall(message.encode())
     received_message = client_socket.recv(1024).decode()
     
+    reply_handler = REPLY_HANDLERS.get(parse_command(received_message).name)
     if received_message == "":
         print("Message from server is empty")
-    elif received_message.startswith("get"):
-        command_get(received_message)
-    elif received_message.startswith("lap"):
-        command_lap(received_message)
-    elif received_message.startswith("lpf"):
-        command_lpf(received_message)
-    elif received_message.startswith("pub"):
-        command_pub(received_message)
-    elif received_message.startswith("sch"):
-        command_sch(received_message)
-    elif received_message.startswith("unp"):
-        command_unp(received_message)
-    elif received_message.startswith("xit"):
-        print("Goodbye!")
-        break
-    else:
+    elif reply_handler is None:
         print("Invalid command")
+    else:
+        reply_handler(received_message)
+        if reply_handler is command_xit:
+            break
         
 client_socket.close()
\ No newline at end of file
@@ -1,64 +1,288 @@
 """
     Asyncio client for P2P file sharing
-    Usage: python3 client_async.py <SERVER_IP> <SERVER_PORT> [--ssl]
+    Usage: python3 client_async.py <SERVER_IP> <SERVER_PORT> [--ssl] [--peer-ssl] [--loop asyncio|uvloop|auto]
     coding: utf-8
     Author: Danny Li (refactored to asyncio)
 """
+import argparse
 import asyncio
-import sys
+import collections
+import contextlib
 import os
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import event_loops
+from protocol import parse_command
+from tracker_client import AuthError, ResumableSSLContext, Source, TrackerClient, TrackerError, open_connection
+
+MAX_CONCURRENT_UPLOADS = 64
+UPLOAD_BACKLOG = 1024
+PEER_REQUEST_TIMEOUT = 10.0
+TRANSFER_CHUNK_SIZE = 64 * 1024
+TLS_CHUNK_SIZE = 256 * 1024  # Bigger writes under TLS amortise per-write record and drain overhead
+IO_QUEUE_DEPTH = 2  # Double buffering: one chunk on the wire, one on the disk
+DISK_WORKERS = 4
+PIECE_SIZE = 256 * 1024  # Granularity of the completed-range bitmap and of swarm requests
+MAX_SWARM_SOURCES = 4  # Peers fetched from in parallel by one download
+SWARM_ROUNDS = 3  # Source-list refreshes before giving up on missing pieces
+HAVE_INTERVAL = 1.0  # Seconds between piece availability updates to the tracker
+PEER_CERT_FILE = "peer.crt"
+PEER_KEY_FILE = "peer.key"
+PEER_TLS_TICKETS = 4  # Session tickets per handshake, one per connection a swarm download opens
+
 ################################################################################
-################################ STARTING CLIENT ###############################
+################################### DISK I/O ###################################
 ################################################################################
 
-if len(sys.argv) < 3:
-    print("\n===== Error usage, python3 client_async.py SERVER_IP SERVER_PORT [--ssl]\n")
-    exit(0)
+# File I/O runs in its own pool so a slow disk never stalls heartbeats or sockets
+DISK_EXECUTOR = ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix="disk-io")
 
-USE_SSL = "--ssl" in sys.argv
-SERVER_HOST = [arg for arg in sys.argv[1:] if arg != "--ssl"][0]
-SERVER_PORT = int([arg for arg in sys.argv[1:] if arg != "--ssl"][1])
+def run_disk(func, *args):
+    """Run a blocking file operation in the disk pool"""
+    return asyncio.get_event_loop().run_in_executor(DISK_EXECUTOR, func, *args)
 
-async def send_heartbeat(writer):
-    """Send periodic heartbeat to server"""
-    while True:
-        await asyncio.sleep(2)
+def pwrite_all(fd: int, data: bytes, offset: int):
+    """Write all of data at offset, looping over short writes"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def close_after(fd: int, pending):
+    """Close fd once in-flight disk operations on it have finished"""
+    if pending:
+        asyncio.gather(*pending, return_exceptions=True).add_done_callback(lambda _: os.close(fd))
+    else:
+        os.close(fd)
+
+async def read_chunks(path, chunk_size: int = TRANSFER_CHUNK_SIZE, depth: int = IO_QUEUE_DEPTH,
+                      offset: int = 0, length: int = None):
+    """Yield a file's chunks (or those of [offset, offset + length)), keeping up to depth reads in flight"""
+    fd = await run_disk(os.open, str(path), os.O_RDONLY)
+    end = None if length is None else offset + length
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < depth and (end is None or offset < end):
+                size = chunk_size if end is None else min(chunk_size, end - offset)
+                pending.append(run_disk(os.pread, fd, size, offset))
+                offset += size
+            if not pending:
+                return
+            data = await pending.popleft()
+            if not data:
+                return
+            yield data
+    finally:
+        close_after(fd, pending)
+
+class WriteBehind:
+    """Positional file writer that lets up to depth writes run behind the network"""
+    
+    def __init__(self, fd: int, depth: int = IO_QUEUE_DEPTH):
+        self.fd = fd
+        self.depth = depth
+        self.pending = collections.deque()
+    
+    @classmethod
+    async def create(cls, path, depth: int = IO_QUEUE_DEPTH):
+        """Open path for writing, truncating any previous contents"""
+        fd = await run_disk(os.open, str(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        return cls(fd, depth)
+    
+    async def write_at(self, data: bytes, offset: int):
+        """Queue a write, waiting only when depth writes are already in flight"""
+        while len(self.pending) >= self.depth:
+            await self.pending.popleft()
+        self.pending.append(self.submit(data, offset))
+    
+    def submit(self, data: bytes, offset: int):
+        """Start one positional write in the disk pool"""
+        return run_disk(pwrite_all, self.fd, data, offset)
+    
+    async def flush(self):
+        """Wait for every queued write, raising the first disk error"""
+        while self.pending:
+            await self.pending.popleft()
+    
+    def close(self):
+        """Release the file once outstanding writes have drained"""
+        close_after(self.fd, self.pending)
+        self.pending = collections.deque()
+
+def preallocate(fd: int, size: int):
+    """Reserve size bytes up front, falling back to a sparse extend where unsupported"""
+    if size == 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+class DownloadSink(WriteBehind):
+    """Preallocated .part file that accepts chunks at any offset.
+
+    Pieces are marked in the bitmap only once their bytes are on disk, and the
+    file is renamed over dest atomically when every piece has arrived.
+    """
+    
+    def __init__(self, fd: int, dest, file_size: int, piece_size: int = PIECE_SIZE,
+                 depth: int = IO_QUEUE_DEPTH):
+        super().__init__(fd, depth)
+        self.dest = Path(dest)
+        self.part_path = part_path(dest)
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.num_pieces = -(-file_size // piece_size)
+        self.bitmap = bytearray(-(-self.num_pieces // 8))
+        self.piece_spans = {}  # {piece index: sorted, disjoint [start, end) byte ranges on disk} for partial pieces
+        self.pieces_done = 0
+    
+    @classmethod
+    async def open(cls, dest, file_size: int, piece_size: int = PIECE_SIZE,
+                   depth: int = IO_QUEUE_DEPTH):
+        """Create dest's .part file at its final size"""
+        def create():
+            fd = os.open(str(part_path(dest)), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                preallocate(fd, file_size)
+            except OSError:
+                os.close(fd)
+                raise
+            return fd
+        return cls(await run_disk(create), dest, file_size, piece_size, depth)
+    
+    @property
+    def complete(self) -> bool:
+        return self.pieces_done == self.num_pieces
+    
+    def has_piece(self, index: int) -> bool:
+        return bool(self.bitmap[index >> 3] & (0x80 >> (index & 7)))
+    
+    def has_range(self, offset: int, length: int) -> bool:
+        """Whether every piece overlapping [offset, offset + length) is on disk"""
+        if offset < 0 or length <= 0 or offset + length > self.file_size:
+            return False
+        first, last = offset // self.piece_size, (offset + length - 1) // self.piece_size
+        return all(self.has_piece(index) for index in range(first, last + 1))
+    
+    def missing_pieces(self) -> list:
+        return [index for index in range(self.num_pieces) if not self.has_piece(index)]
+    
+    def piece_range(self, index: int) -> tuple:
+        """Byte range [start, end) covered by a piece"""
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.file_size)
+    
+    async def write_at(self, data: bytes, offset: int):
+        if offset < 0 or offset + len(data) > self.file_size:
+            raise ValueError(f"write [{offset}, {offset + len(data)}) outside file of {self.file_size} bytes")
+        await super().write_at(data, offset)
+    
+    def submit(self, data: bytes, offset: int):
+        """Start a write that credits its pieces once it reaches the disk"""
+        async def write_and_credit():
+            await run_disk(pwrite_all, self.fd, data, offset)
+            self._credit(offset, len(data))
+        return asyncio.ensure_future(write_and_credit())
+    
+    def _credit(self, offset: int, length: int):
+        """Add written bytes to the ranges covered in each piece they overlap.
+
+        Ranges are merged rather than summed, so a retried or overlapping write
+        cannot mark a piece done while part of it is still missing.
+        """
+        end = offset + length
+        while offset < end:
+            index = offset // self.piece_size
+            piece_end = min((index + 1) * self.piece_size, end)
+            if not self.has_piece(index):
+                spans = self.piece_spans.setdefault(index, [])
+                add_span(spans, offset, piece_end)
+                if spans[0] == self.piece_range(index):
+                    del self.piece_spans[index]
+                    self.bitmap[index >> 3] |= 0x80 >> (index & 7)
+                    self.pieces_done += 1
+            offset = piece_end
+    
+    async def finish(self) -> bool:
+        """Flush, and rename into place if every piece arrived; otherwise discard the .part"""
         try:
-            writer.write(b"hbt")
-            await writer.drain()
-        except:
-            break
+            await self.flush()
+        finally:
+            self.close()
+        if self.complete:
+            await run_disk(os.replace, self.part_path, self.dest)
+            return True
+        await run_disk(remove_if_exists, self.part_path)
+        return False
+
+def add_span(spans: list, start: int, end: int):
+    """Merge [start, end) into a sorted list of disjoint ranges, in place"""
+    merged = []
+    for span in spans:
+        if span[1] < start or span[0] > end:
+            merged.append(span)
+        else:
+            start, end = min(start, span[0]), max(end, span[1])
+    merged.append((start, end))
+    spans[:] = sorted(merged)
+
+def part_path(dest) -> Path:
+    """Where an in-progress download of dest is staged"""
+    dest = Path(dest)
+    return dest.with_name(dest.name + ".part")
+
+def remove_if_exists(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+################################################################################
+################################ PEER TRANSFERS ################################
+################################################################################
 
-async def handle_file_upload(reader, writer, filename):
-    """Handle file upload to peer"""
+async def handle_file_upload(reader, writer, path, offset: int = 0, length: int = None,
+                             chunk_size: int = TRANSFER_CHUNK_SIZE, use_sendfile: bool = False):
+    """Handle file upload to peer, either the whole file or the range [offset, offset + length)"""
     try:
-        file_size = os.path.getsize(filename)
-        writer.write(f"size {file_size}".encode())
+        if length is None:
+            length = await run_disk(os.path.getsize, path)
+        writer.write(f"size {length}".encode())
         await writer.drain()
         
         if await reader.read(1024) != b"ready":
             return
         
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
+        # sendfile skips the copies through Python, but only works on plaintext sockets
+        if use_sendfile and writer.get_extra_info("sslcontext") is None:
+            with await run_disk(open, path, "rb") as file:
+                await asyncio.get_event_loop().sendfile(writer.transport, file, offset, length)
+            return
+        
+        # The next chunk is read from disk while the current one is being sent
+        async for data in read_chunks(path, chunk_size, offset=offset, length=length):
+            writer.write(data)
+            await writer.drain()
     except Exception as e:
         print(f"Upload error: {e}")
-    finally:
-        writer.close()
-        await writer.wait_closed()
 
-async def handle_file_download(peer_host, peer_port, filename):
-    """Handle file download from peer"""
+def remember_session(ssl_context, host: str, port: int, writer):
+    """Keep a peer's TLS session so the next transfer to it can skip the full handshake"""
+    if isinstance(ssl_context, ResumableSSLContext):
+        ssl_context.remember((host, port), writer)
+
+async def handle_file_download(peer_host, peer_port, filename, dest=None, ssl_context=None) -> bool:
+    """Handle file download from peer, saving to dest (defaults to filename)"""
+    writer = None
+    completed = False
+    chunk_size = TLS_CHUNK_SIZE if ssl_context else TRANSFER_CHUNK_SIZE
     try:
-        reader, writer = await asyncio.open_connection(peer_host, peer_port)
+        reader, writer = await open_connection(peer_host, peer_port, ssl_context)
         
         writer.write(f"download {filename}".encode())
         await writer.drain()
@@ -67,55 +291,253 @@ async def handle_file_download(peer_host, peer_port, filename):
         size_str = size_data.decode()
         if not size_str.startswith("size"):
             print(f"Invalid response from peer: {size_str}")
-            return
+            return False
         
         file_size = int(size_str.split()[1])
+        remember_session(ssl_context, peer_host, peer_port, writer)
         writer.write(b"ready")
         await writer.drain()
         
-        with open(filename, 'wb') as f:
+        # Chunks land at their offsets in a preallocated .part file, renamed into place when complete
+        sink = await DownloadSink.open(dest or filename, file_size)
+        try:
             received = 0
             while received < file_size:
-                data = await reader.read(4096)
+                data = await reader.read(min(chunk_size, file_size - received))
                 if not data:
                     break
-                f.write(data)
+                await sink.write_at(data, received)
                 received += len(data)
+        finally:
+            completed = await sink.finish()
         
-        if received == file_size:
+        if completed:
             print(f"{filename} downloaded successfully")
         else:
             print(f"{filename} download incomplete")
     except Exception as e:
         print(f"Download failed: {e}")
     finally:
-        writer.close()
-        await writer.wait_closed()
+        if writer is not None:
+            writer.close()
+            await writer.wait_closed()
+    return completed
+
+class PeerServer:
+    """Serves published files to other peers from one listening socket.
 
-async def upload_server(upload_port, published_files):
-    """Listen for P2P download requests"""
-    async def handle_peer(reader, writer):
+    The published set is shared with the tracker client, so publishing or
+    unpublishing takes effect for new requesters immediately. With an
+    ssl_context every transfer is encrypted; use_sendfile lets plaintext
+    uploads go through os.sendfile, which can block the loop on a cold page cache.
+    """
+    
+    def __init__(self, published_files, host: str = '0.0.0.0', port: int = 0,
+                 max_uploads: int = MAX_CONCURRENT_UPLOADS, root: str = ".",
+                 ssl_context=None, use_sendfile: bool = False):
+        self.published_files = published_files
+        self.root = Path(root)
+        self.host = host
+        self.port = port
+        self.partial_files = {}  # {"filename": DownloadSink} for downloads in progress
+        self.server = None
+        self.upload_slots = asyncio.Semaphore(max_uploads)
+        self.ssl_context = ssl_context
+        self.use_sendfile = use_sendfile
+        self.chunk_size = TLS_CHUNK_SIZE if ssl_context else TRANSFER_CHUNK_SIZE
+    
+    async def start(self) -> int:
+        """Bind the listening socket once and return the port actually bound"""
+        self.server = await asyncio.start_server(
+            self.handle_peer, host=self.host, port=self.port, backlog=UPLOAD_BACKLOG,
+            ssl=self.ssl_context
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+    
+    async def close(self):
+        """Stop accepting requesters"""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+    
+    def locate(self, filename: str, offset: int = 0, length: int = None):
+        """Path that can serve filename (or a range of it), or None"""
+        if filename in self.published_files:
+            return self.root / filename
+        # Downloads in progress serve the pieces they already have
+        sink = self.partial_files.get(filename)
+        if sink is not None and length is not None and sink.has_range(offset, length):
+            return sink.part_path
+        return None
+    
+    async def handle_peer(self, reader, writer):
+        """Serve download requests: one legacy whole-file request, or any number of range requests"""
         try:
-            data = await reader.read(1024)
-            if not data:
-                return
-            
-            parts = data.decode().split()
-            if len(parts) < 2 or parts[0] != "download":
-                return
-            
-            filename = parts[1]
-            if filename in published_files:
-                await handle_file_upload(reader, writer, filename)
-        except:
+            while True:
+                data = await asyncio.wait_for(reader.read(1024), timeout=PEER_REQUEST_TIMEOUT)
+                parts = data.decode().split()
+                if len(parts) < 2 or parts[0] not in ("download", "stat"):
+                    return
+                
+                filename = parts[1]
+                if parts[0] == "stat":
+                    path = self.locate(filename)
+                    size = await run_disk(os.path.getsize, path) if path else None
+                    writer.write(f"size {size}".encode() if path else b"ERR")
+                    await writer.drain()
+                    continue
+                
+                offset, length = (int(parts[2]), int(parts[3])) if len(parts) >= 4 else (0, None)
+                path = self.locate(filename, offset, length)
+                if path is None:
+                    writer.write(b"ERR")
+                    await writer.drain()
+                    return
+                # Requesters beyond the slot limit wait here instead of competing for disk and bandwidth
+                async with self.upload_slots:
+                    await handle_file_upload(reader, writer, path, offset, length,
+                                             self.chunk_size, self.use_sendfile)
+                if length is None:
+                    return
+        except (asyncio.TimeoutError, ConnectionError, ssl.SSLError, UnicodeDecodeError, ValueError):
             pass
         finally:
             writer.close()
-            await writer.wait_closed()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+async def start_peer_server(tracker: TrackerClient, ssl_context=None) -> PeerServer:
+    """Start serving the tracker's published files and register the upload port"""
+    peer_server = PeerServer(tracker.published, ssl_context=ssl_context)
+    await peer_server.start()
+    await tracker.register_port(peer_server.port)
+    return peer_server
+
+################################################################################
+############################### SWARM DOWNLOADS ################################
+################################################################################
+
+async def stat_peer(source: Source, filename: str, ssl_context=None):
+    """Ask a full seeder for the size of filename"""
+    reader, writer = await open_connection(source.host, source.port, ssl_context)
+    try:
+        writer.write(f"stat {filename}".encode())
+        await writer.drain()
+        parts = (await reader.read(1024)).decode().split()
+        remember_session(ssl_context, source.host, source.port, writer)
+        return int(parts[1]) if len(parts) == 2 and parts[0] == "size" else None
+    finally:
+        writer.close()
+
+async def fetch_pieces(source: Source, filename: str, sink: DownloadSink, todo: set, ssl_context=None):
+    """Pull pieces this source has from the shared todo set over one connection"""
+    reader, writer = await open_connection(source.host, source.port, ssl_context)
+    try:
+        while True:
+            index = next((i for i in todo if source.has_piece(i)), None)
+            if index is None:
+                return
+            todo.discard(index)
+            try:
+                start, end = sink.piece_range(index)
+                writer.write(f"download {filename} {start} {end - start}".encode())
+                await writer.drain()
+                if (await reader.read(1024)).decode() != f"size {end - start}":
+                    raise ConnectionError(f"{source.host}:{source.port} refused piece {index}")
+                remember_session(ssl_context, source.host, source.port, writer)
+                writer.write(b"ready")
+                await writer.drain()
+                # A whole piece is buffered so a dropped connection never leaves it half-written
+                await sink.write_at(await reader.readexactly(end - start), start)
+            except BaseException:
+                todo.add(index)
+                raise
+    finally:
+        writer.close()
+
+async def advertise_pieces(tracker: TrackerClient, filename: str, sink: DownloadSink):
+    """Periodically tell the tracker which pieces we can serve"""
+    advertised = 0
+    while True:
+        await asyncio.sleep(HAVE_INTERVAL)
+        if sink.pieces_done != advertised:
+            advertised = sink.pieces_done
+            try:
+                await tracker.have(filename, sink.file_size, sink.piece_size, sink.bitmap)
+            except TrackerError:
+                pass
+
+async def swarm_download(tracker: TrackerClient, peer_server: PeerServer, filename: str,
+                         dest=None, max_sources: int = MAX_SWARM_SOURCES, ssl_context=None) -> bool:
+    """Download filename piece by piece from full and partial seeders.
+
+    Finished pieces are served to other downloaders while the rest arrive, and a
+    download saved under the peer server's root keeps being seeded once complete.
+    """
+    dest = Path(dest or peer_server.root / filename)
+    sources = await tracker.src(filename)
+    if not sources:
+        # Trackers without swarm support, or nobody sharing: fall back to a single-peer get
+        peer = await tracker.get(filename)
+        if peer is None:
+            print("File not found")
+            return False
+        return await handle_file_download(peer.host, peer.port, filename, dest, ssl_context)
+    
+    file_size = next((source.file_size for source in sources if source.file_size is not None), None)
+    for source in sources:
+        if file_size is not None:
+            break
+        try:
+            file_size = await stat_peer(source, filename, ssl_context)
+        except (ConnectionError, OSError):
+            pass
+    if file_size is None:
+        print(f"Download failed: no source could describe {filename}")
+        return False
+    
+    in_progress = peer_server.partial_files.get(filename)
+    if in_progress is not None and in_progress.dest == dest:
+        print(f"{filename} is already downloading")
+        return False
+    sink = await DownloadSink.open(dest, file_size)
+    peer_server.partial_files[filename] = sink
+    advertiser = asyncio.ensure_future(advertise_pieces(tracker, filename, sink))
+    todo = set(range(sink.num_pieces))
+    try:
+        for _ in range(SWARM_ROUNDS):
+            usable = [
+                source for source in sources
+                if source.bitmap is None or (source.piece_size, source.file_size) == (sink.piece_size, file_size)
+            ]
+            await asyncio.gather(
+                *(fetch_pieces(source, filename, sink, todo, ssl_context) for source in usable[:max_sources]),
+                return_exceptions=True
+            )
+            if not todo:
+                break
+            sources = await tracker.src(filename)
+    finally:
+        advertiser.cancel()
+        if peer_server.partial_files.get(filename) is sink:  # Another download of the name may have replaced it
+            del peer_server.partial_files[filename]
+        completed = await sink.finish()
     
-    server = await asyncio.start_server(handle_peer, host='0.0.0.0', port=upload_port)
-    async with server:
-        await server.serve_forever()
+    if not completed:
+        print(f"{filename} download incomplete")
+        with contextlib.suppress(TrackerError):
+            await tracker.withdraw(filename)
+        return False
+    print(f"{filename} downloaded successfully")
+    if dest.resolve() == (peer_server.root / filename).resolve():
+        await tracker.pub(filename, file_size)
+    else:
+        with contextlib.suppress(TrackerError):
+            await tracker.withdraw(filename)
+    return True
 
 async def create_ssl_context():
     """Create SSL context for client"""
@@ -124,7 +546,8 @@ async def create_ssl_context():
     if not cert_file.exists():
         print("Warning: server.crt not found. SSL connection may fail.")
     
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    # Reconnects offer the previous session so the server can skip the full handshake
+    ssl_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
     ssl_context.check_hostname = False
     ssl_context.verify_mode = ssl.CERT_REQUIRED
     if cert_file.exists():
@@ -134,121 +557,134 @@ async def create_ssl_context():
     
     return ssl_context
 
-async def main():
-    """Main client entry point"""
-    if USE_SSL:
-        ssl_context = await create_ssl_context()
-        reader, writer = await asyncio.open_connection(
-            SERVER_HOST, SERVER_PORT, ssl=ssl_context
-        )
-    else:
-        reader, writer = await asyncio.open_connection(SERVER_HOST, SERVER_PORT)
+def create_peer_ssl_contexts(cert_file: str = PEER_CERT_FILE, key_file: str = PEER_KEY_FILE):
+    """Server and client contexts for encrypted peer transfers.
+
+    Peers have no shared CA, so each serves a self-signed P-256 certificate and
+    requesters do not verify it: transfers are private from passive observers but
+    peers are not authenticated. The client context caches sessions per peer.
+    """
+    if not Path(cert_file).exists() or not Path(key_file).exists():
+        import subprocess
+        print("Peer certificate not found. Generating a self-signed one...")
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+            "-nodes", "-keyout", key_file,
+            "-out", cert_file,
+            "-days", "365",
+            "-subj", "/CN=peer"
+        ], check=True, capture_output=True)
+    
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert_file, key_file)
+    server_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    server_context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(server_context, "num_tickets"):
+        server_context.num_tickets = PEER_TLS_TICKETS
+    
+    client_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    client_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return server_context, client_context
+
+FAILURE_MESSAGES = {"pub": "Failed to publish file", "unp": "Failed to unpublish file"}
+
+async def ainput(prompt: str = "") -> str:
+    """Read a line from stdin without blocking heartbeats on the event loop"""
+    return await asyncio.get_event_loop().run_in_executor(None, input, prompt)
+
+def print_list(items, singular: str, plural: str, empty_message: str):
+    """Print a list response the same way as the legacy client"""
+    if not items:
+        print(empty_message)
+        return
+    print(f"{len(items)} {plural if len(items) > 1 else singular}:")
+    for item in items:
+        print(item)
+
+async def main(server_host: str, server_port: int, use_ssl: bool, peer_ssl: bool = False):
+    """Interactive shell on top of TrackerClient"""
+    ssl_context = await create_ssl_context() if use_ssl else None
+    # Every peer in a swarm must agree on --peer-ssl, the data channel does not negotiate it
+    peer_server_context, peer_client_context = create_peer_ssl_contexts() if peer_ssl else (None, None)
+    tracker = TrackerClient(server_host, server_port, ssl_context=ssl_context)
+    await tracker.connect()
     
     # Authentication
-    authenticated = False
-    while not authenticated:
-        username = input("Enter username: ")
-        password = input("Enter password: ")
-        
-        writer.write(f"auth {username} {password}".encode())
-        await writer.drain()
-        
-        response = (await reader.read(1024)).decode()
-        
-        if response == "auth OK":
-            authenticated = True
-            print("Authentication successful. Available commands: get, lap, lpf, pub, sch, unp, xit")
-            
-            # Start heartbeat
-            asyncio.create_task(send_heartbeat(writer))
-            
-            # Start upload server
-            upload_server_sock = await asyncio.start_server(
-                lambda r, w: None, host='0.0.0.0', port=0
-            )
-            upload_port = upload_server_sock.sockets[0].getsockname()[1]
-            upload_server_sock.close()
-            await upload_server_sock.wait_closed()
-            
-            # Create new upload server
-            upload_server = await asyncio.start_server(
-                lambda r, w: None, host='0.0.0.0', port=upload_port
-            )
-            asyncio.create_task(upload_server.serve_forever())
-            
-            # Send upload port to server
-            writer.write(f"port {upload_port}".encode())
-            await writer.drain()
-            await reader.read(1024)  # Wait for "port OK"
-        else:
+    while True:
+        username = await ainput("Enter username: ")
+        password = await ainput("Enter password: ")
+        try:
+            await tracker.auth(username, password)
+            break
+        except AuthError:
             print("Authentication failed. Please try again.")
+    print("Authentication successful. Available commands: get, lap, lpf, pub, sch, unp, xit")
+    
+    # Serve our published files for as long as the session lasts
+    peer_server = await start_peer_server(tracker, peer_server_context)
+    
+    # Main command loop; downloads run in the background, referenced until they finish
+    downloads = set()
     
-    # Main command loop
-    published_files = set()
+    def report_download(download: asyncio.Task):
+        downloads.discard(download)
+        if not download.cancelled() and download.exception() is not None:
+            print(f"Download failed: {download.exception()}")
     
     try:
         while True:
-            message = input("")
+            message = (await ainput("")).strip()
             if not message:
                 continue
+            command, args = parse_command(message)
+            argument = " ".join(args)
             
-            writer.write(message.encode())
-            await writer.drain()
-            
-            response = (await reader.read(1024)).decode()
-            
-            if message.startswith("get"):
-                parts = response.split()
-                if len(parts) >= 4:
-                    filename = parts[3]
-                    peer_host = parts[1]
-                    peer_port = int(parts[2])
-                    asyncio.create_task(handle_file_download(peer_host, peer_port, filename))
-            elif message.startswith("lap"):
-                peers = ' '.join(parts[1:])
-                if peers == "No active peers":
-                    print(peers)
-                else:
-                    peer_list = peers.split()
-                    print(f"{len(peer_list)} active peer{'s' if len(peer_list) > 1 else ''}:")
-                    for peer in peer_list:
-                        print(peer)
-            elif message.startswith("lpf"):
-                files = ' '.join(parts[1:])
-                if files == "No files published":
-                    print(files)
-                else:
-                    file_list = files.split()
-                    print(f"{len(file_list)} published file{'s' if len(file_list) > 1 else ''}:")
-                    for f in file_list:
-                        print(f)
-            elif message.startswith("pub"):
-                _, filename = message.split()
-                published_files.add(filename)
-                print("File published successfully" if response == "pub OK" else "Failed to publish file")
-            elif message.startswith("sch"):
-                files = ' '.join(parts[1:])
-                if files == "No files found":
-                    print(files)
+            try:
+                if command == "get":
+                    download = asyncio.create_task(swarm_download(tracker, peer_server, argument,
+                                                                   ssl_context=peer_client_context))
+                    downloads.add(download)
+                    download.add_done_callback(report_download)
+                elif command == "lap":
+                    peers = [peer async for peer in tracker.iter_lap()]
+                    print_list(peers, "active peer", "active peers", "No active peers")
+                elif command == "lpf":
+                    files = [name async for name in tracker.iter_lpf()]
+                    print_list(files, "published file", "published files", "No files published")
+                elif command == "pub":
+                    await tracker.pub(argument, os.path.getsize(argument) if os.path.isfile(argument) else None)
+                    print("File published successfully")
+                elif command == "sch":
+                    if any(term.startswith("limit:") for term in args):
+                        files = await tracker.sch(*args)  # Best matches first
+                    else:
+                        files = [name async for name in tracker.iter_sch(*args)] if args else []
+                    print_list(files, "file found", "files found", "No files found")
+                elif command == "unp":
+                    await tracker.unp(argument)
+                    print("File unpublished successfully")
+                elif command == "xit":
+                    print("Goodbye!")
+                    break
                 else:
-                    file_list = files.split()
-                    print(f"{len(file_list)} file{'s' if len(file_list) > 1 else ''} found:")
-                    for f in file_list:
-                        print(f)
-            elif message.startswith("unp"):
-                _, filename = message.split()
-                published_files.discard(filename)
-                print("File unpublished successfully" if response == "unp OK" else "Failed to unpublish file")
-            elif message.startswith("xit"):
-                print("Goodbye!")
-                break
-            else:
-                print(response)
+                    print(await tracker.request(message))
+            except TrackerError as e:
+                print(FAILURE_MESSAGES.get(command, str(e)))
     except KeyboardInterrupt:
         print("\nDisconnected.")
     finally:
-        writer.close()
-        await writer.wait_closed()
+        await peer_server.close()
+        await tracker.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Asyncio CLI client for P2P file sharing")
+    parser.add_argument("server_ip")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--ssl", action="store_true", help="encrypt the tracker connection")
+    parser.add_argument("--peer-ssl", action="store_true", help="encrypt peer transfers (all peers must agree)")
+    parser.add_argument("--loop", choices=event_loops.LOOP_CHOICES, default="asyncio",
+                        help="event loop implementation (uvloop falls back to asyncio if not installed)")
+    args = parser.parse_args()
+    event_loops.run(main(args.server_ip, args.server_port, args.ssl, args.peer_ssl), args.loop)
@@ -0,0 +1,48 @@
+"""
+    Event loop selection shared by the asyncio server, client and benchmarks
+    Usage: import event_loops; event_loops.run(main(), "uvloop")
+    coding: utf-8
+    Author: Danny Li
+"""
+import asyncio
+import sys
+
+LOOP_CHOICES = ("asyncio", "uvloop", "auto")
+
+
+def available() -> list:
+    """Loop implementations importable here"""
+    loops = ["asyncio"]
+    try:
+        import uvloop  # noqa: F401
+        loops.append("uvloop")
+    except ImportError:
+        pass
+    return loops
+
+
+def resolve(name: str = "asyncio") -> str:
+    """The loop that will actually run for a requested name: "auto" picks the fastest installed"""
+    if name not in LOOP_CHOICES:
+        raise ValueError(f"unknown event loop {name!r}, expected one of {', '.join(LOOP_CHOICES)}")
+    if name == "asyncio":
+        return name
+    if "uvloop" in available():
+        return "uvloop"
+    if name == "uvloop":
+        print("uvloop is not installed (pip install uvloop); using the default asyncio loop", file=sys.stderr)
+    return "asyncio"
+
+
+def run(main, name: str = "asyncio"):
+    """asyncio.run(main) on the requested loop, falling back to the default one"""
+    if resolve(name) == "asyncio":
+        return asyncio.run(main)
+    import uvloop
+    if sys.version_info >= (3, 12):
+        return asyncio.run(main, loop_factory=uvloop.new_event_loop)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        return asyncio.run(main)
+    finally:
+        asyncio.set_event_loop_policy(None)
@@ -0,0 +1,283 @@
+"""
+    Prometheus-format metrics for the tracker: preallocated counters and histograms served over HTTP
+    Usage: from metrics import Registry, TimedLock, StallWatchdog, monitor_loop_lag, serve_metrics
+    coding: utf-8
+    Author: Danny Li
+"""
+import asyncio
+import bisect
+import collections
+import secrets
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+
+import tracing
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOOP_LAG_INTERVAL = 0.25  # Seconds between event loop lag probes
+STALL_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STALL_THRESHOLD = 0.5  # Seconds the loop may go without turning before it counts as stalled
+STALL_POLL = 0.1
+STALL_MEMORY = 120.0  # Default seconds of past stalls kept for stalled_seconds()
+SCRAPE_TIMEOUT = 5.0
+
+################################################################################
+##################################### METRICS ##################################
+################################################################################
+
+class Counter:
+    """Monotonic counter over a fixed label set, with one preallocated slot per label value"""
+    __slots__ = ("name", "help", "label", "index", "values")
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label: str = None, keys=("",)):
+        self.name, self.help, self.label = name, help, label
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.values = [0] * len(keys)
+
+    def inc(self, amount: int = 1, key: str = ""):
+        self.values[self.index[key]] += amount
+
+    def samples(self):
+        for key, i in self.index.items():
+            yield self.name, labels(self.label, key), self.values[i]
+
+
+class Histogram:
+    """Latency histogram over a fixed label set; observe() only bumps preallocated slots"""
+    __slots__ = ("name", "help", "label", "index", "bounds", "counts", "sums", "other")
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label: str = None, keys=("",), bounds=LATENCY_BUCKETS):
+        self.name, self.help, self.label, self.bounds = name, help, label, bounds
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.other = self.index.get("other")  # Slot for keys outside the label set, if there is one
+        self.counts = [[0] * (len(bounds) + 1) for _ in keys]  # Last bucket is +Inf
+        self.sums = [0.0] * len(keys)
+
+    def observe(self, value: float, key: str = ""):
+        i = self.index.get(key, self.other)
+        self.counts[i][bisect.bisect_left(self.bounds, value)] += 1
+        self.sums[i] += value
+
+    def samples(self):
+        for key, i in self.index.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + ("+Inf",), self.counts[i]):
+                cumulative += count
+                yield f"{self.name}_bucket", labels(self.label, key, le=bound), cumulative
+            yield f"{self.name}_sum", labels(self.label, key), self.sums[i]
+            yield f"{self.name}_count", labels(self.label, key), cumulative
+
+
+class Collected:
+    """Value read only at scrape time: a number, or {label value: number} for labelled series"""
+    __slots__ = ("name", "help", "label", "kind", "collect")
+
+    def __init__(self, name: str, help: str, kind: str, collect, label: str = None):
+        self.name, self.help, self.kind, self.collect, self.label = name, help, kind, collect, label
+
+    def samples(self):
+        value = self.collect()
+        if self.label is None:
+            yield self.name, "", value
+            return
+        for key, count in sorted(value.items()):
+            yield self.name, labels(self.label, key), count
+
+
+def labels(label: str, key: str, **extra) -> str:
+    pairs = ([(label, key)] if label else []) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Registry:
+    """The metrics a process exposes, in registration order"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, label: str = None, keys=("",)) -> Counter:
+        return self.add(Counter(name, help, label, keys))
+
+    def histogram(self, name: str, help: str, label: str = None, keys=("",), bounds=LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, label, keys, bounds))
+
+    def gauge(self, name: str, help: str, collect, label: str = None) -> Collected:
+        return self.add(Collected(name, help, "gauge", collect, label))
+
+    def collected_counter(self, name: str, help: str, collect, label: str = None) -> Collected:
+        return self.add(Collected(name, help, "counter", collect, label))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Text exposition format 0.0.4"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{series} {value!r}" for name, series, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+################################################################################
+################################### PROBES #####################################
+################################################################################
+
+class TimedLock:
+    """asyncio.Lock that records how long every acquire waited, also in the current trace if sampled"""
+    __slots__ = ("lock", "wait")
+
+    def __init__(self, wait: Histogram):
+        self.lock = asyncio.Lock()
+        self.wait = wait
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        await self.lock.acquire()
+        waited = time.perf_counter() - started
+        self.wait.observe(waited)
+        tracing.add_lock_wait(waited)
+
+    async def __aexit__(self, *exc_info):
+        self.lock.release()
+
+
+async def monitor_loop_lag(lag: Histogram, interval: float = LOOP_LAG_INTERVAL):
+    """Observe how late the loop wakes a sleeping task: time callbacks spent queued behind others"""
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - started - interval))
+
+
+class StallWatchdog:
+    """Notices when the event loop stops turning, and blames the code that stopped it.
+
+    A task on the loop stamps tick every poll interval. A daemon thread watches the
+    stamp; once it is threshold old, the thread samples the loop thread's stack, which
+    still shows the blocking code since nothing else can run meanwhile. The stall is
+    logged and observed once the loop comes back.
+    """
+
+    def __init__(self, stalls: Histogram, threshold: float = STALL_THRESHOLD, attribute=None, log=print,
+                 memory: float = STALL_MEMORY):
+        self.stalls, self.threshold, self.log, self.memory = stalls, threshold, log, memory
+        self.attribute = attribute or (lambda frame: "other")  # Loop thread's frame -> stalls label
+        self.poll = STALL_POLL
+        self.tick = time.time()
+        self.blamed = None  # (tick, label, "file:line in function") sampled during the current stall
+        self.history = collections.deque()  # (ended, seconds) of recent stalls, by wall clock
+        self.loop_thread = None
+        self.stopped = threading.Event()  # Set when run ends, so the watching thread ends with it
+
+    async def run(self, poll: float = STALL_POLL):
+        self.poll = poll
+        self.loop_thread = threading.get_ident()
+        self.stopped.clear()
+        threading.Thread(target=self.watch, name="stall-watchdog", daemon=True).start()
+        try:
+            while True:
+                self.tick = started = time.time()
+                await asyncio.sleep(poll)
+                stalled = time.time() - started - poll
+                if stalled >= self.threshold:
+                    self.report(started, stalled)
+        finally:
+            self.stopped.set()
+
+    def watch(self):
+        while not self.stopped.wait(self.poll):
+            tick = self.tick
+            if time.time() - tick - self.poll < self.threshold or (self.blamed and self.blamed[0] == tick):
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                where = f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+                self.blamed = (tick, self.attribute(frame), where)
+
+    def report(self, started: float, stalled: float):
+        blamed = self.blamed
+        label, where = blamed[1:] if blamed and blamed[0] == started else ("other", "ended before it was sampled")
+        self.stalls.observe(stalled, label)
+        now = time.time()
+        self.history.append((now, stalled))
+        while self.history[0][0] < now - self.memory:
+            self.history.popleft()
+        self.log(f"[server] event loop stalled {stalled * 1000:.0f} ms in {label} at {where}")
+
+    def stalled_seconds(self, since: float) -> float:
+        """How long the loop has been stalled since the wall-clock time since, including a stall it is just leaving"""
+        total = sum(seconds for ended, seconds in self.history if ended > since)
+        pending = time.time() - max(self.tick, since) - self.poll  # A stall the run task has not reported yet
+        return total + pending if pending >= self.threshold else total
+
+################################################################################
+##################################### HTTP #####################################
+################################################################################
+
+async def serve_metrics(registry: Registry, port: int, host: str = "127.0.0.1", routes: dict = None,
+                        token: str = None):
+    """Answer GET /metrics with the registry's current values; one request per connection.
+
+    routes maps extra paths to coroutines taking the query parameters and returning
+    text; they may raise ValueError for bad parameters or RuntimeError when busy.
+    They are only served to requests sending "Authorization: Bearer <token>", and
+    not at all without a token. /metrics itself stays open for scrapers.
+    """
+    routes = routes or {}
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SCRAPE_TIMEOUT)
+            method, target = (request.decode("latin-1").split(" ", 2) + ["", ""])[:2]
+            path, _, query = target.partition("?")
+            if method != "GET":
+                status, body = "405 Method Not Allowed", b"GET only\n"
+            elif path in ("/metrics", "/"):
+                status, body = "200 OK", registry.render().encode()
+            elif path in routes and not authorized(request, token):
+                status, body = "401 Unauthorized", b"send Authorization: Bearer <admin token>\n"
+            elif path in routes:
+                try:
+                    status, body = "200 OK", (await routes[path](dict(parse_qsl(query)))).encode()
+                except ValueError as e:
+                    status, body = "400 Bad Request", f"{e}\n".encode()
+                except RuntimeError as e:
+                    status, body = "409 Conflict", f"{e}\n".encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host=host, port=port)
+
+
+def authorized(request: bytes, token: str) -> bool:
+    """Whether an HTTP request's headers carry token as an "Authorization: Bearer" credential"""
+    if not token:
+        return False
+    for line in request.decode("latin-1").split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "authorization":
+            scheme, _, credential = value.strip().partition(" ")
+            credential = credential.strip().encode("latin-1")
+            return scheme.lower() == "bearer" and secrets.compare_digest(credential, token.encode())
+    return False
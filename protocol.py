@@ -0,0 +1,183 @@
+"""
+    Sans-IO tracker protocol: framing, command parsing and reply formatting shared by servers and clients
+    Usage: from protocol import Decoder, parse_command, format_command, list_reply, parse_list
+    coding: utf-8
+    Author: Danny Li
+"""
+from typing import List, NamedTuple, Optional
+
+INPUT_ERR = "INPUT_ERR"  # Reply to a command the tracker does not know
+MAX_LINE = 64 * 1024  # Bytes an unterminated framed command may reach before the connection is dropped
+NO_CURSOR = "-"  # Page cursor for "from the start" in requests and "no more pages" in replies
+EMPTY_LISTS = {"lap": "No active peers", "lpf": "No files published", "sch": "No files found"}
+ARITY = {  # {"command": (fewest arguments, most or None)}, checked by Command.well_formed
+    "auth": (2, None),  # The password is every argument after the username
+    "port": (1, 1),
+    "hbt": (0, None), "hbi": (0, None), "tok": (0, None), "xit": (0, None),  # Arguments are ignored
+    "get": (1, 1), "unp": (1, 1), "src": (1, 1), "rsm": (1, 1), "wdr": (1, 1),
+    "lap": (0, None), "lpf": (0, None),  # Page arguments are checked with the page, which answers framed
+    "pub": (1, 2),  # Filename and optional size
+    "sch": (1, None),  # Pattern, key:value filters, then optional page arguments
+    "have": (4, 4),
+}
+
+################################################################################
+#################################### FRAMING ###################################
+################################################################################
+
+class ProtocolError(ValueError):
+    """A peer broke framing badly enough that its connection should be dropped"""
+
+
+class Decoder:
+    """Splits one connection's received bytes into command lines.
+
+    Newline-terminated commands (sent by the SDK) are buffered until complete;
+    legacy clients send one unterminated command per write. Undecodable bytes
+    become U+FFFD rather than errors. Only the bytes just received are searched
+    for a newline, so a long line costs linear time to collect.
+    """
+    __slots__ = ("buffer", "line_framed")
+
+    def __init__(self):
+        self.buffer = bytearray()  # The unterminated tail of a framed stream
+        self.line_framed = False  # Set by the first newline; replies to this connection may then be framed too
+
+    def feed(self, data: bytes) -> List[str]:
+        """The commands completed by data; ProtocolError once an unterminated one exceeds MAX_LINE"""
+        if not self.line_framed and b"\n" not in data:
+            return [data.decode(errors="replace")]
+        self.line_framed = True
+        end = data.rfind(b"\n")
+        if end < 0:
+            self.buffer += data
+            lines = []
+        else:
+            lines = (bytes(self.buffer) + data[:end]).split(b"\n")
+            self.buffer = bytearray(data[end + 1:])
+        if len(self.buffer) > MAX_LINE:
+            raise ProtocolError(f"command longer than {MAX_LINE} bytes")
+        return [line.decode(errors="replace").rstrip("\r") for line in lines if line.strip()]
+
+
+def frame(message: str) -> bytes:
+    """A command as the SDK sends it: newline-terminated, so commands written together stay apart"""
+    return f"{message}\n".encode()
+
+################################################################################
+################################### COMMANDS ###################################
+################################################################################
+
+class Command(NamedTuple):
+    """One command or reply line: its first word and the whitespace-separated words after it"""
+    name: str
+    args: List[str]
+
+    def well_formed(self) -> bool:
+        """Whether a known command has an acceptable number of arguments (unknown ones always do)"""
+        fewest, most = ARITY.get(self.name, (0, None))
+        return fewest <= len(self.args) and (most is None or len(self.args) <= most)
+
+
+def parse_command(line: str) -> Command:
+    """Split a line once; never raises, and an empty line has the name "" """
+    parts = line.split()
+    if not parts:
+        return Command("", [])
+    return Command(parts[0], parts[1:])
+
+
+def format_command(name: str, *args) -> str:
+    return " ".join([name, *map(str, args)])
+
+################################################################################
+#################################### REPLIES ###################################
+################################################################################
+
+class PeerAddress(NamedTuple):
+    """Location of a peer serving a file, as returned by get"""
+    host: str
+    port: int
+    filename: str
+
+
+class Source(NamedTuple):
+    """A peer able to serve some or all pieces of a file, as returned by src"""
+    host: str
+    port: int
+    file_size: Optional[int] = None  # None for full seeders
+    piece_size: Optional[int] = None
+    bitmap: Optional[bytes] = None  # None means every piece is available
+
+    def has_piece(self, index: int) -> bool:
+        if self.bitmap is None:
+            return True
+        return bool(self.bitmap[index >> 3] & (0x80 >> (index & 7)))
+
+    @classmethod
+    def parse(cls, entry: str) -> "Source":
+        """Parse 'host,port,*' or 'host,port,file_size,piece_size,bitmap_hex'"""
+        fields = entry.split(",")
+        if fields[2] == "*":
+            return cls(fields[0], int(fields[1]))
+        return cls(fields[0], int(fields[1]), int(fields[2]), int(fields[3]), bytes.fromhex(fields[4]))
+
+
+class Page(NamedTuple):
+    """One page of a paginated lap, lpf or sch"""
+    items: List[str]
+    cursor: Optional[str]  # Pass back to fetch the next page; None after the last one
+
+
+def list_reply(name: str, items: list) -> str:
+    """Unpaginated lap, lpf or sch reply, which legacy clients expect in one read"""
+    return f"{name} {' '.join(items)}" if items else f"{name} {EMPTY_LISTS[name]}"
+
+
+def page_reply(name: str, cursor: Optional[str], items: list) -> str:
+    """Newline-terminated "<name> <next cursor or -> <items...>" reply to a paginated request"""
+    return " ".join([name, cursor or NO_CURSOR, *items]) + "\n"
+
+
+def busy_reply(retry_after: float, line_framed: bool) -> str:
+    # Framed connections get a terminated reply, which both their framed and unframed reads accept
+    return f"BUSY {retry_after:.3f}\n" if line_framed else f"BUSY {retry_after:.3f}"
+
+
+def busy_delay(reply: str) -> Optional[float]:
+    """Seconds a BUSY reply asks the client to wait before retrying, or None for any other reply"""
+    if not reply.startswith("BUSY "):
+        return None
+    return float(reply.split()[1])
+
+
+def parse_list(reply: str, empty_message: Optional[str] = None) -> List[str]:
+    """Items of a list reply, mapping the empty sentinel (by default the reply's own) to []"""
+    name, items = parse_command(reply)
+    if empty_message is None:
+        empty_message = EMPTY_LISTS.get(name)
+    if " ".join(items) == empty_message:
+        return []
+    return items
+
+
+def parse_page(reply: str, name: str) -> Optional[Page]:
+    """A page reply to name, or None if it was refused"""
+    reply_name, args = parse_command(reply)
+    if reply_name != name or not args or args[0] == "ERR":
+        return None
+    return Page(args[1:], None if args[0] == NO_CURSOR else args[0])
+
+
+def parse_get(reply: str) -> Optional[PeerAddress]:
+    name, args = parse_command(reply)
+    if name != "get" or len(args) < 3 or not args[1].isdigit():
+        return None
+    return PeerAddress(args[0], int(args[1]), args[2])
+
+
+def parse_sources(reply: str) -> List[Source]:
+    name, args = parse_command(reply)
+    if name != "src" or args == ["ERR"]:
+        return []
+    return [Source.parse(entry) for entry in args]
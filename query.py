@@ -0,0 +1,487 @@
+"""
+    File query engine for the tracker: prefix, glob and regex patterns with filters and ranking
+    Usage: from query import FileIndex, parse_query
+    coding: utf-8
+    Author: Danny Li
+"""
+import bisect
+import fnmatch
+import functools
+import multiprocessing
+import re
+import threading
+import time
+from typing import Iterable, List, NamedTuple, Optional
+
+MAX_PATTERN_LENGTH = 128
+REGEX_TIME_BUDGET = 0.05  # Seconds an in-process regex scan may take, checked between names
+REGEX_TIMEOUT = 0.5  # Seconds a RegexWorker scan may take before its process is killed
+MAX_REGEX_NAME = 255  # Characters of a name a regex is matched against
+GRAM = 3  # Substrings at least this long are served from the n-gram index
+BULK_UPDATE = 64  # Batches this large rebuild the sorted name list once instead of shifting it per name
+MAX_PENDING_NAMES = 100_000  # Unsent RegexWorker updates past this are dropped for a fresh copy instead
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+WORD_SEPARATORS = "_-. /"
+
+################################################################################
+#################################### QUERIES ###################################
+################################################################################
+
+class QueryError(ValueError):
+    """Malformed query, or a pattern too expensive to run"""
+
+
+class Query(NamedTuple):
+    """A parsed sch query: one pattern plus optional filters"""
+    kind: str  # "substring", "prefix", "glob" or "regex"
+    pattern: str
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    owner: Optional[str] = None
+    limit: Optional[int] = None
+
+    def matcher(self):
+        """Predicate on a filename for this query's pattern"""
+        if self.kind == "substring":
+            return lambda name: self.pattern in name
+        if self.kind == "prefix":
+            return lambda name: name.startswith(self.pattern)
+        if self.kind == "glob":
+            return compile_pattern(self.kind, self.pattern).match  # Globs match the whole name
+        search = compile_pattern(self.kind, self.pattern).search
+        return lambda name: search(name[:MAX_REGEX_NAME])
+
+    def accepts(self, owners: Iterable[str], size: Optional[int]) -> bool:
+        """Whether a match passes the owner and size filters"""
+        if self.owner is not None and self.owner not in owners:
+            return False
+        if self.min_size is None and self.max_size is None:
+            return True
+        if size is None:
+            return False  # Published without a size: cannot satisfy a size filter
+        return ((self.min_size is None or size >= self.min_size)
+                and (self.max_size is None or size <= self.max_size))
+
+    def rank(self, name: str, owners: int = 1) -> tuple:
+        """Sort key, best first: exact, prefix, word-start, then earlier, better-seeded and shorter names"""
+        if self.kind in ("substring", "prefix"):
+            position = name.find(self.pattern)
+            if name == self.pattern:
+                quality = 0
+            elif position == 0:
+                quality = 1
+            elif name[position - 1] in WORD_SEPARATORS:
+                quality = 2
+            else:
+                quality = 3
+        else:
+            quality, position = 3, 0
+        return quality, -owners, position, len(name), name
+
+
+def parse_size(text: str) -> int:
+    """Parse a byte count with an optional k/m/g suffix"""
+    match = re.fullmatch(r"(\d+)([kmg]?)b?", text.lower())
+    if match is None:
+        raise QueryError(f"bad size {text!r}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_query(pattern: str, filters: List[str] = ()) -> Query:
+    """Build a Query from a pattern and "key:value" filter terms.
+
+    Patterns: "re:<regex>", a glob if it contains * ? or [ ("report*" is a
+    prefix query), otherwise a substring. Filters: size:>N, size:<N, size:N-M,
+    owner:<username>, limit:<N>.
+    """
+    if not pattern or len(pattern) > MAX_PATTERN_LENGTH:
+        raise QueryError(f"pattern must be 1 to {MAX_PATTERN_LENGTH} characters")
+    if pattern.startswith("re:"):
+        kind, pattern = "regex", pattern[3:]
+        compile_pattern(kind, pattern)  # Reject bad or expensive patterns up front
+    elif pattern.endswith("*") and not any(char in pattern[:-1] for char in "*?["):
+        kind, pattern = "prefix", pattern[:-1]
+    elif any(char in pattern for char in "*?["):
+        kind = "glob"
+    else:
+        kind = "substring"
+
+    options = {}
+    for term in filters:
+        key, _, value = term.partition(":")
+        if key == "size":
+            if value.startswith(">"):
+                options["min_size"] = parse_size(value[1:])
+            elif value.startswith("<"):
+                options["max_size"] = parse_size(value[1:])
+            elif "-" in value:
+                low, _, high = value.partition("-")
+                options["min_size"], options["max_size"] = parse_size(low), parse_size(high)
+            else:
+                options["min_size"] = options["max_size"] = parse_size(value)
+        elif key == "owner" and value:
+            options["owner"] = value
+        elif key == "limit" and value.isdigit() and int(value) > 0:
+            options["limit"] = int(value)
+        else:
+            raise QueryError(f"unknown filter {term!r}")
+    return Query(kind, pattern, **options)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(kind: str, pattern: str):
+    """Compile a glob or regex once; repeated queries reuse the compiled form"""
+    if kind == "glob":
+        return re.compile(fnmatch.translate(pattern))
+    if risky_repetition(pattern):
+        raise QueryError("repeated groups may not contain | or quantifiers")
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise QueryError(f"bad regex: {e}")
+
+
+def risky_repetition(pattern: str) -> bool:
+    """Whether a group repeated by * + or {} holds alternation or a quantifier, like (a|a)* or (a+)+.
+
+    Those backtrack exponentially on a miss. Other slow patterns (a*a*a*b is
+    polynomial) are left to the scan's time limit.
+    """
+    flagged = [False]  # Per open group: whether it holds | or a quantifier so far
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "[":  # Character classes hold no groups or quantifiers
+            i = class_end(pattern, i)
+            continue
+        if char == "(":
+            flagged.append(False)
+            i += 2 if pattern[i + 1:i + 2] == "?" else 1  # (?:...) and friends: that ? is no quantifier
+            continue
+        if char == ")":
+            inner = flagged.pop() if len(flagged) > 1 else False
+            if inner and pattern[i + 1:i + 2] in ("*", "+", "{"):
+                return True
+            flagged[-1] = flagged[-1] or inner
+        elif char in "|*+?{":
+            flagged[-1] = True
+        i += 1
+    return False
+
+
+def class_end(pattern: str, i: int) -> int:
+    """Index just past the character class opening at pattern[i]"""
+    i += 2 if pattern[i + 1:i + 2] == "^" else 1
+    i += 1 if pattern[i + 1:i + 2] == "]" else 0
+    while i + 1 < len(pattern) and pattern[i + 1] != "]":
+        i += 2 if pattern[i + 1] == "\\" else 1
+    return i + 2
+
+
+def regex_literal(pattern: str) -> str:
+    """The longest run of characters every match of a regex must contain, or "" if none is certain.
+
+    Conservative: top-level alternation gives up, and groups, classes, anchors
+    and characters a quantifier may leave out all end a run.
+    """
+    if compile_pattern("regex", pattern).flags & re.IGNORECASE:
+        return ""
+    runs, run = [], []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == "\\":
+            escaped = pattern[i + 1:i + 2]
+            literal = escaped if escaped and not escaped.isalnum() else None  # \d, \b, \1... are not literals
+            i += 2
+        elif char == "[":
+            i = class_end(pattern, i)
+        elif char in "*?{":
+            if depth == 0 and run:
+                run.pop()  # The character before may be absent from a match
+            closing = pattern.find("}", i) if char == "{" else -1
+            i = closing + 1 if closing != -1 else i + 1
+        elif char == "|" and depth == 0:
+            return ""
+        else:
+            depth += {"(": 1, ")": -1}.get(char, 0)
+            literal = char if char not in "()|.^$+" else None
+            i += 1
+        if literal is not None and depth == 0:
+            run.append(literal)
+        elif literal is None:
+            runs.append("".join(run))
+            run = []
+    runs.append("".join(run))
+    return max(runs, key=len)
+
+
+def literal_prefix(pattern: str) -> str:
+    """The part of a glob before its first wildcard"""
+    match = re.search(r"[*?\[]", pattern)
+    return pattern[:match.start()] if match else pattern
+
+################################################################################
+##################################### INDEX ####################################
+################################################################################
+
+class FileIndex:
+    """Searchable filenames: a sorted list for prefixes and a trigram index for substrings"""
+
+    def __init__(self):
+        self.names = []  # Sorted, for prefix ranges
+        self.grams = {}  # {"trigram": set(names)}
+        self.mirror = None  # RegexWorker told of every name added or removed, so regexes scan its own copy
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str):
+        position = bisect.bisect_left(self.names, name)
+        if position < len(self.names) and self.names[position] == name:
+            return
+        self.names.insert(position, name)
+        for gram in grams_of(name):
+            self.grams.setdefault(gram, set()).add(name)
+        if self.mirror is not None:
+            self.mirror.update("add", [name])
+
+    def remove(self, name: str):
+        position = bisect.bisect_left(self.names, name)
+        if position == len(self.names) or self.names[position] != name:
+            return
+        del self.names[position]
+        self._drop_grams(name)
+        if self.mirror is not None:
+            self.mirror.update("remove", [name])
+
+    def add_many(self, names: Iterable[str]):
+        """add() each of names, sorting the list once for a large batch rather than inserting one by one"""
+        names = list(names)
+        if len(names) < BULK_UPDATE:
+            for name in names:
+                self.add(name)
+            return
+        fresh = set(names).difference(self.names)
+        self.names.extend(fresh)
+        self.names.sort()  # Two sorted runs: timsort merges them in linear time
+        for name in fresh:
+            for gram in grams_of(name):
+                self.grams.setdefault(gram, set()).add(name)
+        if self.mirror is not None:
+            self.mirror.update("add", list(fresh))
+
+    def remove_many(self, names: Iterable[str]):
+        """remove() each of names, filtering the list once for a large batch"""
+        names = list(names)
+        if len(names) < BULK_UPDATE:
+            for name in names:
+                self.remove(name)
+            return
+        gone = set(names).intersection(self.names)  # Only names that were indexed have postings to drop
+        self.names = [name for name in self.names if name not in gone]
+        for name in gone:
+            self._drop_grams(name)
+        if self.mirror is not None:
+            self.mirror.update("remove", list(gone))
+
+    def _drop_grams(self, name: str):
+        for gram in grams_of(name):
+            postings = self.grams.get(gram)
+            if postings is not None:
+                postings.discard(name)
+                if not postings:
+                    del self.grams[gram]
+
+    def with_prefix(self, prefix: str):
+        """Names starting with prefix, in order"""
+        for position in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[position]
+            if not name.startswith(prefix):
+                return
+            yield name
+
+    def containing(self, substring: str):
+        """Names containing substring, narrowed by the rarest of its trigrams"""
+        if len(substring) < GRAM:
+            return (name for name in self.names if substring in name)
+        postings = []
+        for gram in grams_of(substring):
+            names = self.grams.get(gram)
+            if not names:
+                return iter(())
+            postings.append(names)
+        return (name for name in min(postings, key=len) if substring in name)
+
+    def candidates(self, query: Query):
+        """Names that could match query's pattern, from the narrowest index available"""
+        if query.kind == "prefix":
+            return self.with_prefix(query.pattern)
+        if query.kind == "substring":
+            return self.containing(query.pattern)
+        if query.kind == "glob":
+            return self.with_prefix(literal_prefix(query.pattern))
+        narrowed = self.regex_candidates(query.pattern)
+        return iter(self.names) if narrowed is None else narrowed
+
+    def regex_candidates(self, pattern: str):
+        """Names containing the longest literal every match of a regex needs, or None if it has none to index"""
+        literal = regex_literal(pattern)
+        return self.containing(literal) if len(literal) >= GRAM else None
+
+    def match(self, query: Query, names: Optional[Iterable[str]] = None):
+        """Names matching query's pattern, from names if given (e.g. one owner's files).
+
+        Regex scans stop with QueryError once they exceed REGEX_TIME_BUDGET.
+        """
+        matches = query.matcher()
+        if names is None:
+            names = self.candidates(query)
+            if query.kind in ("substring", "prefix"):
+                return names  # The index already checked the pattern
+        if query.kind != "regex":
+            return (name for name in names if matches(name))
+        return budgeted(names, matches)
+
+
+def grams_of(name: str) -> set:
+    return {name[i:i + GRAM] for i in range(len(name) - GRAM + 1)}
+
+
+def budgeted(names, matches):
+    """Yield regex matches, giving up once the scan exceeds its time budget.
+
+    One match() cannot be interrupted; servers run scans in a RegexWorker for a hard limit.
+    """
+    deadline = time.perf_counter() + REGEX_TIME_BUDGET
+    for name in names:
+        if matches(name):
+            yield name
+        if time.perf_counter() > deadline:
+            raise QueryError("regex query exceeded its time budget")
+
+################################################################################
+################################# REGEX WORKER #################################
+################################################################################
+
+class RegexWorker:
+    """A child process that runs regex scans, killed and replaced when one overruns.
+
+    A catastrophic match() holds the GIL until it returns, so nothing in the
+    calling process can stop it; a separate process can simply be killed.
+    scan() blocks, so an event loop calls it from a thread.
+
+    The worker keeps its own copy of a FileIndex's names (set it as the index's
+    mirror), so a scan sends only the pattern. The copy is seeded with reseed()
+    and kept current by update(); a replaced worker starts empty and needs
+    reseeding before it can scan the whole index again.
+    """
+
+    def __init__(self, timeout: float = REGEX_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()  # One scan at a time over the one pipe
+        self.process = self.connection = None
+        self.pending_lock = threading.Lock()  # update() runs on the event loop while scan() runs in a thread
+        self.pending = []  # [("reset" | "add" | "remove", names)] not yet sent to the worker
+        self.pending_names = 0
+        self.seeded = False  # Whether the worker's copy plus pending matches the index
+
+    @property
+    def needs_seed(self) -> bool:
+        return not self.seeded
+
+    def reseed(self, names: list):
+        """Replace the worker's copy with names, a snapshot of the whole index"""
+        with self.pending_lock:
+            self.pending = [("reset", names)]
+            self.pending_names = 0
+            self.seeded = True
+
+    def update(self, op: str, names: list):
+        """Queue names added to or removed from the index; called by FileIndex"""
+        with self.pending_lock:
+            if not self.seeded:
+                return  # The next reseed() carries them
+            self.pending.append((op, names))
+            self.pending_names += len(names)
+            if self.pending_names > MAX_PENDING_NAMES:  # No regex queries lately: a snapshot is cheaper
+                self.forget()
+
+    def forget(self):
+        """Drop the worker's copy (caller holds pending_lock)"""
+        self.pending = []
+        self.pending_names = 0
+        self.seeded = False
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")  # Forking a process with running threads is unsafe
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve_regex_scans, args=(child,), name="regex-worker", daemon=True)
+        self.process.start()
+        child.close()
+        self.connection.recv()  # Ready: its start-up does not count against the first scan's timeout
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.connection.close()
+            self.process = self.connection = None
+            with self.pending_lock:
+                self.forget()
+
+    def scan(self, pattern: str, names: Optional[list] = None) -> list:
+        """The names pattern (already validated by parse_query) matches, or the worker's copy of the
+        index without names; QueryError if it overruns or the copy needs reseeding
+        """
+        with self.lock:
+            if self.process is not None and not self.process.is_alive():
+                self.stop()
+            if self.process is None:
+                self.start()
+            with self.pending_lock:
+                pending, seeded = self.pending, self.seeded
+                self.pending, self.pending_names = [], 0
+            if names is None and not seeded:
+                raise QueryError("regex index is being rebuilt")
+            try:
+                if pending:
+                    # Applied before the scan is timed: only matching counts against the timeout
+                    self.connection.send(("sync", pending))
+                    self.connection.recv()
+                self.connection.send(("scan", pattern, names))
+                if self.connection.poll(self.timeout):
+                    return self.connection.recv()
+            except (EOFError, OSError):
+                pass
+            self.stop()
+            raise QueryError("regex query exceeded its time limit")
+
+
+def serve_regex_scans(connection):
+    """RegexWorker's process: keep a copy of the index's names and answer scans until the pipe closes"""
+    indexed = set()
+    connection.send(None)
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message[0] == "sync":
+            for op, names in message[1]:
+                if op == "reset":
+                    indexed = set(names)
+                elif op == "add":
+                    indexed.update(names)
+                else:
+                    indexed.difference_update(names)
+            connection.send(None)
+        else:
+            _, pattern, names = message
+            matches = Query("regex", pattern).matcher()
+            connection.send([name for name in (indexed if names is None else names) if matches(name)])
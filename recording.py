@@ -0,0 +1,99 @@
+"""
+    Control-channel traffic recording for the tracker, replayed by benchmarks/replay_traffic.py
+    Usage: from recording import Recorder, load_recording
+    coding: utf-8
+    Author: Danny Li
+"""
+import hashlib
+import json
+import os
+import time
+
+RECORDING_VERSION = 1
+WRITE_BUFFER = 1 << 16  # Lines are buffered in memory; a flush costs one write() per 64 KiB
+NAME_COMMANDS = {"pub", "unp", "get", "src", "have", "wdr"}  # Commands whose first argument is a filename
+PAGED_COMMANDS = {"lap", "lpf"}  # Their non-numeric arguments are hex cursors holding a name
+SECRET_COMMANDS = {"auth", "rsm"}  # Arguments are a password or a resume token, never written
+
+################################################################################
+################################### RECORDER ###################################
+################################################################################
+
+class Recorder:
+    """Writes one JSON line per command: when, which connection and user, what, how big, how long.
+
+    Filenames, search patterns and page cursors are replaced by keyed hashes, so
+    repeats of one name still line up but names cannot be recovered or guessed.
+    The key is random per recording and never written. Usernames become small
+    integers, and credentials and resume tokens are dropped.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "w", buffering=WRITE_BUFFER)
+        self.key = os.urandom(16)
+        self.started = time.time()
+        self.users = {}  # {"username": ordinal}
+        self.file.write(json.dumps({"version": RECORDING_VERSION, "started": round(self.started, 3)}) + "\n")
+
+    def name(self, text: str) -> str:
+        return "f" + hashlib.blake2b(text.encode(), digest_size=8, key=self.key).hexdigest()
+
+    def user(self, username: str) -> int:
+        return self.users.setdefault(username, len(self.users))
+
+    def args(self, command: str, args: list) -> list:
+        """args with everything identifying replaced; replay_traffic rebuilds a command from these"""
+        if command in SECRET_COMMANDS:
+            return []
+        if command in NAME_COMMANDS:
+            return [self.name(args[0])] + args[1:] if args else []
+        if command == "sch":
+            return [self.pattern(args[0])] + [self.filter(term) for term in args[1:]] if args else []
+        if command in PAGED_COMMANDS:
+            return [arg if arg.isdigit() or arg == "-" else self.cursor(arg) for arg in args]
+        return [arg if arg.isdigit() else self.name(arg) for arg in args]
+
+    def pattern(self, pattern: str) -> str:
+        """Hash a sch pattern but keep what makes it a regex, prefix or substring query"""
+        if pattern.startswith("re:"):
+            return "re:" + self.name(pattern[3:])
+        if pattern.endswith("*"):
+            return self.name(pattern[:-1]) + "*"
+        return self.name(pattern)
+
+    def filter(self, term: str) -> str:
+        key, _, value = term.partition(":")
+        if key == "owner":
+            return f"owner:{self.user(value)}"
+        return term if key in ("size", "limit") else self.name(term)
+
+    def cursor(self, cursor: str) -> str:
+        try:
+            return self.name(bytes.fromhex(cursor).decode()).encode().hex()
+        except ValueError:
+            return self.name(cursor)
+
+    def record(self, connection: int, username, command, received: int, sent: int, seconds: float):
+        """Write one parsed command that just took seconds; username is None until the connection has logged in"""
+        self.file.write(json.dumps({
+            "t": round(time.time() - seconds - self.started, 6),  # When the command arrived
+            "conn": connection,
+            "user": None if username is None else self.user(username),
+            "cmd": command.name,
+            "args": self.args(command.name, command.args),
+            "in": received,
+            "out": sent,
+            "ms": round(seconds * 1000, 3),
+        }) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def load_recording(path: str) -> list:
+    """The command records of a recording, in time order"""
+    with open(path) as file:
+        lines = [json.loads(line) for line in file if line.strip()]
+    if not lines or lines[0].get("version") != RECORDING_VERSION:
+        raise ValueError(f"{path} is not a version {RECORDING_VERSION} tracker recording")
+    return sorted(lines[1:], key=lambda record: record["t"])
@@ -1,10 +1,19 @@
 #!/bin/bash
 # Generate self-signed SSL certificates for development
-# Usage: bash scripts/generate_certs.sh
+# Usage: bash scripts/generate_certs.sh [--ecdsa]
+#   --ecdsa  P-256 ECDSA key instead of RSA-2048 (much cheaper full handshakes)
 
 set -e
 
-echo "Generating self-signed SSL certificates..."
+KEY_TYPE="rsa"
+if [ "$1" == "--ecdsa" ]; then
+    KEY_TYPE="ecdsa"
+elif [ -n "$1" ]; then
+    echo "Usage: bash scripts/generate_certs.sh [--ecdsa]"
+    exit 1
+fi
+
+echo "Generating self-signed SSL certificates ($KEY_TYPE)..."
 
 # Check if openssl is installed
 if ! command -v openssl &> /dev/null; then
@@ -12,8 +21,14 @@ if ! command -v openssl &> /dev/null; then
     exit 1
 fi
 
+if [ "$KEY_TYPE" == "ecdsa" ]; then
+    KEY_ARGS="-newkey ec -pkeyopt ec_paramgen_curve:prime256v1"
+else
+    KEY_ARGS="-newkey rsa:2048"
+fi
+
 # Generate private key and certificate
-openssl req -x509 -newkey rsa:2048 \
+openssl req -x509 $KEY_ARGS \
     -nodes \
     -keyout server.key \
     -out server.crt \
@@ -26,4 +41,3 @@ echo "  - server.key (private key)"
 echo "  - server.crt (certificate)"
 echo ""
 echo "IMPORTANT: Add these files to .gitignore to avoid committing them."
-EOFchmod +x "/Users/danny/Documents/code projects/simple_file_sharing_server/scripts/generate_certs.sh"
\ No newline at end of file
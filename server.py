@@ -1,19 +1,21 @@
 """
     Multi-threaded server to share files built on python3
-    Usage: python3 server.py <PORT>
+    Usage: python3 server.py <PORT> [--workers N]
     coding: utf-8
     Author: Danny Li
 """
 from socket import *
 from threading import Thread, Lock
-import sys, select, time, datetime
+from concurrent.futures import ThreadPoolExecutor
+import sys, select, selectors, queue, time, datetime
+from protocol import INPUT_ERR, Decoder, list_reply, parse_command
 
 ################################################################################
 ################################ STARTING SERVER ###############################
 ################################################################################
 
-if len(sys.argv) != 2:
-    print("\n===== Error usage, python3 server.py SERVER_PORT ======\n")
+if len(sys.argv) not in (2, 4) or (len(sys.argv) == 4 and (sys.argv[2] != "--workers" or not sys.argv[3].isdigit() or int(sys.argv[3]) < 1)):
+    print("\n===== Error usage, python3 server.py SERVER_PORT [--workers N] ======\n")
     exit(0)
 
 ################################################################################
@@ -41,6 +43,51 @@ def check_heartbeat():
         finally:
             lock.release()
 
+def serve_with_workers(server_socket, workers):
+    """
+        Readiness loop for --workers: one thread waits on every client socket and
+        hands each readable client to a bounded pool, which runs one command for it
+    """
+    selector = selectors.DefaultSelector()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+    handled = queue.SimpleQueue()  # Clients whose command is done, to be watched again
+    wake_reader, wake_writer = socketpair()
+    wake_reader.setblocking(False)
+    wake_writer.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    selector.register(wake_reader, selectors.EVENT_READ)
+
+    def handle(client):
+        client.serve_one()
+        if client.client_alive:
+            handled.put(client)
+            try:
+                wake_writer.send(b"\0")
+            except BlockingIOError:
+                pass  # The selector already has a wakeup pending
+
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is server_socket:
+                client_socket, client_address = server_socket.accept()
+                client = ClientHandler(client_socket, client_address)
+                selector.register(client_socket, selectors.EVENT_READ, client)
+            elif key.fileobj is wake_reader:
+                try:
+                    while wake_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                # Stop watching while its command runs, so each client has one command in flight,
+                # in order, as it would on its own thread
+                selector.unregister(key.fileobj)
+                pool.submit(handle, key.data)
+        while not handled.empty():
+            client = handled.get()
+            if client.client_alive:
+                selector.register(client.client_socket, selectors.EVENT_READ, client)
+
 ################################################################################
 ############################### SERVER VARIABLES ###############################
 ################################################################################
@@ -53,54 +100,38 @@ lock = Lock()
 ################################# CLIENT THREAD ################################
 ################################################################################
 
-class ClientThread(Thread):
+class ClientHandler:
     """
-        Running the client thread - init and check which methods to run
+        One client's connection state and command handlers - serve_one reads and runs its commands
     """
     
     def __init__(self, client_socket, client_address):
-        Thread.__init__(self)
         self.client_socket = client_socket
         self.client_address = client_address
         self.client_alive = True
         self.client_username = None
         self.client_upload_port_number = None
+        self.decoder = Decoder()
     
-    def run(self):
-        ERR_MSG = "INPUT_ERR"
-        message = ''    
-        while self.client_alive:
-            try:
-                message = self.client_socket.recv(1024).decode()
-                if message == '':
-                    self.disconnect_client()
-                elif message.startswith("auth"):
-                    self.process_auth(message)
-                elif message.startswith("port"):
-                    self.auth_process_uploading_port(message)
-                elif message.startswith("hbt"):
-                    self.process_heartbeat()
-                elif message.startswith("get"):
-                    self.process_get(message)
-                elif message.startswith("lap"):
-                    self.process_lap()
-                elif message.startswith("lpf"):
-                    self.process_lpf()
-                elif message.startswith("pub"):
-                    self.process_pub(message)
-                elif message.startswith("sch"):
-                    self.process_sch(message)
-                elif message.startswith("unp"):
-                    self.process_unp(message)
-                elif message.startswith("xit"):
-                    self.process_xit()
-                else:
-                    self.print_server_message(f"Sent ERR to {self.client_username}")
-                    self.send_client_message(ERR_MSG)
-            except Exception as e:
-                self.print_server_message(f"Error with {self.client_username}: {str(e)}")
+    def serve_one(self):
+        try:
+            data = self.client_socket.recv(1024)
+            if not data:
                 self.disconnect_client()
-                break
+                return
+            for message in self.decoder.feed(data):
+                command = parse_command(message)
+                handler = self.handlers.get(command.name)
+                if handler is None:
+                    self.print_server_message(f"Sent ERR to {self.client_username}")
+                    self.send_client_message(INPUT_ERR)
+                else:
+                    handler(self, command.args)
+                if not self.client_alive:
+                    break
+        except Exception as e:
+            self.print_server_message(f"Error with {self.client_username}: {str(e)}")
+            self.disconnect_client()
                     
     """
         Helper functions and background functions
@@ -111,7 +142,9 @@ class ClientThread(Thread):
         - auth_process_uploading_port
     """ 
     def send_client_message(self, message):
-        self.client_socket.send(message.encode())
+        if self.decoder.line_framed and not message.endswith("\n"):
+            message += "\n"  # Framed clients read replies by line, however long they are
+        self.client_socket.sendall(message.encode())
     
     def print_server_message(self, message):
         current_timestamp = datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3]
@@ -128,7 +161,7 @@ class ClientThread(Thread):
                 lock.release()
         self.client_socket.close()
 
-    def process_heartbeat(self):
+    def process_heartbeat(self, args):
         if self.client_username in active_clients:
             lock.acquire()
             try:
@@ -137,14 +170,12 @@ class ClientThread(Thread):
             finally:
                 lock.release()
 
-    def auth_process_uploading_port(self, message):
-        try:
-            _, upload_port = message.split()
-        except ValueError:
+    def auth_process_uploading_port(self, args):
+        if len(args) != 1:
             self.send_client_message("port ERR")
             return
         
-        self.client_upload_port_number = int(upload_port)
+        self.client_upload_port_number = int(args[0])
         lock.acquire()
         try:
             if self.client_username in active_clients:
@@ -164,14 +195,13 @@ class ClientThread(Thread):
         - process_unp
         - process_xit
     """
-    def process_auth(self, message):
+    def process_auth(self, args):
         auth_ok = "auth OK"
         auth_fail = "auth ERR"
-        try:
-            _, username, password = message.split()
-        except ValueError:
+        if len(args) != 2:
             self.send_client_message(auth_fail)
             return
+        username, password = args
         
         self.client_username = username
         self.print_server_message(f"Received AUTH from {self.client_username}")
@@ -199,140 +229,129 @@ class ClientThread(Thread):
         }
         return
         
-    def process_get(self, message):
+    def process_get(self, args):
         self.print_server_message(f"Received GET from {self.client_username}")
-        try:
-            _, filename = message.split()
-        except ValueError:
+        if len(args) != 1:
             self.send_client_message("get ERR")
             return
+        filename = args[0]
     
-        if filename:
-            lock.acquire()
-            try:
-                peers_with_file = [username for username in published_files[filename] if username != self.client_username]
-                if peers_with_file:
-                    peer_username = peers_with_file[0]
-                    peer_address = active_clients[peer_username]["address"]
-                    peer_upload_port = active_clients[peer_username]["upload_port"]
-                    self.send_client_message(f"get {peer_address[0]} {peer_upload_port} {filename}")
-                    self.print_server_message(f"Sent OK to {self.client_username}")
-                else:
-                    self.send_client_message("get ERR")
-                    self.print_server_message(f"Sent ERR to {self.client_username}")
-            finally:
-                lock.release()
-        else:
-            self.send_client_message("get ERR")
-            self.print_server_message(f"Sent ERR to {self.client_username}")
+        lock.acquire()
+        try:
+            peers_with_file = [username for username in published_files[filename] if username != self.client_username]
+            if peers_with_file:
+                peer_username = peers_with_file[0]
+                peer_address = active_clients[peer_username]["address"]
+                peer_upload_port = active_clients[peer_username]["upload_port"]
+                self.send_client_message(f"get {peer_address[0]} {peer_upload_port} {filename}")
+                self.print_server_message(f"Sent OK to {self.client_username}")
+            else:
+                self.send_client_message("get ERR")
+                self.print_server_message(f"Sent ERR to {self.client_username}")
+        finally:
+            lock.release()
                 
-    def process_lap(self):
+    def process_lap(self, args):
         lock.acquire()
         self.print_server_message(f"Received LAP from {self.client_username}")
         try:
             active_peers = [username for username in active_clients.keys() if username != self.client_username]
-            if active_peers:
-                self.send_client_message(f"lap {' '.join(active_peers)}")
-            else:
-                self.send_client_message("lap No active peers")
+            self.send_client_message(list_reply("lap", active_peers))
         finally:
             lock.release()
     
-    def process_lpf(self):
+    def process_lpf(self, args):
         lock.acquire()
         self.print_server_message(f"Received LPF from {self.client_username}")
         try:
             published_by_user = [file for file, users in published_files.items() if self.client_username in users]
-            if published_by_user:
-                self.send_client_message(f"lpf {' '.join(published_by_user)}")
-            else:
-                self.send_client_message("lpf No files published")
+            self.send_client_message(list_reply("lpf", published_by_user))
         finally:
             lock.release()
     
-    def process_pub(self, message):
+    def process_pub(self, args):
         pub_success = "pub OK"
         pub_failure = "pub ERR"
-        try:
-            _, filename = message.split()
-        except ValueError:
+        if len(args) != 1:
             self.send_client_message(pub_failure)
             return
+        filename = args[0]
         self.print_server_message(f"Received PUB from {self.client_username}")
-        if filename:
-            lock.acquire()
-            try:
-                if filename not in published_files:
-                    published_files[filename] = set()  # Set will prevent duplicate values for key
+        lock.acquire()
+        try:
+            if filename not in published_files:
+                published_files[filename] = set()  # Set will prevent duplicate values for key
 
-                published_files[filename].add(self.client_username)
-                self.print_server_message(f"Sent OK to {self.client_username}")
-                self.send_client_message(pub_success)
-            finally:
-                lock.release()
-        else:
-            self.send_client_message(pub_failure)
-            self.print_server_message(f"Sent ERR to {self.client_username}")
+            published_files[filename].add(self.client_username)
+            self.print_server_message(f"Sent OK to {self.client_username}")
+            self.send_client_message(pub_success)
+        finally:
+            lock.release()
             
-    def process_sch(self, message):
-        try:
-            _, substring = message.split()
-        except ValueError:
-            self.send_client_message("sch No files found")
+    def process_sch(self, args):
+        if len(args) != 1:
+            self.send_client_message(list_reply("sch", []))
             return
+        substring = args[0]
 
-        search_results = []
         lock.acquire()
         self.print_server_message(f"Received SCH from {self.client_username}")
         try:
-            if not substring:
-                self.send_client_message("sch No files found")
-                return
-            
-            for file, users in published_files.items():
-                if substring in file and self.client_username not in users:
-                    search_results.append(file)
-                    
-            if search_results:
-                self.send_client_message(f"sch {' '.join(search_results)}")
-            else:
-                self.send_client_message("sch No files found")
+            search_results = [file for file, users in published_files.items()
+                              if substring in file and self.client_username not in users]
+            self.send_client_message(list_reply("sch", search_results))
         finally:
             lock.release()
     
-    def process_unp(self, message):
+    def process_unp(self, args):
         unp_success = "unp OK"
         unp_failure = "unp ERR"
-        try:
-            _, filename = message.split()
-        except ValueError:
+        if len(args) != 1:
             self.send_client_message(unp_failure)
             return 
+        filename = args[0]
 
         self.print_server_message(f"Received UNP from {self.client_username}")
-        if filename:
-            lock.acquire()
-            try:
-                if filename in published_files and self.client_username in published_files[filename]:
-                    published_files[filename].remove(self.client_username)
-                    # If no users have the file published, remove the file from the published_files map
-                    if not published_files[filename]:
-                        del published_files[filename]
-                    self.send_client_message(unp_success)
-                    self.print_server_message(f"Sent OK to {self.client_username}")
-                else:
-                    self.send_client_message(unp_failure)
-                    self.print_server_message(f"Sent ERR to {self.client_username}")
-            finally:
-                lock.release()
-        else:
-            self.send_client_message(unp_failure)
-            self.print_server_message(f"Sent ERR to {self.client_username}")
+        lock.acquire()
+        try:
+            if filename in published_files and self.client_username in published_files[filename]:
+                published_files[filename].remove(self.client_username)
+                # If no users have the file published, remove the file from the published_files map
+                if not published_files[filename]:
+                    del published_files[filename]
+                self.send_client_message(unp_success)
+                self.print_server_message(f"Sent OK to {self.client_username}")
+            else:
+                self.send_client_message(unp_failure)
+                self.print_server_message(f"Sent ERR to {self.client_username}")
+        finally:
+            lock.release()
     
-    def process_xit(self):
+    def process_xit(self, args):
         self.send_client_message("xit")
         self.disconnect_client()
     
+    # Commands by name, looked up once each - the legacy server knows fewer than server_async.py
+    handlers = {
+        "auth": process_auth, "port": auth_process_uploading_port, "hbt": process_heartbeat,
+        "get": process_get, "lap": process_lap, "lpf": process_lpf, "pub": process_pub,
+        "sch": process_sch, "unp": process_unp, "xit": process_xit,
+    }
+
+
+class ClientThread(ClientHandler, Thread):
+    """
+        Running the client thread - one per connection, blocked in recv between commands
+    """
+    
+    def __init__(self, client_socket, client_address):
+        ClientHandler.__init__(self, client_socket, client_address)
+        Thread.__init__(self)
+    
+    def run(self):
+        while self.client_alive:
+            self.serve_one()
+    
 ################################################################################
 ################################## RUN SERVER ##################################
 ################################################################################
@@ -349,6 +368,11 @@ heartbeat_checking_thread = Thread(target=check_heartbeat)
 heartbeat_checking_thread.daemon = True
 heartbeat_checking_thread.start()
 
+if len(sys.argv) == 4:
+    # Bounded pool: a few threads serve every client instead of one thread each
+    server_socket.listen()
+    serve_with_workers(server_socket, int(sys.argv[3]))
+
 # Start listening to server socket and make new threads for clients
 while True:
     server_socket.listen()
@@ -1,27 +1,77 @@
 """
     Asyncio-based server for P2P file sharing
-    Usage: python3 server_async.py <PORT> [--ssl]
+    Usage: python3 server_async.py <PORT> [--ssl] [--udp-heartbeat] [--max-connections N] [--backlog N]
+                                   [--write-buffer-limit BYTES] [--rate-limit-scale F] [--loop asyncio|uvloop|auto]
+                                   [--metrics-port PORT] [--trace-sample N] [--admin-port PORT]
     coding: utf-8
     Author: Danny Li (refactored to asyncio)
 """
+import argparse
 import asyncio
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import secrets
+import signal
 import sys
 import time
 import datetime
 import sqlite3
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import event_loops
+import metrics
+import recording
+import tracing
+from protocol import INPUT_ERR, NO_CURSOR, Decoder, busy_reply, list_reply, page_reply, parse_command
+from query import FileIndex, QueryError, RegexWorker, parse_query
+
 ################################################################################
 ################################ STARTING SERVER ###############################
 ################################################################################
 
-if len(sys.argv) < 2:
-    print("\n===== Error usage, python3 server_async.py SERVER_PORT [--ssl]\n")
-    exit(0)
-
-USE_SSL = "--ssl" in sys.argv
-SERVER_PORT = int([arg for arg in sys.argv[1:] if arg != "--ssl"][0])
+DB_PATH = 'server.db'
+PUBLICATION_FLUSH_INTERVAL = 0.5  # Seconds between publication batch commits
+PUBLICATION_MAX_BATCH = 1000  # Pending changes that trigger an early commit
+TLS_SESSION_TICKETS = 2  # Tickets per full handshake, so a client can resume more than once
+HEARTBEAT_INTERVAL = 2  # Seconds between heartbeats for legacy clients and at low load
+MAX_HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TARGET_RATE = 200  # Heartbeats per second the server aims for across all clients
+HEARTBEAT_TIMEOUT_FACTOR = 1.5  # A client is dropped after this many of its intervals without traffic
+HEARTBEAT_CHECK_INTERVAL = 3
+STALL_MEMORY = MAX_HEARTBEAT_INTERVAL * HEARTBEAT_TIMEOUT_FACTOR  # Older stalls cannot excuse any client's silence
+UNAUTHENTICATED_TIMEOUT = 10.0  # Idle seconds before an unauthenticated connection is closed
+MAX_CONNECTIONS = 10000  # Connections beyond this are closed on accept
+LISTEN_BACKLOG = 1024  # Pending accepts the kernel queues while the loop is busy
+WRITE_BUFFER_LIMIT = 1024 * 1024  # Unsent bytes past which replies wait for the client to read
+WRITE_STALL_TIMEOUT = 5.0  # Seconds a client may leave that backlog unread before it is evicted
+RATE_LIMITS = {  # {"command class": (tokens per second, burst)}, per user
+    "query": (50, 200),
+    "mutate": (500, 2000),  # Reconnecting clients replay all their publications at once
+    "auth": (1, 5),  # Per attempted username, to slow password guessing
+    "unknown": (20, 50),  # Commands answered INPUT_ERR; kept apart so they cannot spend the query budget
+}
+COMMAND_CLASSES = {
+    "sch": "query", "lap": "query", "lpf": "query", "get": "query", "src": "query",
+    "pub": "mutate", "unp": "mutate", "have": "mutate", "wdr": "mutate", "port": "mutate",
+    "auth": "auth",
+}
+UNLIMITED_COMMANDS = {"hbt", "hbi", "tok", "rsm", "xit"}  # Cheap, or needed to keep a session alive
+RATE_BUCKET_IDLE = 60  # Seconds after which a full, unused bucket is forgotten
+SHED_REPORT_INTERVAL = 10
+ADMIN_TOKEN_FILE = "admin.token"  # Generated on first use with --admin-port, readable only by its owner
+ADMIN_IDLE_TIMEOUT = 300.0
+ADMIN_SAMPLE_INTERVAL = 10  # Seconds per command-rate window, and between hot-file decays
+HOT_FILE_DECAY = 0.9  # Request counts are multiplied by this each interval (half-life about a minute)
+MAX_ADMIN_ROWS = 1000
+MAX_HOT_FILES = 10000  # Names whose request counts are kept; the coldest half is dropped when full
+METRIC_COMMANDS = ("auth", "port", "hbt", "hbi", "get", "lap", "lpf", "pub", "sch", "unp", "xit",
+                   "have", "wdr", "src", "tok", "rsm", "other")  # Label values for per-command latency
 
 ################################################################################
 ############################### SERVER FUNCTIONS ###############################
@@ -29,9 +79,15 @@ SERVER_PORT = int([arg for arg in sys.argv[1:] if arg != "--ssl"][0])
 
 async def init_db():
     """Initialize the SQLite database with users table"""
-    conn = sqlite3.connect('server.db', check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     c = conn.cursor()
+    c.execute('PRAGMA journal_mode=WAL')  # Publication batches must not block auth lookups
     c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS publications (
+                     filename TEXT NOT NULL,
+                     username TEXT NOT NULL,
+                     PRIMARY KEY (filename, username)
+                 ) WITHOUT ROWID''')
     c.execute('SELECT COUNT(*) FROM users')
     if c.fetchone()[0] == 0:
         try:
@@ -48,7 +104,7 @@ async def init_db():
 
 def check_auth_db(username: str, password: str) -> bool:
     """Check if username and password match"""
-    conn = sqlite3.connect('server.db')
+    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     c.execute('SELECT password FROM users WHERE username = ?', (username,))
     row = c.fetchone()
@@ -57,41 +113,515 @@ def check_auth_db(username: str, password: str) -> bool:
 
 def user_exists_db(username: str) -> bool:
     """Check if username exists in database"""
-    conn = sqlite3.connect('server.db')
+    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     c.execute('SELECT 1 FROM users WHERE username = ?', (username,))
     row = c.fetchone()
     conn.close()
     return bool(row)
 
+class TokenBucket:
+    """Allows rate requests per second on average, and bursts of up to burst"""
+    
+    __slots__ = ("rate", "burst", "tokens", "updated")
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def take(self) -> float:
+        """Spend a token: 0 if one was available, otherwise the seconds until one will be"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def idle(self, now: float) -> bool:
+        return now - self.updated > RATE_BUCKET_IDLE and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class PublicationStore:
+    """Durable publication registry in server.db.
+
+    Changes are coalesced per (filename, username), so a pub/unp burst costs at
+    most one row write, and committed in batches on a dedicated database thread.
+    """
+    
+    def __init__(self, path: str = DB_PATH, flush_interval: float = PUBLICATION_FLUSH_INTERVAL,
+                 max_batch: int = PUBLICATION_MAX_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.pending = {}  # {(filename, username): True to store, False to delete}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.conn = None
+        self.wakeup = None
+    
+    async def run_db(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+    
+    async def open(self) -> dict:
+        """Connect on the database thread and return {"username": set(filenames)}"""
+        self.wakeup = asyncio.Event()
+        return await self.run_db(self._open)
+    
+    def _open(self) -> dict:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=NORMAL')  # WAL makes this crash-safe
+        publications = {}
+        for filename, username in self.conn.execute('SELECT filename, username FROM publications'):
+            publications.setdefault(username, set()).add(filename)
+        return publications
+    
+    def add(self, filename: str, username: str):
+        self._queue((filename, username), True)
+    
+    def remove(self, filename: str, username: str):
+        self._queue((filename, username), False)
+    
+    def _queue(self, key: tuple, present: bool):
+        self.pending[key] = present
+        if len(self.pending) >= self.max_batch:
+            self.wakeup.set()
+    
+    async def run(self):
+        """Flush pending changes every flush_interval, or sooner when a batch fills up"""
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Could not save publications, retrying in {self.flush_interval:g}s: {e}")
+    
+    async def flush(self):
+        """Commit pending changes; a batch that fails to commit is queued again"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await self.run_db(self._write, batch)
+        except BaseException:
+            batch.update(self.pending)  # Changes queued since the batch left are newer
+            self.pending = batch
+            raise
+    
+    def _write(self, batch: dict):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO publications VALUES (?, ?)',
+                [key for key, present in batch.items() if present]
+            )
+            self.conn.executemany(
+                'DELETE FROM publications WHERE filename = ? AND username = ?',
+                [key for key, present in batch.items() if not present]
+            )
+    
+    async def close(self):
+        """Write anything still pending and release the connection"""
+        await self.flush()
+        if self.conn is not None:
+            await self.run_db(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+class PeerRecord:
+    """An authenticated client in active_clients; slotted, as there is one per connected peer"""
+    __slots__ = ("writer", "host", "heartbeat", "interval", "upload_port")
+    
+    def __init__(self, writer, address: tuple, upload_port: int = None):
+        self.writer = writer
+        self.host = sys.intern(address[0])  # Peers behind one address share the string
+        self.heartbeat = time.time()
+        self.interval = HEARTBEAT_INTERVAL
+        self.upload_port = upload_port
+
+class Session:
+    """A resumable login; expires is None while its user is connected"""
+    __slots__ = ("username", "upload_port", "expires", "udp_key")
+    
+    def __init__(self, username: str, udp_key: str):
+        self.username = username
+        self.upload_port = None
+        self.expires = None
+        self.udp_key = udp_key
+
+class PeerIds:
+    """Dense integer IDs for usernames, so file owner sets hold small ints rather than strings"""
+    
+    def __init__(self):
+        self.ids = {}  # {"username": id}
+        self.names = []  # [username] indexed by id
+    
+    def id_of(self, username: str) -> int:
+        peer_id = self.ids.get(username)
+        if peer_id is None:
+            username = sys.intern(username)
+            peer_id = self.ids[username] = len(self.names)
+            self.names.append(username)
+        return peer_id
+
+# A file's owners are a single peer ID, by far the common case, or a set of IDs once shared
+
+def add_owner(owners, peer_id: int):
+    if owners is None or owners == peer_id:
+        return peer_id
+    if isinstance(owners, int):
+        return {owners, peer_id}
+    owners.add(peer_id)
+    return owners
+
+def remove_owner(owners, peer_id: int):
+    """owners without peer_id, collapsing a last remaining owner back to an int; None once empty"""
+    if isinstance(owners, int):
+        return None if owners == peer_id else owners
+    owners.discard(peer_id)
+    if len(owners) == 1:
+        return next(iter(owners))
+    return owners or None
+
+def owner_ids(owners):
+    if owners is None:
+        return ()
+    return (owners,) if isinstance(owners, int) else owners
+
+class PublicationIndex:
+    """Publications split by whether their owner is connected.
+
+    sch/get/src only consult live owners. Disconnecting moves all of a user's
+    files to dormant in one pass over that user's own files, and reconnecting
+    moves them back. Filenames with a live owner are kept in a FileIndex for sch.
+    Usernames and filenames are interned so every table shares one copy of each.
+    """
+    
+    def __init__(self):
+        self.live = {}  # {"filename": owners} owners currently connected, as peer IDs (see add_owner)
+        self.dormant = {}  # {"filename": owners} owners currently away
+        self.by_user = {}  # {"username": set(filenames)} every publication, live or dormant
+        self.live_users = set()
+        self.peer_ids = PeerIds()
+        self.names = FileIndex()  # Keys of live, for prefix/substring/glob queries
+        self.sizes = {}  # {"filename": bytes} as last reported by a publisher, not persisted
+    
+    def load(self, publications: dict):
+        """Add persisted publications ({"username": set(filenames)}) as dormant"""
+        for username, filenames in publications.items():
+            username = sys.intern(username)
+            filenames = [sys.intern(filename) for filename in filenames]
+            self.by_user.setdefault(username, set()).update(filenames)
+            if username in self.live_users:
+                self._move(username, self.dormant, self.live, filenames)
+            else:
+                self._move(username, None, self.dormant, filenames)
+    
+    def publish(self, filename: str, username: str, size: int = None):
+        if not isinstance(username, str) or not username:
+            raise ValueError("a publication needs a signed-in owner")  # Checked before any table changes
+        filename = sys.intern(filename)
+        self.by_user.setdefault(username, set()).add(filename)
+        if size is not None:
+            self.sizes[filename] = size
+        self._move(username, None, self.live if username in self.live_users else self.dormant, [filename])
+    
+    def unpublish(self, filename: str, username: str) -> bool:
+        """Remove a publication, returning whether it existed"""
+        filenames = self.by_user.get(username)
+        if not filenames or filename not in filenames:
+            return False
+        filenames.discard(filename)
+        if not filenames:
+            del self.by_user[username]
+        self._move(username, self.live if username in self.live_users else self.dormant, None, [filename])
+        return True
+    
+    def activate(self, username: str):
+        """Owner connected: serve their files again"""
+        if username not in self.live_users:
+            self.live_users.add(username)
+            self._move(username, self.dormant, self.live, self.by_user.get(username, ()))
+    
+    def deactivate(self, username: str):
+        """Owner gone: hide their files from sch/get until they return"""
+        if username in self.live_users:
+            self.live_users.discard(username)
+            self._move(username, self.live, self.dormant, self.by_user.get(username, ()))
+    
+    def files_of(self, username: str) -> set:
+        return self.by_user.get(username, set())
+    
+    def usernames(self, owners) -> set:
+        return {self.peer_ids.names[peer_id] for peer_id in owner_ids(owners)}
+    
+    def live_owners(self, filename: str) -> set:
+        return self.usernames(self.live.get(filename))
+    
+    def owner_count(self, filename: str) -> int:
+        owners = self.live.get(filename)
+        return 0 if owners is None else 1 if isinstance(owners, int) else len(owners)
+    
+    def owns(self, filename: str, username: str) -> bool:
+        """Whether username is a live owner of filename"""
+        peer_id = self.peer_ids.ids.get(username)
+        return peer_id is not None and peer_id in owner_ids(self.live.get(filename))
+    
+    def _move(self, username: str, source, target, filenames):
+        peer_id = self.peer_ids.id_of(username)
+        unlisted, listed = [], []  # Names leaving and joining live, applied to the FileIndex in one batch each
+        for filename in filenames:
+            if source is not None:
+                owners = source.get(filename)
+                if owners is not None:
+                    owners = remove_owner(owners, peer_id)
+                    if owners is None:
+                        del source[filename]
+                        if source is self.live:
+                            unlisted.append(filename)
+                    else:
+                        source[filename] = owners
+            if target is not None:
+                owners = target.get(filename)
+                if owners is None and target is self.live:
+                    listed.append(filename)
+                target[filename] = add_owner(owners, peer_id)
+            if filename not in self.live and filename not in self.dormant:
+                self.sizes.pop(filename, None)
+        self.names.remove_many(unlisted)
+        self.names.add_many(listed)
+
 ################################################################################
 ############################### SERVER STATE ##################################
 ################################################################################
 
-active_clients = {}  # {"username": {"reader": reader, "writer": writer, "heartbeat": float, "upload_port": int, "address": tuple}}
-published_files = {}  # {"filename": set(usernames)}
+active_clients = {}  # {"username": PeerRecord}
+publications = PublicationIndex()
+publication_store = None  # Will be initialized in main
+piece_maps = {}  # {"filename": {"username": (file_size, piece_size, bitmap_hex)}} for partial seeders
+partial_by_user = {}  # {"username": set(filenames)} so a user's piece maps can be dropped together
+sessions = {}  # {"token": Session}
+session_tokens = {}  # {"username": "token"}
+udp_keys = {}  # {"udp_key": "token"} for heartbeat datagrams, which must not carry the resume token
+udp_heartbeat_port = None  # Set in main when UDP heartbeats are enabled
+rate_buckets = {}  # {("username" or "ip:<address>" or "auth:<username>", "command class"): TokenBucket}
+rate_limit_scale = 1.0  # Multiplies RATE_LIMITS; 0 disables rate limiting
+max_connections = MAX_CONNECTIONS
+write_buffer_limit = WRITE_BUFFER_LIMIT
+open_connections = 0
+client_handlers = set()  # Every open ClientHandler, for the admin channel
+file_hits = collections.Counter()  # {"filename": decayed get/src count} for the admin channel's hot files
+command_rates = {}  # {"command": per second over the last ADMIN_SAMPLE_INTERVAL}
+shed = collections.Counter()  # {"connections_rejected" | "rate_limited_<class>" | "slow_consumers_evicted": count}
+RESUME_GRACE = 30  # Seconds a disconnected session can still be resumed with rsm
+MAX_SOURCES = 32  # Sources returned per src request, sampled so downloaders spread across the swarm
+MAX_PAGE_ITEMS = 1000  # Largest page a paginated lap/lpf/sch may ask for
+MAX_PAGE_BYTES = 16 * 1024  # Pages are cut short beyond this so one fits in any client's read buffer
 state_lock = None  # Will be initialized in main
 
+# Metrics are always collected (each update bumps a preallocated slot) and served with --metrics-port
+registry = metrics.Registry()
+command_seconds = registry.histogram("tracker_command_duration_seconds", "Time to handle one command",
+                                     "command", METRIC_COMMANDS)
+heartbeat_expiries = registry.counter("tracker_heartbeat_expiries_total", "Clients dropped for missing heartbeats")
+lock_wait = registry.histogram("tracker_state_lock_wait_seconds", "Time spent waiting to acquire state_lock")
+loop_lag = registry.histogram("tracker_event_loop_lag_seconds", "How late the event loop ran a due timer")
+loop_stalls = registry.histogram("tracker_event_loop_stall_seconds", "Loop stalls by the command that blocked it",
+                                 "command", METRIC_COMMANDS, bounds=metrics.STALL_BUCKETS)
+registry.gauge("tracker_open_connections", "Open client connections", lambda: open_connections)
+registry.gauge("tracker_active_clients", "Authenticated clients", lambda: len(active_clients))
+registry.gauge("tracker_published_files", "Distinct filenames with a connected publisher", lambda: len(publications.names))
+registry.collected_counter("tracker_shed_total", "Work refused by admission control", lambda: shed, "reason")
+tracer = tracing.Tracer()  # Sampled per-command phase timings, dumped from /debug/traces
+stall_watchdog = None  # metrics.StallWatchdog, set in main unless --stall-threshold is 0
+recorder = None  # recording.Recorder with --record
+regex_worker = None  # query.RegexWorker, set in main; sch regexes run in it with a hard time limit
+connection_ids = itertools.count()  # Numbers connections in recordings
+
+def heartbeat_overdue(info: PeerRecord, now: float) -> bool:
+    """Whether a client has been silent past the interval it was last told to use.
+
+    Time the loop spent stalled does not count: the client's heartbeats were
+    sitting unread in its socket.
+    """
+    limit = info.interval * HEARTBEAT_TIMEOUT_FACTOR
+    if now - info.heartbeat <= limit:
+        return False
+    stalled = stall_watchdog.stalled_seconds(info.heartbeat) if stall_watchdog else 0.0
+    return now - info.heartbeat - stalled > limit
+
 async def check_heartbeat():
     """Periodically remove inactive clients"""
     global state_lock
     while True:
-        await asyncio.sleep(3)
+        await asyncio.sleep(HEARTBEAT_CHECK_INTERVAL)
         current_time = time.time()
         async with state_lock:
             inactive_clients = [
-                username for username, info in active_clients.items()
-                if current_time - info["heartbeat"] > 3
+                username for username, info in active_clients.items() if heartbeat_overdue(info, current_time)
             ]
+            heartbeat_expiries.inc(len(inactive_clients))
             for username in inactive_clients:
                 print(f"[server] {username} timed out. Removing from active clients.")
                 if username in active_clients:
-                    try:
-                        active_clients[username]["writer"].close()
-                        await active_clients[username]["writer"].wait_closed()
-                    except:
-                        pass
+                    # Abort rather than wait for a close: a silent client may never read what is queued
+                    active_clients[username].writer.transport.abort()
                     del active_clients[username]
+                    publications.deactivate(username)
+                    drop_piece_map(username)
+                    suspend_session(username)
+            
+            expired = [
+                token for token, session in sessions.items()
+                if session.expires is not None and session.expires < current_time
+            ]
+            for token in expired:
+                revoke_session(sessions[token].username)
+        
+        prune_rate_buckets()
+
+def stalled_command(frame) -> str:
+    """The command whose handler is on the stalled loop thread's stack, for the stall watchdog"""
+    while frame is not None:
+        if frame.f_code is ClientHandler.dispatch.__code__:
+            command = frame.f_locals.get("command")
+            return command.name if command is not None else "other"
+        frame = frame.f_back
+    return "other"
+
+def peer_endpoint(username: str, requester: str):
+    """'host,port' for a live peer other than the requester, or None (caller holds state_lock)"""
+    if username == requester or username not in active_clients:
+        return None
+    info = active_clients[username]
+    if not info.upload_port:
+        return None
+    return f"{info.host},{info.upload_port}"
+
+def issue_session(username: str) -> str:
+    """Create a resumable session for a freshly authenticated user (caller holds state_lock)"""
+    revoke_session(username)
+    token = secrets.token_urlsafe(24)
+    udp_key = secrets.token_urlsafe(12)
+    sessions[token] = Session(username, udp_key)
+    session_tokens[username] = token
+    udp_keys[udp_key] = token
+    return token
+
+def suspend_session(username: str):
+    """Start the resume grace window after a disconnect (caller holds state_lock)"""
+    token = session_tokens.get(username)
+    if token:
+        sessions[token].expires = time.time() + RESUME_GRACE
+
+def revoke_session(username: str):
+    """Forget a user's session token (caller holds state_lock)"""
+    token = session_tokens.pop(username, None)
+    if token:
+        session = sessions.pop(token, None)
+        if session:
+            udp_keys.pop(session.udp_key, None)
+
+def admit(identity: str, command_class: str) -> float:
+    """Charge a command to identity's bucket for its class: 0 to run it, else seconds to wait"""
+    if rate_limit_scale <= 0:
+        return 0.0
+    bucket = rate_buckets.get((identity, command_class))
+    if bucket is None:
+        rate, burst = RATE_LIMITS[command_class]
+        bucket = rate_buckets[(identity, command_class)] = TokenBucket(
+            rate * rate_limit_scale, max(1.0, burst * rate_limit_scale)
+        )
+    return bucket.take()
+
+def prune_rate_buckets():
+    """Forget buckets that have refilled and gone unused"""
+    now = time.monotonic()
+    for key in [key for key, bucket in rate_buckets.items() if bucket.idle(now)]:
+        del rate_buckets[key]
+
+async def report_shedding():
+    """Print shed counters whenever they change"""
+    reported = {}
+    while True:
+        await asyncio.sleep(SHED_REPORT_INTERVAL)
+        if shed != reported:
+            reported = dict(shed)
+            print(f"[server] shed: {', '.join(f'{key}={count}' for key, count in sorted(shed.items()))}")
+
+def heartbeat_interval() -> float:
+    """Interval to hand out: the legacy 2 s at low load, stretched so total heartbeats stay near the target rate"""
+    return min(MAX_HEARTBEAT_INTERVAL, max(HEARTBEAT_INTERVAL, len(active_clients) / HEARTBEAT_TARGET_RATE))
+
+def touch(username: str, writer=None):
+    """Record traffic from a user as liveness; no lock needed as nothing here awaits"""
+    info = active_clients.get(username)
+    if info is not None and (writer is None or info.writer is writer):
+        info.heartbeat = time.time()
+
+class HeartbeatProtocol(asyncio.DatagramProtocol):
+    """UDP keep-alives, "hbt <udp_key>", that skip TCP stream processing entirely"""
+    
+    def datagram_received(self, data: bytes, addr):
+        parts = data.split()
+        if len(parts) == 2 and parts[0] == b"hbt":
+            session = sessions.get(udp_keys.get(parts[1].decode("ascii", "replace")))
+            if session is not None:
+                touch(session.username)
+
+def drop_piece_map(username: str, filename: str = None) -> bool:
+    """Forget a user's partial availability for one file, or all files (caller holds state_lock)"""
+    filenames = [filename] if filename else list(partial_by_user.get(username, ()))
+    dropped = False
+    for name in filenames:
+        maps = piece_maps.get(name)
+        if maps and maps.pop(username, None) is not None:
+            dropped = True
+            if not maps:
+                del piece_maps[name]
+        partial_by_user.get(username, set()).discard(name)
+    if not partial_by_user.get(username, True):
+        del partial_by_user[username]
+    return dropped
+
+def parse_page_args(args: list):
+    """(limit, cursor) from the optional "<limit> [<cursor>]" arguments, or None if malformed"""
+    try:
+        limit = int(args[0])
+        cursor = None if len(args) < 2 or args[1] == NO_CURSOR else bytes.fromhex(args[1]).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if len(args) > 2 or not 0 < limit <= MAX_PAGE_ITEMS:
+        return None
+    return limit, cursor
+
+def page_after(names, cursor, limit: int):
+    """The first names in sorted order after cursor, and the cursor that continues after them.
+
+    Only limit + 1 names are kept while scanning, so a page costs O(limit) memory
+    however many names match. The cursor is the last name returned, which stays
+    valid when names are added or removed between pages.
+    """
+    candidates = heapq.nsmallest(limit + 1, (name for name in names if cursor is None or name > cursor))
+    page, size = [], 0
+    for name in candidates[:limit]:
+        size += len(name.encode()) + 1
+        if page and size > MAX_PAGE_BYTES:
+            break
+        page.append(name)
+    next_cursor = page[-1].encode().hex() if len(candidates) > len(page) else None
+    return page, next_cursor
+
+def page_response(command: str, page_args: list, names) -> str:
+    """Reply to a paginated request: the page after its cursor, or a newline-terminated ERR"""
+    parsed = parse_page_args(page_args)
+    if parsed is None:
+        return f"{command} ERR\n"
+    page, next_cursor = page_after(names, parsed[1], parsed[0])
+    return page_reply(command, next_cursor, page)
 
 ################################################################################
 ############################### CLIENT HANDLER ################################
@@ -99,6 +629,8 @@ async def check_heartbeat():
 
 class ClientHandler:
     """Async handler for a single client connection"""
+    __slots__ = ("reader", "writer", "address", "client_alive", "client_username", "client_upload_port",
+                 "decoder", "connected_at", "bytes_in", "bytes_out", "commands", "connection_id")
     
     def __init__(self, reader, writer, address):
         self.reader = reader
@@ -107,6 +639,12 @@ class ClientHandler:
         self.client_alive = True
         self.client_username = None
         self.client_upload_port = None
+        self.decoder = Decoder()
+        self.connected_at = time.time()
+        self.bytes_in = self.bytes_out = self.commands = 0
+        self.connection_id = next(connection_ids)
+        # drain() never waits below the eviction threshold, so a stalled reader cannot block a handler
+        writer.transport.set_write_buffer_limits(high=write_buffer_limit)
     
     def log(self, message: str):
         """Print server message with timestamp"""
@@ -115,17 +653,61 @@ class ClientHandler:
         print(f"{current_timestamp}: {peer_port}: {message}")
     
     async def send(self, message: str):
-        """Send message to client"""
-        self.writer.write(message.encode())
-        await self.writer.drain()
+        """Send message to client, evicting it if it stops reading with output past the limit.
+
+        One reply may be larger than the limit; the client is evicted only if the
+        limit was already exceeded before writing, or if it reads nothing from
+        that backlog for WRITE_STALL_TIMEOUT.
+        """
+        trace = tracing.current.get()
+        started = time.perf_counter() if trace is not None else 0.0
+        if self.decoder.line_framed and not message.endswith("\n"):
+            message += "\n"  # Framed clients read replies by line, however long they are
+        data = message.encode()
+        if self.writer.transport.get_write_buffer_size() > write_buffer_limit:
+            self.evict_slow_consumer()
+        self.bytes_out += len(data)
+        self.writer.write(data)
+        unsent = self.writer.transport.get_write_buffer_size()
+        if unsent <= write_buffer_limit:
+            await self.writer.drain()  # Does not yield, so state changes after a reply stay in step with it
+        else:
+            await self.wait_for_reader(unsent)
+        if trace is not None:
+            trace.write += time.perf_counter() - started
+    
+    async def wait_for_reader(self, unsent: int):
+        """Drain a backlog past the limit, evicting the client if a whole WRITE_STALL_TIMEOUT passes unread"""
+        while True:
+            try:
+                await asyncio.wait_for(self.writer.drain(), WRITE_STALL_TIMEOUT)
+                return
+            except asyncio.TimeoutError:
+                if self.writer.transport.get_write_buffer_size() >= unsent:
+                    self.evict_slow_consumer()
+                unsent = self.writer.transport.get_write_buffer_size()
+    
+    def evict_slow_consumer(self):
+        shed["slow_consumers_evicted"] += 1
+        self.log(f"Evicting {self.client_username}: not reading its responses")
+        self.writer.transport.abort()
+        raise ConnectionResetError("slow consumer evicted")
+    
+    def owns_session(self) -> bool:
+        """Whether this connection is the active one for its user (caller holds state_lock)"""
+        info = active_clients.get(self.client_username)
+        return info is not None and info.writer is self.writer
     
     async def disconnect(self):
         """Cleanly disconnect client"""
         self.client_alive = False
         if self.client_username and self.client_username in active_clients:
             async with state_lock:
-                if self.client_username in active_clients:
+                if self.owns_session():
                     del active_clients[self.client_username]
+                    publications.deactivate(self.client_username)
+                    drop_piece_map(self.client_username)
+                    suspend_session(self.client_username)
         try:
             self.writer.close()
             await self.writer.wait_closed()
@@ -138,36 +720,20 @@ class ClientHandler:
         
         while self.client_alive:
             try:
-                data = await asyncio.wait_for(self.reader.read(1024), timeout=10.0)
+                # Authenticated clients are timed out by check_heartbeat, which also sees UDP heartbeats
+                timeout = None if self.owns_session() else UNAUTHENTICATED_TIMEOUT
+                data = await asyncio.wait_for(self.reader.read(1024), timeout=timeout)
                 if not data:
                     await self.disconnect()
                     break
+                self.bytes_in += len(data)
+                # Any command is proof of life, so busy clients need not send hbt at all
+                touch(self.client_username, self.writer)
                 
-                message = data.decode()
-                
-                if message.startswith("auth"):
-                    await self.process_auth(message)
-                elif message.startswith("port"):
-                    await self.process_port(message)
-                elif message.startswith("hbt"):
-                    await self.process_heartbeat()
-                elif message.startswith("get"):
-                    await self.process_get(message)
-                elif message.startswith("lap"):
-                    await self.process_lap()
-                elif message.startswith("lpf"):
-                    await self.process_lpf()
-                elif message.startswith("pub"):
-                    await self.process_pub(message)
-                elif message.startswith("sch"):
-                    await self.process_sch(message)
-                elif message.startswith("unp"):
-                    await self.process_unp(message)
-                elif message.startswith("xit"):
-                    await self.process_xit()
-                else:
-                    self.log(f"Sent ERR to {self.client_username}")
-                    await self.send("INPUT_ERR")
+                for message in self.decoder.feed(data):
+                    await self.dispatch(message)
+                    if not self.client_alive:
+                        break
                     
             except asyncio.TimeoutError:
                 await self.disconnect()
@@ -180,204 +746,566 @@ class ClientHandler:
                 await self.disconnect()
                 break
     
-    async def process_auth(self, message: str):
-        """Handle authentication request"""
+    async def throttle(self, command) -> bool:
+        """Apply the rate limit for command's class, replying BUSY if it is shed"""
+        if command.name in UNLIMITED_COMMANDS:
+            return False
+        command_class = COMMAND_CLASSES.get(command.name, "unknown")
+        if command_class == "auth":
+            identity = f"auth:{command.args[0] if command.args else ''}"
+        elif self.owns_session():
+            identity = self.client_username
+        else:
+            identity = f"ip:{self.address[0]}"
+        retry_after = admit(identity, command_class)
+        if not retry_after:
+            return False
+        shed[f"rate_limited_{command_class}"] += 1
+        await self.send(busy_reply(retry_after, self.decoder.line_framed))
+        return True
+    
+    async def dispatch(self, message: str):
+        """Handle one command, recording how long it took and, if sampled, where the time went"""
+        started = time.perf_counter()
+        sent = self.bytes_out
+        self.commands += 1
+        command = parse_command(message)  # The only split; throttle, handler and recorder share it
+        trace = tracer.start(command.name, self.client_username)
+        if trace is not None:
+            tracing.current.set(trace)  # Each connection is its own task, so this stays per client
         try:
-            parts = message.split()
-            if len(parts) < 3:
-                await self.send("auth ERR")
+            if await self.throttle(command):
                 return
-            _, username, password = parts[0], parts[1], " ".join(parts[2:])
-        except (ValueError, IndexError):
-            await self.send("auth ERR")
-            return
-        
-        self.client_username = username
-        self.log(f"Received AUTH from {self.client_username}")
-        
-        if not user_exists_db(self.client_username):
+            if trace is not None:
+                trace.parse = time.perf_counter() - started
+            await self.route(command)
+        finally:
+            elapsed = time.perf_counter() - started
+            command_seconds.observe(elapsed, command.name)
+            if recorder is not None:
+                username = self.client_username if self.owns_session() else None
+                recorder.record(self.connection_id, username, command, len(message.encode()),
+                                self.bytes_out - sent, elapsed)
+            if trace is not None:
+                tracing.current.set(None)
+                tracer.finish(trace, elapsed)
+    
+    async def route(self, command):
+        """Route one command to its handler through the handlers table"""
+        handler = self.handlers.get(command.name)
+        if handler is None:
             self.log(f"Sent ERR to {self.client_username}")
-            await self.send("auth ERR")
-            return
+            await self.send(INPUT_ERR)
+        elif not command.well_formed():
+            # A search for nothing finds nothing; other malformed commands are refused
+            await self.send(list_reply("sch", []) if command.name == "sch" else f"{command.name} ERR")
+        else:
+            await handler(self, command.args)
+    
+    async def process_auth(self, args: list):
+        """Handle authentication request"""
+        username, password = sys.intern(args[0]), " ".join(args[1:])  # Shared by every table keyed on this user
+        self.log(f"Received AUTH from {username}")
         
-        if not check_auth_db(self.client_username, password):
-            self.log(f"Sent ERR to {self.client_username}")
+        # The connection takes the name only once the password checks out; until then it owns nothing
+        if not user_exists_db(username) or not check_auth_db(username, password):
+            self.log(f"Sent ERR to {username}")
             await self.send("auth ERR")
             return
         
         async with state_lock:
-            if self.client_username in active_clients:
-                self.log(f"Sent ERR to {self.client_username}")
-                await self.send("auth ERR")
-                return
-            
-            active_clients[self.client_username] = {
-                "address": self.address,
-                "reader": self.reader,
-                "writer": self.writer,
-                "heartbeat": time.time(),
-                "upload_port": None
-            }
+            signed_in = username in active_clients
+            if not signed_in:
+                self.client_username = username
+                active_clients[username] = PeerRecord(self.writer, self.address)
+                publications.activate(username)
+                issue_session(username)
+        if signed_in:
+            self.log(f"Sent ERR to {username}")
+            await self.send("auth ERR")
+            return
         
         self.log(f"Sent OK to {self.client_username}")
         await self.send("auth OK")
     
-    async def process_port(self, message: str):
+    async def process_port(self, args: list):
         """Handle upload port registration"""
         try:
-            _, upload_port_str = message.split()
-            upload_port = int(upload_port_str)
-        except (ValueError, IndexError):
+            upload_port = int(args[0])
+        except ValueError:
             await self.send("port ERR")
             return
         
         self.client_upload_port = upload_port
         
         async with state_lock:
-            if self.client_username in active_clients:
-                active_clients[self.client_username]["upload_port"] = upload_port
-                await self.send("port OK")
-            else:
-                await self.send("port ERR")
+            registered = self.owns_session()
+            if registered:
+                active_clients[self.client_username].upload_port = upload_port
+                if self.client_username in session_tokens:
+                    sessions[session_tokens[self.client_username]].upload_port = upload_port
+        await self.send("port OK" if registered else "port ERR")
+    
+    async def process_heartbeat(self, args: list):
+        """Handle heartbeat update (handle() has already recorded the traffic)"""
+        touch(self.client_username, self.writer)
     
-    async def process_heartbeat(self):
-        """Handle heartbeat update"""
+    async def process_hbi(self, args: list):
+        """Tell the client its heartbeat interval, and where to send UDP heartbeats if enabled"""
         async with state_lock:
-            if self.client_username in active_clients:
-                active_clients[self.client_username]["heartbeat"] = time.time()
-                self.log(f"Received HBT from {self.client_username}")
+            signed_in = self.owns_session()
+            if signed_in:
+                interval = heartbeat_interval()
+                active_clients[self.client_username].interval = interval
+                udp_key = sessions[session_tokens[self.client_username]].udp_key
+        if not signed_in:
+            await self.send("hbi ERR")
+        elif udp_heartbeat_port is None:
+            await self.send(f"hbi {interval:g}")
+        else:
+            await self.send(f"hbi {interval:g} {udp_heartbeat_port} {udp_key}")
     
-    async def process_get(self, message: str):
+    async def process_get(self, args: list):
         """Handle file request"""
         self.log(f"Received GET from {self.client_username}")
-        try:
-            _, filename = message.split()
-        except ValueError:
-            await self.send("get ERR")
-            return
+        filename = args[0]
         
+        response = None
         async with state_lock:
-            if filename in published_files:
-                peers_with_file = [
-                    username for username in published_files[filename]
-                    if username != self.client_username and username in active_clients
-                ]
-                
-                if peers_with_file:
-                    peer_username = peers_with_file[0]
-                    peer_info = active_clients[peer_username]
-                    peer_address = peer_info["address"]
-                    peer_upload_port = peer_info.get("upload_port")
-                    
-                    if peer_upload_port:
-                        await self.send(f"get {peer_address[0]} {peer_upload_port} {filename}")
-                        self.log(f"Sent OK to {self.client_username}")
-                        return
+            count_hit(filename)
+            for peer_username in publications.live_owners(filename):
+                if peer_username == self.client_username:
+                    continue
+                peer_info = active_clients[peer_username]
+                if peer_info.upload_port:
+                    response = f"get {peer_info.host} {peer_info.upload_port} {filename}"
+                    break
+        if response is not None:
+            await self.send(response)
+            self.log(f"Sent OK to {self.client_username}")
+            return
         
         await self.send("get ERR")
         self.log(f"Sent ERR to {self.client_username}")
     
-    async def process_lap(self):
-        """Handle list active peers request"""
+    async def process_lap(self, page_args: list):
+        """Handle list active peers request, paginated when a limit is given"""
         async with state_lock:
             self.log(f"Received LAP from {self.client_username}")
-            active_peers = [
-                username for username in active_clients.keys()
-                if username != self.client_username
-            ]
-            
-            if active_peers:
-                await self.send(f"lap {' '.join(active_peers)}")
+            active_peers = (username for username in active_clients.keys() if username != self.client_username)
+            if page_args:
+                response = page_response("lap", page_args, active_peers)
             else:
-                await self.send("lap No active peers")
+                response = list_reply("lap", list(active_peers))
+        await self.send(response)
     
-    async def process_lpf(self):
-        """Handle list published files request"""
+    async def process_lpf(self, page_args: list):
+        """Handle list published files request, paginated when a limit is given"""
         async with state_lock:
             self.log(f"Received LPF from {self.client_username}")
-            published_by_user = [
-                file for file, users in published_files.items()
-                if self.client_username in users
-            ]
-            
-            if published_by_user:
-                await self.send(f"lpf {' '.join(published_by_user)}")
+            published_by_user = publications.files_of(self.client_username)
+            if page_args:
+                response = page_response("lpf", page_args, published_by_user)
             else:
-                await self.send("lpf No files published")
+                response = list_reply("lpf", list(published_by_user))
+        await self.send(response)
     
-    async def process_pub(self, message: str):
-        """Handle file publish request"""
-        try:
-            _, filename = message.split()
-        except ValueError:
+    async def process_pub(self, args: list):
+        """Handle file publish request, with an optional size in bytes for size-filtered searches"""
+        if len(args) == 2 and not args[1].isdigit():
             await self.send("pub ERR")
             return
+        filename = args[0]
+        size = int(args[1]) if len(args) == 2 else None
         
         self.log(f"Received PUB from {self.client_username}")
         
         async with state_lock:
-            if filename not in published_files:
-                published_files[filename] = set()
-            
-            published_files[filename].add(self.client_username)
-            self.log(f"Sent OK to {self.client_username}")
-            await self.send("pub OK")
+            signed_in = self.owns_session()
+            if signed_in:
+                publications.publish(filename, self.client_username, size)
+                publication_store.add(filename, self.client_username)
+                drop_piece_map(self.client_username, filename)
+        if not signed_in:
+            self.log(f"Sent ERR to {self.client_username}: not signed in")
+            await self.send("pub ERR")
+            return
+        self.log(f"Sent OK to {self.client_username}")
+        await self.send("pub OK")
     
-    async def process_sch(self, message: str):
-        """Handle file search request"""
+    async def process_sch(self, args: list):
+        """Handle file search: "sch <pattern> [key:value filters] [<limit> [<cursor>]]".
+
+        Unpaginated results are ranked by relevance; paginated ones come in name order.
+        """
+        filters = [term for term in args[1:] if ":" in term]
+        page_args = args[1 + len(filters):]
+        
+        self.log(f"Received SCH from {self.client_username}")
+        
         try:
-            _, substring = message.split()
-        except ValueError:
-            await self.send("sch No files found")
+            query = parse_query(args[0], filters)
+            if page_args and query.limit is not None:
+                raise QueryError("limit: cannot be combined with pagination")
+        except QueryError:
+            await self.send("sch ERR\n" if page_args else "sch ERR")
             return
         
-        self.log(f"Received SCH from {self.client_username}")
+        regex_matches = None
+        if query.kind == "regex" and regex_worker is not None:
+            # Run in the worker process, outside state_lock: a slow regex cannot stall other commands.
+            # Only names narrowed by an owner or a literal in the pattern are sent; otherwise the
+            # worker scans its own copy of the index
+            async with state_lock:
+                scope = self.search_scope(query)
+                if scope is None:
+                    scope = publications.names.regex_candidates(query.pattern)
+                if scope is not None:
+                    scope = list(scope)
+                elif regex_worker.needs_seed:
+                    regex_worker.reseed(list(publications.names.names))  # A new worker starts empty
+            try:
+                regex_matches = await asyncio.get_event_loop().run_in_executor(
+                    None, regex_worker.scan, query.pattern, scope
+                )
+            except QueryError:
+                await self.send("sch ERR\n" if page_args else "sch ERR")
+                return
         
         async with state_lock:
-            search_results = []
-            
-            for file, users in published_files.items():
-                if substring in file and self.client_username not in users:
-                    search_results.append(file)
-            
-            if search_results:
-                await self.send(f"sch {' '.join(search_results)}")
+            scope = self.search_scope(query)
+            if regex_matches is not None:
+                # Names may have been unpublished, or their owner gone, while the worker scanned
+                scope = publications.live if scope is None else scope
+                found = (name for name in regex_matches if name in scope)
             else:
-                await self.send("sch No files found")
+                found = publications.names.match(query, scope)
+            size_filter = query._replace(owner=None)  # The search scope already holds only the owner's files
+            matches = (
+                name for name in found
+                if not publications.owns(name, self.client_username)
+                and size_filter.accepts((), publications.sizes.get(name))
+            )
+            try:
+                if page_args:
+                    response = page_response("sch", page_args, matches)
+                else:
+                    def rank(name):
+                        return query.rank(name, publications.owner_count(name))
+                    if query.limit is not None:
+                        search_results = heapq.nsmallest(query.limit, matches, key=rank)
+                    else:
+                        search_results = sorted(matches, key=rank)
+                    response = list_reply("sch", search_results)
+            except QueryError:
+                response = "sch ERR\n" if page_args else "sch ERR"
+        
+        await self.send(response)
     
-    async def process_unp(self, message: str):
+    def search_scope(self, query):
+        """Live files of the query's owner filter, or None when it has none (caller holds state_lock)"""
+        if query.owner is None:
+            return None
+        return publications.files_of(query.owner) if query.owner in publications.live_users else ()
+    
+    async def process_unp(self, args: list):
         """Handle file unpublish request"""
+        filename = args[0]
+        
+        self.log(f"Received UNP from {self.client_username}")
+        
+        async with state_lock:
+            signed_in = self.owns_session()
+            withdrew_partial = signed_in and drop_piece_map(self.client_username, filename)
+            unpublished = signed_in and publications.unpublish(filename, self.client_username)
+            if unpublished:
+                publication_store.remove(filename, self.client_username)
+        if unpublished or withdrew_partial:
+            await self.send("unp OK")
+            self.log(f"Sent OK to {self.client_username}")
+        else:
+            await self.send("unp ERR")
+            self.log(f"Sent ERR to {self.client_username}")
+    
+    async def process_have(self, args: list):
+        """Handle partial availability: have <filename> <file_size> <piece_size> <bitmap_hex>"""
         try:
-            _, filename = message.split()
+            filename, file_size, piece_size, bitmap_hex = args
+            file_size, piece_size = int(file_size), int(piece_size)
+            if file_size < 0 or piece_size <= 0:
+                raise ValueError
+            num_pieces = -(-file_size // piece_size)
+            if len(bytes.fromhex(bitmap_hex)) != (num_pieces + 7) // 8:
+                raise ValueError
         except ValueError:
-            await self.send("unp ERR")
+            await self.send("have ERR")
             return
         
-        self.log(f"Received UNP from {self.client_username}")
+        async with state_lock:
+            signed_in = self.owns_session()
+            if signed_in:
+                piece_maps.setdefault(filename, {})[self.client_username] = (file_size, piece_size, bitmap_hex)
+                partial_by_user.setdefault(self.client_username, set()).add(filename)
+        await self.send("have OK" if signed_in else "have ERR")
+    
+    async def process_wdr(self, args: list):
+        """Handle withdrawal of partial availability, leaving any publication of the file in place"""
+        async with state_lock:
+            signed_in = self.owns_session()
+            if signed_in:
+                drop_piece_map(self.client_username, args[0])
+        await self.send("wdr OK" if signed_in else "wdr ERR")
+    
+    async def process_src(self, args: list):
+        """Handle swarm source request: full seeders and partial seeders of a file"""
+        self.log(f"Received SRC from {self.client_username}")
+        filename = args[0]
         
         async with state_lock:
-            if filename in published_files and self.client_username in published_files[filename]:
-                published_files[filename].discard(self.client_username)
-                
-                if not published_files[filename]:
-                    del published_files[filename]
-                
-                await self.send("unp OK")
-                self.log(f"Sent OK to {self.client_username}")
+            count_hit(filename)
+            sources = []
+            for username in publications.live_owners(filename):
+                address = peer_endpoint(username, self.client_username)
+                if address:
+                    sources.append(f"{address},*")
+            for username, (file_size, piece_size, bitmap_hex) in piece_maps.get(filename, {}).items():
+                address = peer_endpoint(username, self.client_username)
+                if address:
+                    sources.append(f"{address},{file_size},{piece_size},{bitmap_hex}")
+        
+        if not sources:
+            await self.send("src ERR")
+            return
+        if len(sources) > MAX_SOURCES:
+            sources = random.sample(sources, MAX_SOURCES)
+        else:
+            random.shuffle(sources)
+        await self.send(f"src {' '.join(sources)}")
+    
+    async def process_tok(self, args: list):
+        """Hand the session token issued at auth to its owner"""
+        async with state_lock:
+            token = session_tokens.get(self.client_username) if self.owns_session() else None
+        await self.send(f"tok {token}" if token else "tok ERR")
+    
+    async def process_rsm(self, args: list):
+        """Resume a session by token: restore peer record, upload port and publications"""
+        token = args[0]
+        
+        async with state_lock:
+            session = sessions.get(token)
+            if session is None or (session.expires is not None and session.expires < time.time()):
+                refusal = ""
+            elif self.owns_session() and session.username != self.client_username:
+                # Taking over another user's session would leave this one's peer record stale
+                refusal = ": already signed in"
             else:
-                await self.send("unp ERR")
-                self.log(f"Sent ERR to {self.client_username}")
+                refusal = None
+                self.resume(session)
+        if refusal is not None:
+            self.log(f"Sent ERR to {self.client_username}{refusal}")
+            await self.send("rsm ERR")
+            return
+        
+        self.log(f"Resumed session for {self.client_username}")
+        await self.send("rsm OK")
+    
+    def resume(self, session: Session):
+        """Make this connection the live one for session's user (caller holds state_lock)"""
+        self.client_username = session.username
+        self.client_upload_port = session.upload_port
+        previous = active_clients.get(self.client_username)
+        if previous is not None and previous.writer is not self.writer:
+            # The old connection has not noticed the network blip yet; this one takes over
+            previous.writer.close()
+        active_clients[self.client_username] = PeerRecord(self.writer, self.address, session.upload_port)
+        session.expires = None
+        publications.activate(self.client_username)
     
-    async def process_xit(self):
+    async def process_xit(self, args: list):
         """Handle exit request"""
+        async with state_lock:
+            if self.owns_session():
+                revoke_session(self.client_username)
         await self.send("xit")
         await self.disconnect()
+    
+    # One dict lookup per command in place of a chain of prefix checks; arities are in protocol.ARITY
+    handlers = {
+        "auth": process_auth, "port": process_port, "hbt": process_heartbeat, "hbi": process_hbi,
+        "get": process_get, "lap": process_lap, "lpf": process_lpf, "pub": process_pub, "sch": process_sch,
+        "unp": process_unp, "xit": process_xit, "have": process_have, "wdr": process_wdr, "src": process_src,
+        "tok": process_tok, "rsm": process_rsm,
+    }
 
 async def handle_client(reader, writer):
     """Handle incoming client connection"""
-    address = writer.get_extra_info('peername')
-    handler = ClientHandler(reader, writer, address)
-    await handler.handle()
+    global open_connections
+    if open_connections >= max_connections:
+        shed["connections_rejected"] += 1
+        writer.transport.abort()
+        return
+    open_connections += 1
+    handler = None
+    try:
+        address = writer.get_extra_info('peername')
+        handler = ClientHandler(reader, writer, address)
+        client_handlers.add(handler)
+        await handler.handle()
+    finally:
+        open_connections -= 1
+        client_handlers.discard(handler)
+
+################################################################################
+##################################### ADMIN ####################################
+################################################################################
+
+# Snapshots are plain synchronous reads: nothing awaits, so they are consistent without state_lock
+# and never queue behind client commands. They read counts and bounded top-N, not whole tables.
+
+def load_admin_token() -> str:
+    """Read the admin token, generating one readable only by this user on first use"""
+    if not os.path.exists(ADMIN_TOKEN_FILE):
+        fd = os.open(ADMIN_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as file:
+            file.write(secrets.token_urlsafe(24) + "\n")
+        print(f"Generated an admin token in {ADMIN_TOKEN_FILE}")
+    with open(ADMIN_TOKEN_FILE) as file:
+        return file.read().strip()
+
+def stats_snapshot() -> dict:
+    return {
+        "connections": open_connections,
+        "authenticated": len(active_clients),
+        "sessions": len(sessions),
+        "live_files": len(publications.live),
+        "dormant_files": len(publications.dormant),
+        "publishers": len(publications.by_user),
+        "index_trigrams": len(publications.names.grams),
+        "partial_files": len(piece_maps),
+        "rate_buckets": len(rate_buckets),
+        "command_rates": command_rates,
+        "shed": dict(shed),
+    }
+
+def connections_snapshot(limit: int) -> list:
+    """The limit connections that have moved the most bytes"""
+    now = time.time()
+    busiest = heapq.nlargest(limit, client_handlers, key=lambda handler: handler.bytes_in + handler.bytes_out)
+    return [{
+        "user": handler.client_username,
+        "address": f"{handler.address[0]}:{handler.address[1]}",
+        "bytes_in": handler.bytes_in,
+        "bytes_out": handler.bytes_out,
+        "commands": handler.commands,
+        "seconds": round(now - handler.connected_at, 1),
+    } for handler in busiest]
+
+def top_publishers(limit: int) -> list:
+    ranked = heapq.nlargest(limit, publications.by_user.items(), key=lambda item: len(item[1]))
+    return [[username, len(filenames)] for username, filenames in ranked]
+
+def count_hit(filename: str):
+    """Count a get or src toward the hot files if filename is published (caller holds state_lock)"""
+    if filename not in publications.live:
+        return  # Lookups of arbitrary names must not grow the table
+    if filename not in file_hits and len(file_hits) >= MAX_HOT_FILES:
+        hottest = file_hits.most_common(MAX_HOT_FILES // 2)
+        file_hits.clear()
+        file_hits.update(dict(hottest))
+    file_hits[filename] += 1
+
+def hot_files(limit: int) -> list:
+    return [[filename, round(hits, 1)] for filename, hits in file_hits.most_common(limit)]
+
+async def sample_command_rates():
+    """Turn command counts into per-second rates, and age hot-file counts"""
+    previous = {}
+    while True:
+        await asyncio.sleep(ADMIN_SAMPLE_INTERVAL)
+        totals = {command: sum(command_seconds.counts[i]) for command, i in command_seconds.index.items()}
+        command_rates.clear()
+        command_rates.update({
+            command: round((count - previous.get(command, 0)) / ADMIN_SAMPLE_INTERVAL, 2)
+            for command, count in totals.items() if count > previous.get(command, 0)
+        })
+        previous = totals
+        for filename, hits in list(file_hits.items()):
+            if hits * HOT_FILE_DECAY < 0.5:
+                del file_hits[filename]
+            else:
+                file_hits[filename] = hits * HOT_FILE_DECAY
+
+async def evict(username: str) -> bool:
+    """Disconnect a user and revoke their session so it cannot be resumed"""
+    async with state_lock:
+        info = active_clients.pop(username, None)
+        if info is None:
+            return False
+        publications.deactivate(username)
+        drop_piece_map(username)
+        revoke_session(username)
+    print(f"[server] {username} evicted by an operator")
+    info.writer.transport.abort()
+    return True
+
+class AdminHandler:
+    """One operator connection on the admin port: "auth <token>" first, then one JSON reply per command"""
+    
+    def __init__(self, reader, writer, token: str):
+        self.reader = reader
+        self.writer = writer
+        self.token = token
+    
+    async def reply(self, message: str):
+        self.writer.write(f"{message}\n".encode())
+        await self.writer.drain()
+    
+    async def handle(self):
+        authenticated = False
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(self.reader.readline(), ADMIN_IDLE_TIMEOUT)
+                except ValueError:  # Past the stream limit; the rest of the line cannot be told from commands
+                    await self.reply("ERR line too long")
+                    break
+                if not line:
+                    break
+                parts = line.decode(errors="replace").split()
+                if not parts:
+                    continue
+                if not authenticated:
+                    if parts[0] != "auth" or len(parts) != 2 or not secrets.compare_digest(parts[1], self.token):
+                        await self.reply("auth ERR")
+                        break
+                    authenticated = True
+                    await self.reply("auth OK")
+                    continue
+                await self.reply(await self.run(parts[0], parts[1:]))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+    
+    async def run(self, command: str, args: list) -> str:
+        """Run one admin command and format its reply"""
+        if command == "evict":
+            if len(args) != 1:
+                return "evict ERR usage: evict <username>"
+            return "evict OK" if await evict(args[0]) else "evict ERR not connected"
+        listings = {"conns": connections_snapshot, "publishers": top_publishers, "hot": hot_files}
+        if command == "stats":
+            return f"stats {json.dumps(stats_snapshot())}"
+        if command in listings:
+            try:
+                limit = int(args[0]) if args else 10
+            except ValueError:  # Includes digits str.isdigit() accepts but int() does not, such as "²"
+                limit = -1
+            if limit < 0:
+                return f"{command} ERR usage: {command} [N]"
+            return f"{command} {json.dumps(listings[command](min(limit, MAX_ADMIN_ROWS)))}"
+        return "ERR commands: stats, conns [N], publishers [N], hot [N], evict <username>"
 
 def create_ssl_context():
     """Create SSL context for secure connections"""
@@ -400,33 +1328,109 @@ def create_ssl_context():
     ssl_context.load_cert_chain(cert_file, key_file)
     ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
     
+    # Session resumption: TLS 1.3 tickets (and the TLS 1.2 session cache) let a
+    # reconnecting client skip the certificate exchange and key signature
+    ssl_context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(ssl_context, "num_tickets"):
+        ssl_context.num_tickets = TLS_SESSION_TICKETS
+    
     return ssl_context
 
-async def main():
+def debug_routes() -> dict:
+    """On-demand diagnostics served next to /metrics"""
+    async def traces(params):
+        return tracer.dump()
+    
+    async def profile(params):
+        return await tracing.profile_window(tracing.capture_seconds(params), params.get("sort", "cumulative"))
+    
+    async def allocations(params):
+        return await tracing.allocation_window(tracing.capture_seconds(params))
+    
+    return {"/debug/traces": traces, "/debug/profile": profile, "/debug/allocations": allocations}
+
+async def main(server_port: int, use_ssl: bool, udp_heartbeat: bool = False,
+               connection_limit: int = MAX_CONNECTIONS, backlog: int = LISTEN_BACKLOG,
+               buffer_limit: int = WRITE_BUFFER_LIMIT, rate_scale: float = 1.0, metrics_port: int = None,
+               trace_sample: int = tracing.TRACE_SAMPLE_EVERY, admin_port: int = None,
+               stall_threshold: float = metrics.STALL_THRESHOLD, record_path: str = None):
     """Main entry point for asyncio server"""
-    global state_lock
+    global state_lock, publication_store, udp_heartbeat_port, stall_watchdog, recorder, regex_worker
+    global max_connections, write_buffer_limit, rate_limit_scale
+    max_connections, write_buffer_limit, rate_limit_scale = connection_limit, buffer_limit, rate_scale
+    tracer.sample_every = tracer.countdown = trace_sample
     
     await init_db()
-    state_lock = asyncio.Lock()
+    state_lock = metrics.TimedLock(lock_wait)
+    
+    # Warm restart: persisted publications stay dormant until their owner authenticates
+    publication_store = PublicationStore()
+    publications.load(await publication_store.open())
+    print(f"Loaded {sum(map(len, publications.by_user.values()))} dormant publications")
     
-    if USE_SSL:
+    regex_worker = RegexWorker()
+    await asyncio.get_event_loop().run_in_executor(None, regex_worker.start)
+    publications.names.mirror = regex_worker
+    
+    if use_ssl:
         ssl_context = create_ssl_context()
         server = await asyncio.start_server(
             handle_client,
             host="127.0.0.1",
-            port=SERVER_PORT,
-            ssl=ssl_context
+            port=server_port,
+            ssl=ssl_context,
+            backlog=backlog
         )
-        print(f"SSL-encrypted asyncio server started on port {SERVER_PORT}")
+        print(f"SSL-encrypted asyncio server started on port {server_port}")
     else:
         server = await asyncio.start_server(
             handle_client,
             host="127.0.0.1",
-            port=SERVER_PORT
+            port=server_port,
+            backlog=backlog
         )
-        print(f"Asyncio server started on port {SERVER_PORT}")
+        print(f"Asyncio server started on port {server_port}")
+    
+    if udp_heartbeat:
+        await asyncio.get_event_loop().create_datagram_endpoint(
+            HeartbeatProtocol, local_addr=("127.0.0.1", server_port)
+        )
+        udp_heartbeat_port = server_port
+        print(f"Accepting UDP heartbeats on port {server_port}")
+    
+    if metrics_port is not None:
+        # /debug/* can profile the server and expose usernames, so it takes the admin channel's token
+        await metrics.serve_metrics(registry, metrics_port, routes=debug_routes(), token=load_admin_token())
+        asyncio.create_task(metrics.monitor_loop_lag(loop_lag))
+        print(f"Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+    
+    if admin_port is not None:
+        admin_token = load_admin_token()
+        await asyncio.start_server(
+            lambda reader, writer: AdminHandler(reader, writer, admin_token).handle(),
+            host="127.0.0.1",
+            port=admin_port
+        )
+        print(f"Admin commands on 127.0.0.1:{admin_port} (token in {ADMIN_TOKEN_FILE})")
+    
+    if stall_threshold > 0:
+        stall_watchdog = metrics.StallWatchdog(loop_stalls, stall_threshold, stalled_command, memory=STALL_MEMORY)
+        asyncio.create_task(stall_watchdog.run())
+    
+    if record_path is not None:
+        recorder = recording.Recorder(record_path)
+        print(f"Recording control traffic to {record_path}")
     
     asyncio.create_task(check_heartbeat())
+    asyncio.create_task(report_shedding())
+    asyncio.create_task(sample_command_rates())  # Also ages hot-file counts, which get and src always keep
+    store_task = asyncio.create_task(publication_store.run())
+    
+    # SIGTERM shuts down like Ctrl+C so pending publications are committed
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
     
     address = server.sockets[0].getsockname()
     print(f"Listening on {address}")
@@ -438,9 +1442,39 @@ async def main():
         print("\nServer shutting down...")
     except KeyboardInterrupt:
         print("\nServer shutting down...")
+    finally:
+        store_task.cancel()
+        await publication_store.close()
+        regex_worker.stop()
+        if recorder is not None:
+            recorder.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asyncio tracker for P2P file sharing")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--ssl", action="store_true")
+    parser.add_argument("--udp-heartbeat", action="store_true", help="also accept heartbeats over UDP")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG, help="listen() queue length")
+    parser.add_argument("--write-buffer-limit", type=int, default=WRITE_BUFFER_LIMIT,
+                        help="unsent bytes after which a client is evicted")
+    parser.add_argument("--rate-limit-scale", type=float, default=1.0,
+                        help="multiply per-user rate limits; 0 disables them")
+    parser.add_argument("--loop", choices=event_loops.LOOP_CHOICES, default="asyncio",
+                        help="event loop implementation (uvloop falls back to asyncio if not installed)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics and /debug endpoints on this port")
+    parser.add_argument("--trace-sample", type=int, default=tracing.TRACE_SAMPLE_EVERY,
+                        help="trace one command in N (0 disables tracing)")
+    parser.add_argument("--admin-port", type=int, help="accept admin commands on this local port")
+    parser.add_argument("--stall-threshold", type=float, default=metrics.STALL_THRESHOLD,
+                        help="log event loop stalls longer than this many seconds (0 disables the watchdog)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="write every command to PATH as JSON lines, with filenames hashed, for replay")
+    args = parser.parse_args()
+    print(f"Using the {event_loops.resolve(args.loop)} event loop")
     try:
-        asyncio.run(main())
+        event_loops.run(main(args.port, args.ssl, args.udp_heartbeat, args.max_connections, args.backlog,
+                             args.write_buffer_limit, args.rate_limit_scale, args.metrics_port,
+                             args.trace_sample, args.admin_port, args.stall_threshold, args.record), args.loop)
     except KeyboardInterrupt:
         print("\nServer stopped.")
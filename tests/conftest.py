@@ -44,3 +44,29 @@ def temp_test_file():
     yield filename
     if os.path.exists(filename):
         os.unlink(filename)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASYNC_SERVER_PORT = 12001
+
+def start_async_server(workdir, port=ASYNC_SERVER_PORT, *flags):
+    """Start server_async.py in workdir, seeding credentials.txt from the example file"""
+    credentials = os.path.join(str(workdir), "credentials.txt")
+    if not os.path.exists(credentials):
+        with open(os.path.join(REPO_ROOT, "credentials.example.txt")) as src, open(credentials, "w") as dst:
+            dst.write(src.read())
+    proc = subprocess.Popen(
+        ["python3", os.path.join(REPO_ROOT, "server_async.py"), str(port), *flags],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,  # Never read, so a pipe would fill and stall the server mid-test
+        stderr=subprocess.DEVNULL
+    )
+    time.sleep(1)  # Wait for server to start
+    return proc
+
+@pytest.fixture(scope="module")
+def async_server_process(tmp_path_factory):
+    """Start server_async.py in a scratch directory seeded with the example credentials"""
+    proc = start_async_server(tmp_path_factory.mktemp("tracker"))
+    yield proc
+    proc.terminate()
+    proc.wait()
@@ -0,0 +1,26 @@
+"""
+Test event loop selection and the fallback when uvloop is missing
+"""
+import asyncio
+
+import pytest
+
+import event_loops
+
+
+def test_resolve_falls_back_to_asyncio():
+    assert event_loops.resolve("asyncio") == "asyncio"
+    expected = "uvloop" if "uvloop" in event_loops.available() else "asyncio"
+    assert event_loops.resolve("auto") == expected
+    assert event_loops.resolve("uvloop") == expected
+    with pytest.raises(ValueError):
+        event_loops.resolve("trio")
+
+
+def test_run_returns_the_coroutine_result():
+    async def answer():
+        await asyncio.sleep(0)
+        return 42
+
+    for name in event_loops.LOOP_CHOICES:
+        assert event_loops.run(answer(), name) == 42
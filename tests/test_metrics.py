@@ -0,0 +1,104 @@
+"""
+Test the tracker's metric registry and probes
+"""
+import asyncio
+import threading
+import time
+
+import tracing
+from metrics import Registry, StallWatchdog, TimedLock
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    latency = registry.histogram("cmd_seconds", "Command latency", "command", ("sch", "other"), bounds=(0.01, 0.1))
+    latency.observe(0.005, "sch")
+    latency.observe(0.05, "sch")
+    latency.observe(3.0, "unknown")  # Unlisted keys land in "other"
+    text = registry.render()
+    
+    assert "# TYPE cmd_seconds histogram" in text
+    assert 'cmd_seconds_bucket{command="sch",le="0.01"} 1' in text
+    assert 'cmd_seconds_bucket{command="sch",le="0.1"} 2' in text
+    assert 'cmd_seconds_bucket{command="sch",le="+Inf"} 2' in text
+    assert 'cmd_seconds_count{command="sch"} 2' in text
+    assert 'cmd_seconds_bucket{command="other",le="0.1"} 0' in text
+    assert 'cmd_seconds_count{command="other"} 1' in text
+
+
+def test_counters_and_collected_values():
+    registry = Registry()
+    expiries = registry.counter("expiries_total", "Expired clients")
+    expiries.inc()
+    expiries.inc(2)
+    registry.gauge("connections", "Open connections", lambda: 7)
+    registry.collected_counter("shed_total", "Shed work", lambda: {"rate_limited_query": 4}, "reason")
+    text = registry.render()
+    
+    assert "expiries_total 3" in text
+    assert "connections 7" in text
+    assert 'shed_total{reason="rate_limited_query"} 4' in text
+
+
+def test_timed_lock_records_waits():
+    registry = Registry()
+    wait = registry.histogram("lock_wait_seconds", "Lock wait", bounds=(0.01,))
+    
+    async def scenario():
+        lock = TimedLock(wait)
+        async with lock:
+            contender = asyncio.ensure_future(lock.__aenter__())
+            await asyncio.sleep(0.05)
+            assert not contender.done()
+        await contender
+        await lock.__aexit__(None, None, None)
+        assert not lock.locked()
+    
+    asyncio.run(scenario())
+    assert wait.counts[0] == [1, 1]  # One immediate acquire, one that waited 50 ms
+
+
+def test_tracer_samples_into_a_bounded_buffer():
+    tracer = tracing.Tracer(sample_every=3, capacity=2)
+    sampled = [tracer.start("sch", "hans") for _ in range(9)]
+    assert [trace is not None for trace in sampled] == [False, False, True] * 3
+    for trace in filter(None, sampled):
+        trace.lock = 0.001
+        tracer.finish(trace, 0.004)
+    lines = tracer.dump().splitlines()
+    assert len(lines) == 2  # The oldest trace was overwritten
+    assert '"lock_ms": 1.0' in lines[0] and '"handler_ms": 3.0' in lines[0]
+
+
+def test_stall_watchdog_blames_the_blocking_code():
+    registry = Registry()
+    stalls = registry.histogram("stall_seconds", "Loop stalls", "command", ("sch", "other"), bounds=(1.0,))
+    logged = []
+    
+    def attribute(frame):
+        while frame is not None and frame.f_code.co_name != "process_sch":
+            frame = frame.f_back
+        return "sch" if frame is not None else "other"
+    
+    watchdog = StallWatchdog(stalls, threshold=0.2, attribute=attribute, log=logged.append)
+    
+    async def process_sch():
+        time.sleep(0.5)  # A synchronous call that blocks the loop
+    
+    async def scenario():
+        task = asyncio.create_task(watchdog.run(poll=0.02))
+        await asyncio.sleep(0.1)
+        before = time.time()
+        await process_sch()
+        assert watchdog.stalled_seconds(before) >= 0.3  # Counted before the run task reports it
+        await asyncio.sleep(0.1)
+        assert watchdog.stalled_seconds(before) >= 0.3
+        assert watchdog.stalled_seconds(time.time()) == 0
+        task.cancel()
+    
+    asyncio.run(scenario())
+    assert stalls.counts[0] == [1, 0]
+    assert watchdog.stopped.is_set()  # The watching thread ends with the run task
+    time.sleep(0.1)
+    assert "stall-watchdog" not in [thread.name for thread in threading.enumerate()]
+    assert len(logged) == 1 and "in sch at" in logged[0] and "process_sch" in logged[0]
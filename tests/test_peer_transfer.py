@@ -0,0 +1,198 @@
+"""
+Test peer-to-peer transfers between client_async peers over loopback
+"""
+import asyncio
+import os
+import pytest
+
+from client_async import (
+    PIECE_SIZE, DownloadSink, PeerServer, create_peer_ssl_contexts, fetch_pieces, handle_file_download,
+    swarm_download
+)
+from tests.conftest import ASYNC_SERVER_PORT
+from tracker_client import Source, TrackerClient, open_connection
+
+
+def test_peer_server_serves_published_files(tmp_path):
+    """Published files should be served, unpublished ones refused"""
+    seed_dir = tmp_path / "seed"
+    seed_dir.mkdir()
+    payload = os.urandom(300_000)
+    (seed_dir / "shared.bin").write_bytes(payload)
+    (seed_dir / "private.bin").write_bytes(b"secret")
+    
+    async def scenario():
+        published = {"shared.bin"}
+        server = PeerServer(published, host="127.0.0.1", root=seed_dir)
+        port = await server.start()
+        try:
+            await asyncio.gather(*(
+                handle_file_download("127.0.0.1", port, "shared.bin", dest=tmp_path / f"copy{i}.bin")
+                for i in range(8)
+            ))
+            await handle_file_download("127.0.0.1", port, "private.bin", dest=tmp_path / "leak.bin")
+        finally:
+            await server.close()
+    
+    asyncio.run(scenario())
+    for i in range(8):
+        assert (tmp_path / f"copy{i}.bin").read_bytes() == payload
+    assert not (tmp_path / "leak.bin").exists()
+
+
+def test_peer_server_over_tls_resumes_sessions(tmp_path):
+    """Encrypted transfers should arrive intact and later ones should resume the TLS session"""
+    seed_dir = tmp_path / "seed"
+    seed_dir.mkdir()
+    payload = os.urandom(1_000_000)
+    (seed_dir / "shared.bin").write_bytes(payload)
+    server_context, client_context = create_peer_ssl_contexts(tmp_path / "peer.crt", tmp_path / "peer.key")
+    
+    async def scenario():
+        server = PeerServer({"shared.bin"}, host="127.0.0.1", root=seed_dir, ssl_context=server_context)
+        port = await server.start()
+        try:
+            for i in range(2):
+                assert await handle_file_download("127.0.0.1", port, "shared.bin", tmp_path / f"copy{i}.bin",
+                                                  client_context)
+            # Plaintext requesters are not served by a TLS peer
+            assert not await handle_file_download("127.0.0.1", port, "shared.bin", tmp_path / "plain.bin")
+            reader, writer = await open_connection("127.0.0.1", port, client_context)
+            writer.write(b"stat shared.bin")
+            await writer.drain()
+            assert await reader.read(1024) == f"size {len(payload)}".encode()
+            reused = writer.get_extra_info("ssl_object").session_reused
+            writer.close()
+            return reused
+        finally:
+            await server.close()
+    
+    assert asyncio.run(scenario())
+    for i in range(2):
+        assert (tmp_path / f"copy{i}.bin").read_bytes() == payload
+    assert not (tmp_path / "plain.bin").exists()
+
+
+def test_download_sink_accepts_out_of_order_pieces(tmp_path):
+    """Pieces written in any order should land at their offsets before the atomic rename"""
+    payload = os.urandom(10 * 1024 + 123)
+    dest = tmp_path / "assembled.bin"
+    
+    async def scenario():
+        sink = await DownloadSink.open(dest, len(payload), piece_size=1024)
+        assert os.path.getsize(tmp_path / "assembled.bin.part") == len(payload)
+        for index in reversed(range(sink.num_pieces)):
+            start, end = sink.piece_range(index)
+            await sink.write_at(payload[start:end], start)
+            await sink.flush()
+            assert sink.has_piece(index)
+            assert not dest.exists()
+        assert sink.missing_pieces() == []
+        return await sink.finish()
+    
+    assert asyncio.run(scenario())
+    assert dest.read_bytes() == payload
+    assert not (tmp_path / "assembled.bin.part").exists()
+
+
+def test_download_sink_discards_incomplete_file(tmp_path):
+    """An incomplete download should not replace the destination"""
+    dest = tmp_path / "partial.bin"
+    
+    async def scenario():
+        sink = await DownloadSink.open(dest, 4096, piece_size=1024)
+        await sink.write_at(b"x" * 1024, 2048)
+        await sink.flush()
+        assert sink.missing_pieces() == [0, 1, 3]
+        return await sink.finish()
+    
+    assert not asyncio.run(scenario())
+    assert not dest.exists()
+    assert not (tmp_path / "partial.bin.part").exists()
+
+
+def test_download_sink_does_not_credit_rewritten_bytes(tmp_path):
+    """Retried or overlapping writes count once, so a piece with a hole is not marked done"""
+    dest = tmp_path / "retried.bin"
+    
+    async def scenario():
+        sink = await DownloadSink.open(dest, 2048, piece_size=1024)
+        for offset in (0, 0, 256, 256):  # 1024 bytes written to piece 0, but [768, 1024) never
+            await sink.write_at(b"x" * 512, offset)
+        await sink.write_at(b"y" * 600, 900)  # Spans both pieces
+        await sink.flush()
+        assert sink.missing_pieces() == [0, 1]
+        await sink.write_at(b"z" * 200, 700)
+        await sink.write_at(b"z" * 548, 1500)
+        await sink.flush()
+        assert sink.missing_pieces() == [] and sink.piece_spans == {}
+        return await sink.finish()
+    
+    assert asyncio.run(scenario())
+
+
+def test_partial_seeder_serves_only_completed_pieces(tmp_path):
+    """A download in progress should serve its finished pieces and refuse the rest"""
+    payload = os.urandom(4 * 1024)
+    
+    async def scenario():
+        sink = await DownloadSink.open(tmp_path / "hot.bin", len(payload), piece_size=1024)
+        await sink.write_at(payload[1024:2048], 1024)
+        await sink.flush()
+        server = PeerServer(set(), host="127.0.0.1")
+        server.partial_files["hot.bin"] = sink
+        port = await server.start()
+        try:
+            have = Source("127.0.0.1", port, len(payload), 1024, bytes(sink.bitmap))
+            target = await DownloadSink.open(tmp_path / "copy.bin", len(payload), piece_size=1024)
+            todo = {1}
+            await fetch_pieces(have, "hot.bin", target, todo)
+            await target.flush()
+            assert todo == set() and target.has_piece(1)
+            
+            lying = Source("127.0.0.1", port)  # Claims every piece
+            with pytest.raises(ConnectionError):
+                await fetch_pieces(lying, "hot.bin", target, {0})
+            await target.finish()
+        finally:
+            await server.close()
+            await sink.finish()
+    
+    asyncio.run(scenario())
+
+
+def test_swarm_download_through_tracker(tmp_path, async_server_process):
+    """A swarm download should complete from a seeder and then be seeded by the downloader"""
+    seed_dir, leech_dir = tmp_path / "seed", tmp_path / "leech"
+    seed_dir.mkdir()
+    leech_dir.mkdir()
+    payload = os.urandom(3 * PIECE_SIZE + 1000)
+    (seed_dir / "swarm.bin").write_bytes(payload)
+    
+    async def scenario():
+        async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as seeder, \
+                   TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as leecher:
+            await seeder.auth("chewy", "wookie+aaaawww")
+            await leecher.auth("palpatine", "darkside_%$run")
+            seed_server = PeerServer(seeder.published, host="127.0.0.1", root=seed_dir)
+            leech_server = PeerServer(leecher.published, host="127.0.0.1", root=leech_dir)
+            await seeder.register_port(await seed_server.start())
+            await leecher.register_port(await leech_server.start())
+            try:
+                await seeder.pub("swarm.bin")
+                # Overlapping downloads of one name each finish and leave no partial file behind
+                assert await asyncio.gather(*(
+                    swarm_download(leecher, leech_server, "swarm.bin", dest=tmp_path / f"copy{i}.bin")
+                    for i in range(2)
+                )) == [True, True]
+                assert leech_server.partial_files == {}
+                assert await swarm_download(leecher, leech_server, "swarm.bin")
+                assert await leecher.lpf() == ["swarm.bin"]
+                assert len(await seeder.src("swarm.bin")) == 1
+            finally:
+                await seed_server.close()
+                await leech_server.close()
+    
+    asyncio.run(scenario())
+    assert (leech_dir / "swarm.bin").read_bytes() == payload
+    assert (tmp_path / "copy0.bin").read_bytes() == (tmp_path / "copy1.bin").read_bytes() == payload
@@ -0,0 +1,146 @@
+"""
+Test the shared protocol module with seeded random inputs, and that both servers parse alike
+"""
+import os
+import random
+import shutil
+import socket
+import string
+import subprocess
+import time
+
+import pytest
+
+from protocol import (ARITY, EMPTY_LISTS, MAX_LINE, Command, Decoder, Page, ProtocolError, busy_delay, busy_reply,
+                      format_command, list_reply, page_reply, parse_command, parse_list, parse_page)
+from tests.conftest import ASYNC_SERVER_PORT, REPO_ROOT
+from tests.test_server_workers import free_port
+
+ROUNDS = 500
+WHITESPACE = " \t\x0b\x0c\u3000\u2028"  # All separate words for str.split(); newlines frame lines instead
+WORD_CHARS = string.ascii_letters + string.digits + "*:^$.-_/\u00e9\u00df\u4e2d\U0001f600"
+
+
+def random_word(rng, chars=WORD_CHARS) -> str:
+    return "".join(rng.choice(chars) for _ in range(rng.randint(1, 12)))
+
+
+def random_line(rng) -> str:
+    """Words with runs of assorted whitespace around and between them, sometimes none at all"""
+    pieces = [rng.choice(WHITESPACE) * rng.randint(0, 2)]
+    for _ in range(rng.randint(0, 6)):
+        pieces += [random_word(rng), rng.choice(WHITESPACE) * rng.randint(1, 3)]
+    return "".join(pieces)
+
+
+def test_decoder_output_does_not_depend_on_chunking():
+    """However a framed stream is split across reads, the same command lines come out"""
+    rng = random.Random(50)
+    for _ in range(ROUNDS):
+        lines = [random_line(rng) + rng.choice(["", "\r"]) for _ in range(rng.randint(1, 8))]
+        stream = "\n".join(lines).encode() + b"\n" + random_line(rng).encode()  # Ends mid-command
+        whole = Decoder().feed(stream)
+        decoder = Decoder()
+        # The first read must hold a newline, or it is a legacy unframed command
+        cut = stream.index(b"\n") + 1 + rng.randint(0, 4)
+        chunked = decoder.feed(stream[:cut])
+        while cut < len(stream):
+            step = rng.randint(1, 16)
+            chunked += decoder.feed(stream[cut:cut + step])
+            cut += step
+        assert chunked == whole
+        # Blank lines are dropped as bytes, so a line of only non-ASCII spaces survives to parse as ""
+        assert whole == [line.rstrip("\r") for line in lines if line.encode().strip()]
+
+
+def test_decoder_and_parser_never_raise_on_arbitrary_bytes():
+    rng = random.Random(51)
+    for _ in range(ROUNDS):
+        decoder = Decoder()
+        for _ in range(rng.randint(1, 4)):
+            for line in decoder.feed(bytes(rng.randrange(256) for _ in range(rng.randint(1, 64)))):
+                command = parse_command(line)
+                assert isinstance(command.name, str) and all(command.args)
+                command.well_formed()
+
+
+def test_decoder_refuses_an_endless_line(async_server_process):
+    """An unterminated command past MAX_LINE is an error, and the tracker drops its connection"""
+    decoder = Decoder()
+    assert decoder.feed(b"hbt\n" + b"x" * MAX_LINE) == ["hbt"]
+    with pytest.raises(ProtocolError):
+        decoder.feed(b"x")
+
+    with socket.create_connection(("127.0.0.1", ASYNC_SERVER_PORT), timeout=5) as sock:
+        sock.sendall(b"hbt\n" + b"x" * (MAX_LINE + 1024))
+        try:
+            assert sock.recv(1024) == b""
+        except ConnectionResetError:
+            pass  # Closed with our bytes still unread
+
+
+def test_parse_command_splits_once_and_round_trips():
+    rng = random.Random(52)
+    for _ in range(ROUNDS):
+        line = random_line(rng)
+        command = parse_command(line)
+        words = line.split()
+        assert command == (Command(words[0], words[1:]) if words else Command("", []))
+        if words:
+            assert parse_command(format_command(command.name, *command.args)) == command
+
+
+def test_well_formed_follows_arity():
+    assert not parse_command("auth hans").well_formed()
+    assert parse_command("auth hans pass with spaces").well_formed()
+    assert parse_command("pub notes.txt 1024").well_formed()
+    assert not parse_command("pub notes.txt 1024 extra").well_formed()
+    assert not parse_command("have part.iso 10 4").well_formed()
+    assert parse_command("hbt ignored").well_formed()
+    assert parse_command("unknown a b c").well_formed()  # Left for the dispatcher to refuse
+    assert set(EMPTY_LISTS) <= set(ARITY)
+
+
+def test_list_and_page_replies_round_trip():
+    rng = random.Random(53)
+    for _ in range(ROUNDS):
+        name = rng.choice(sorted(EMPTY_LISTS))
+        items = [random_word(rng) for _ in range(rng.randint(0, 5))]
+        cursor = rng.choice([None, random_word(rng, string.hexdigits)])
+        assert parse_list(list_reply(name, items)) == items
+        assert parse_page(page_reply(name, cursor, items), name) == Page(items, cursor)
+    assert parse_page("lap ERR\n", "lap") is None
+    assert busy_delay(busy_reply(0.25, True)) == busy_delay(busy_reply(0.25, False)) == 0.25
+    assert busy_delay("sch BUSY") is None
+
+
+def test_servers_answer_malformed_and_unknown_commands_alike(async_server_process, tmp_path):
+    """server.py and server_async.py parse through the same module, so refusals match"""
+    rng = random.Random(54)
+    commands = ["auth", "port", "get", "pub", "unp", "sch", "  get  ", "\tpub"]
+    while len(commands) < 40:
+        word = random_word(rng, string.ascii_lowercase + "_")
+        if word not in ARITY:
+            commands.append(" ".join([word] + [random_word(rng) for _ in range(rng.randint(0, 3))]))
+    rng.shuffle(commands)
+
+    port = free_port()
+    shutil.copy(os.path.join(REPO_ROOT, "credentials.example.txt"), tmp_path / "credentials.txt")
+    legacy = subprocess.Popen(["python3", os.path.join(REPO_ROOT, "server.py"), str(port)],
+                              cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+    replies = []
+    try:
+        for server_port in (port, ASYNC_SERVER_PORT):
+            with socket.create_connection(("127.0.0.1", server_port), timeout=5) as sock:
+                answers = []
+                for command in commands:
+                    sock.sendall(command.encode())
+                    answers.append(sock.recv(1024).decode())
+                replies.append(answers)
+    finally:
+        legacy.terminate()
+        legacy.wait()
+
+    assert replies[0] == replies[1]
+    assert "INPUT_ERR" in replies[0] and "sch No files found" in replies[0]
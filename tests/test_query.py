@@ -0,0 +1,139 @@
+"""
+Test the tracker's file query engine
+"""
+import time
+
+import pytest
+
+from query import BULK_UPDATE, FileIndex, QueryError, RegexWorker, parse_query, regex_literal
+
+
+def make_index(names):
+    index = FileIndex()
+    for name in names:
+        index.add(name)
+    return index
+
+
+def test_pattern_kinds():
+    """Patterns should be classified as substring, prefix, glob or regex"""
+    assert parse_query("report").kind == "substring"
+    assert parse_query("rep*")[:2] == ("prefix", "rep")
+    assert parse_query("*.pdf").kind == "glob"
+    assert parse_query("re:^a.*z$")[:2] == ("regex", "^a.*z$")
+
+
+def test_filters():
+    query = parse_query("x", ["size:>1m", "owner:yoda", "limit:5"])
+    assert (query.min_size, query.max_size, query.owner, query.limit) == (1024 ** 2, None, "yoda", 5)
+    assert parse_query("x", ["size:10k-20k"])[2:4] == (10 * 1024, 20 * 1024)
+    assert not query.accepts({"yoda"}, None)
+    assert query.accepts({"yoda", "hans"}, 2 * 1024 ** 2)
+    with pytest.raises(QueryError):
+        parse_query("x", ["colour:red"])
+
+
+def test_expensive_or_invalid_regex_rejected():
+    with pytest.raises(QueryError):
+        parse_query("re:(a+)+$")
+    with pytest.raises(QueryError):
+        parse_query("re:(unclosed")
+    with pytest.raises(QueryError):
+        parse_query("a" * 200)
+    for pattern in ["(a|a)*b", "(?:a|ab)+$", "(x(a*))*", "(a|b){2,}"]:
+        with pytest.raises(QueryError):
+            parse_query(f"re:{pattern}")
+    for pattern in ["(a|b)?c", "(abc)+", "[(|*)]+", "^data_[0-9]+\\.bin$"]:
+        assert parse_query(f"re:{pattern}").kind == "regex"
+
+
+def test_regex_literal_is_required_by_every_match():
+    """Regexes are narrowed by the trigram index only on a literal no match can lack"""
+    assert regex_literal("^draft_.*\\.md$") == "draft_"
+    assert regex_literal("abc?def") == "def"
+    assert regex_literal("(abc)+xyz") == "xyz"
+    assert regex_literal("re+port") == "port"
+    assert regex_literal("foo\\dbar") == "foo"
+    for pattern in ["a|bcd", "(?i)abcdef", "[abc]+", "x.y"]:
+        assert len(regex_literal(pattern)) < 3
+    index = make_index(["draft_one.md", "draft_two.txt", "notes.md"])
+    assert sorted(index.regex_candidates("^draft_.*\\.md$")) == ["draft_one.md", "draft_two.txt"]
+    assert sorted(index.regex_candidates("\\.md$")) == ["draft_one.md", "notes.md"]
+    assert index.regex_candidates("x.y") is None
+
+def test_regex_worker_kills_a_scan_that_overruns():
+    """A slow regex is cut off at the worker's timeout, and the next scan gets a fresh worker"""
+    worker = RegexWorker(timeout=0.5)
+    try:
+        worker.start()
+        assert worker.scan("port\\.", ["report.pdf", "notes.md"]) == ["report.pdf"]
+        started = time.perf_counter()
+        with pytest.raises(QueryError):
+            worker.scan("a*a*a*a*a*a*a*b", ["a" * 255])  # Polynomial, and well past any budget
+        assert time.perf_counter() - started < 2
+        assert worker.scan("^a+$", ["a" * 1000]) == ["a" * 1000]  # Matched on its first 255 characters
+    finally:
+        worker.stop()
+
+
+def test_regex_worker_scans_its_copy_of_the_index():
+    """A mirrored worker answers from names it was sent as they changed, and needs a reseed after a kill"""
+    worker = RegexWorker(timeout=0.5)
+    index = FileIndex()
+    index.mirror = worker
+    try:
+        worker.start()
+        index.add("before_seed.txt")
+        assert worker.needs_seed
+        with pytest.raises(QueryError):
+            worker.scan("txt$")
+        worker.reseed(list(index.names))
+        index.add_many([f"mirrored_{i:03}.txt" for i in range(2 * BULK_UPDATE)])
+        index.remove("mirrored_000.txt")
+        assert sorted(worker.scan("^mirrored_00")) == [f"mirrored_00{i}.txt" for i in range(1, 10)]
+        assert worker.scan("seed") == ["before_seed.txt"]
+        assert worker.scan("seed", ["reseeded.txt"]) == ["reseeded.txt"]  # Given names replace the copy
+        
+        index.add("a" * 255)
+        with pytest.raises(QueryError):
+            worker.scan("a*a*a*a*a*a*a*b")
+        assert worker.needs_seed
+        worker.reseed(list(index.names))
+        assert worker.scan("^a+$") == ["a" * 255]
+    finally:
+        worker.stop()
+
+def test_index_matches_each_kind():
+    """Indexed lookups should return exactly the names the pattern matches"""
+    names = ["report.pdf", "annual_report.pdf", "rep.txt", "notes.md", "xreportx", "re"]
+    index = make_index(names)
+    for pattern in ["report", "re", "rep*", "*.pdf", "rep?.*", "re:port\\.", "zzz"]:
+        query = parse_query(pattern)
+        matches = query.matcher()
+        assert sorted(index.match(query)) == sorted(name for name in names if matches(name))
+    
+    index.remove("report.pdf")
+    assert sorted(index.match(parse_query("report"))) == ["annual_report.pdf", "xreportx"]
+    assert "rep" in index.grams and "pdf" in index.grams
+
+
+def test_bulk_updates_match_single_ones():
+    """add_many/remove_many past BULK_UPDATE leave the same index as adding and removing one by one"""
+    names = [f"bulk_{i:04}.bin" for i in range(3 * BULK_UPDATE)]
+    single, bulk = make_index(names[::2]), make_index(names[::2])
+    for name in names:
+        single.add(name)
+    bulk.add_many(names)
+    assert bulk.names == single.names == sorted(names) and bulk.grams == single.grams
+    for name in names[::3] + ["missing.bin"]:
+        single.remove(name)
+    bulk.remove_many(names[::3] + ["missing.bin"])
+    assert bulk.names == single.names and bulk.grams == single.grams
+    assert list(bulk.containing("_0004")) == ["bulk_0004.bin"] and list(bulk.containing("_0003")) == []
+
+def test_ranking_prefers_exact_then_prefix_then_word_start():
+    query = parse_query("report")
+    names = ["xreportx", "annual_report.pdf", "report", "report.pdf"]
+    assert sorted(names, key=query.rank) == ["report", "report.pdf", "annual_report.pdf", "xreportx"]
+    # Better-seeded files win among equally good matches
+    assert query.rank("report_a", owners=3) < query.rank("report_b", owners=1)
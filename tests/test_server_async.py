@@ -0,0 +1,513 @@
+"""
+Test server_async.py tracker state across connections and restarts
+"""
+import asyncio
+import json
+import socket
+import sqlite3
+import time
+
+import pytest
+
+import server_async
+from metrics import StallWatchdog
+from recording import load_recording
+from server_async import (MAX_PAGE_BYTES, WRITE_STALL_TIMEOUT, PeerRecord, PublicationIndex, PublicationStore,
+                          heartbeat_overdue, page_after)
+from tests.conftest import ASYNC_SERVER_PORT, start_async_server
+from tracker_client import TrackerClient
+
+RESTART_PORT = 12002
+UDP_HEARTBEAT_PORT = 12003
+ADMISSION_PORT = 12004
+METRICS_TRACKER_PORT = 12005
+METRICS_PORT = 12006
+ADMIN_TRACKER_PORT = 12007
+ADMIN_PORT = 12008
+RECORD_PORT = 12009
+STALLED_READER_PORT = 12010
+
+
+def test_publications_survive_restart(tmp_path):
+    """Publications should be restored, dormant, and reactivated when their owner returns"""
+    async def publish():
+        async with TrackerClient("127.0.0.1", RESTART_PORT) as client:
+            await client.auth("hans", "falcon*solo")
+            await client.pub("durable.txt")
+            await client.pub("withdrawn.txt")
+            await client.unp("withdrawn.txt")
+    
+    async def after_restart():
+        async with TrackerClient("127.0.0.1", RESTART_PORT) as owner, \
+                   TrackerClient("127.0.0.1", RESTART_PORT) as other:
+            await other.auth("yoda", "wise@!man")
+            dormant = await other.sch("txt")
+            await owner.auth("hans", "falcon*solo")
+            return dormant, await owner.lpf(), await other.sch("txt")
+    
+    proc = start_async_server(tmp_path, RESTART_PORT)
+    try:
+        asyncio.run(publish())
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    proc = start_async_server(tmp_path, RESTART_PORT)
+    try:
+        dormant, owned, live = asyncio.run(after_restart())
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    assert dormant == []
+    assert owned == ["durable.txt"]
+    assert live == ["durable.txt"]
+
+
+def test_search_ignores_disconnected_publishers(async_server_process):
+    """Files of a peer that left should not be offered until it returns"""
+    async def scenario():
+        async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as searcher:
+            await searcher.auth("vader", "sithlord**")
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as publisher:
+                await publisher.auth("leia", "$blasterpistol$")
+                await publisher.register_port(45002)
+                await publisher.pub("leaving.txt")
+                assert await searcher.sch("leaving") == ["leaving.txt"]
+            assert await searcher.sch("leaving") == []
+            assert await searcher.get("leaving.txt") is None
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as publisher:
+                await publisher.auth("leia", "$blasterpistol$")
+                assert await searcher.sch("leaving") == ["leaving.txt"]
+    asyncio.run(scenario())
+
+
+def test_failed_auth_owns_nothing(async_server_process):
+    """After a failed or missing auth, commands that change a user's files are refused"""
+    async def scenario():
+        async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as anonymous, \
+                   TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as impostor:
+            assert await anonymous.request("pub unsigned.txt") == "pub ERR"
+            assert await impostor.request("auth yoda not-the-password") == "auth ERR"
+            assert await impostor.request("pub stolen.txt") == "pub ERR"
+            assert await impostor.request("have stolen.txt 4096 1024 f0") == "have ERR"
+            assert await impostor.request("wdr stolen.txt") == "wdr ERR"
+            assert await impostor.request("port 45009") == "port ERR"
+            assert await impostor.request("unp stolen.txt") == "unp ERR"
+        async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as owner:
+            await owner.auth("yoda", "wise@!man")
+            assert "stolen.txt" not in await owner.lpf()
+            assert await owner.src("stolen.txt") == []
+    asyncio.run(scenario())
+
+def test_commands_count_as_heartbeats(async_server_process):
+    """A client that keeps issuing commands should stay active without sending hbt"""
+    async def scenario():
+        async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as busy, \
+                   TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as observer:
+            await busy.auth("r2d2", "do*!@#dedo")
+            await observer.auth("c3p0", "droid#gold")
+            assert busy.piggyback and busy.heartbeat_interval == 2
+            busy._heartbeat_task.cancel()
+            for _ in range(5):
+                await asyncio.sleep(1)
+                await busy.lpf()
+            assert "r2d2" in await observer.lap()
+    asyncio.run(scenario())
+
+
+def test_udp_heartbeats_keep_session_alive(tmp_path):
+    """With --udp-heartbeat, datagrams alone should keep an idle client active"""
+    proc = start_async_server(tmp_path, UDP_HEARTBEAT_PORT, "--udp-heartbeat")
+    
+    async def scenario():
+        async with TrackerClient("127.0.0.1", UDP_HEARTBEAT_PORT, udp_heartbeats=True) as idle, \
+                   TrackerClient("127.0.0.1", UDP_HEARTBEAT_PORT) as observer:
+            await idle.auth("r2d2", "do*!@#dedo")
+            await observer.auth("c3p0", "droid#gold")
+            assert idle._udp is not None
+            await asyncio.sleep(4.5)
+            assert "r2d2" in await observer.lap()
+            # Forged keys are ignored
+            idle._udp_key = "forged"
+            await asyncio.sleep(4.5)
+            assert "r2d2" not in await observer.lap()
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_admission_control(tmp_path):
+    """Connections past the cap are refused, floods are shed, and stalled readers are evicted"""
+    proc = start_async_server(tmp_path, ADMISSION_PORT, "--max-connections", "3",
+                              "--rate-limit-scale", "0.1", "--write-buffer-limit", "65536")
+    
+    async def scenario():
+        # Connection cap
+        connections = [await asyncio.open_connection("127.0.0.1", ADMISSION_PORT) for _ in range(3)]
+        reader, writer = await asyncio.open_connection("127.0.0.1", ADMISSION_PORT)
+        assert await asyncio.wait_for(reader.read(100), 5) == b""
+        for _, held in connections:
+            held.close()
+        await asyncio.sleep(0.5)
+        
+        # A legacy client flooding lap is told to back off once its burst is spent
+        reader, writer = await asyncio.open_connection("127.0.0.1", ADMISSION_PORT)
+        writer.write(b"auth hans falcon*solo")
+        assert await reader.read(100) == b"auth OK"
+        replies = []
+        for _ in range(30):
+            writer.write(b"lap")
+            replies.append(await reader.read(100))
+        assert replies[0].startswith(b"lap") and any(reply.startswith(b"BUSY ") for reply in replies)
+        writer.close()
+        
+        # The SDK waits out BUSY replies instead of failing
+        async with TrackerClient("127.0.0.1", ADMISSION_PORT) as client:
+            await client.auth("yoda", "wise@!man")
+            for _ in range(25):
+                await client.lap()
+        
+        # Unknown commands are shed from their own bucket, leaving the query budget alone
+        reader, writer = await asyncio.open_connection("127.0.0.1", ADMISSION_PORT)
+        writer.write(b"auth r2d2 do*!@#dedo")
+        assert await reader.read(100) == b"auth OK"
+        for _ in range(30):
+            writer.write(b"nosuchcommand")
+            await reader.read(100)  # INPUT_ERR, or BUSY once that burst is spent
+        writer.write(b"lap")
+        assert (await reader.read(100)).startswith(b"lap")
+        writer.close()
+        
+        # A reply larger than the buffer limit and the socket buffers still reaches a client reading it
+        async with TrackerClient("127.0.0.1", ADMISSION_PORT) as client:
+            await client.auth("vader", "sithlord**")
+            names = [f"big_{i:02}_{'x' * 60000}.txt" for i in range(80)]  # About 5 MB of lpf
+            for name in names:
+                await client.pub(name)
+            assert sorted(await client.lpf()) == names
+        
+        # A client that never reads its responses is disconnected
+        reader, writer = await asyncio.open_connection("127.0.0.1", ADMISSION_PORT, limit=4096)
+        writer.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        writer.write(b"auth leia $blasterpistol$\n")
+        writer.transport.pause_reading()
+        try:
+            for _ in range(200):
+                writer.write(b"tok\n" * 1000)  # 200k replies, several MB if all were delivered
+                await writer.drain()
+        except ConnectionError:
+            pass
+        await asyncio.sleep(WRITE_STALL_TIMEOUT + 1)
+        writer.transport.resume_reading()
+        received = 0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                received += len(data)
+        except ConnectionError:
+            pass
+        assert received < 1024 * 1024
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_stalled_reader_does_not_hold_up_others(tmp_path):
+    """Replies queued for a client that stopped reading are not waited on while other clients are served"""
+    proc = start_async_server(tmp_path, STALLED_READER_PORT, "--rate-limit-scale", "0")
+    
+    async def scenario():
+        name = f"wide_{'x' * 60000}.bin"
+        async with TrackerClient("127.0.0.1", STALLED_READER_PORT) as seeder, \
+                   TrackerClient("127.0.0.1", STALLED_READER_PORT) as observer:
+            await seeder.auth("yoda", "wise@!man")
+            await seeder.register_port(45000)
+            await seeder.pub(name)
+            await observer.auth("vader", "sithlord**")
+            
+            reader, writer = await asyncio.open_connection("127.0.0.1", STALLED_READER_PORT, limit=4096)
+            writer.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            writer.write(b"auth leia $blasterpistol$\n")
+            writer.transport.pause_reading()
+            writer.write(f"get {name}\n".encode() * 200)  # About 12 MB of replies, never read
+            
+            slowest = 0.0
+            deadline = time.monotonic() + WRITE_STALL_TIMEOUT + 1
+            while time.monotonic() < deadline:
+                started = time.monotonic()
+                assert "yoda" in await observer.lap()
+                slowest = max(slowest, time.monotonic() - started)
+                await asyncio.sleep(0.05)
+            writer.close()
+            return slowest
+    
+    try:
+        assert asyncio.run(scenario()) < 1
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def owners_by_name(index: PublicationIndex, table: dict) -> dict:
+    return {filename: index.usernames(owners) for filename, owners in table.items()}
+
+
+class TestPublicationIndex:
+    """Live/dormant split of published files"""
+    
+    def test_disconnect_hides_files_until_reconnect(self):
+        index = PublicationIndex()
+        index.activate("hans")
+        index.activate("yoda")
+        index.publish("shared.txt", "hans")
+        index.publish("shared.txt", "yoda")
+        index.publish("solo.txt", "hans")
+        
+        index.deactivate("hans")
+        assert owners_by_name(index, index.live) == {"shared.txt": {"yoda"}}
+        assert owners_by_name(index, index.dormant) == {"shared.txt": {"hans"}, "solo.txt": {"hans"}}
+        assert index.files_of("hans") == {"shared.txt", "solo.txt"}
+        
+        index.activate("hans")
+        assert owners_by_name(index, index.live) == {"shared.txt": {"hans", "yoda"}, "solo.txt": {"hans"}}
+        assert index.dormant == {}
+    
+    def test_loaded_publications_start_dormant(self):
+        index = PublicationIndex()
+        index.load({"hans": {"a.txt"}, "yoda": {"a.txt", "b.txt"}})
+        assert index.live == {}
+        index.activate("yoda")
+        assert index.live_owners("a.txt") == {"yoda"}
+        assert index.live_owners("b.txt") == {"yoda"}
+    
+    def test_single_owner_is_stored_as_peer_id(self):
+        index = PublicationIndex()
+        index.activate("hans")
+        index.activate("yoda")
+        index.publish("a.txt", "hans")
+        assert isinstance(index.live["a.txt"], int)
+        index.publish("a.txt", "yoda")
+        assert index.owner_count("a.txt") == 2 and index.owns("a.txt", "yoda")
+        index.unpublish("a.txt", "yoda")
+        assert isinstance(index.live["a.txt"], int)
+        assert index.live_owners("a.txt") == {"hans"} and not index.owns("a.txt", "yoda")
+    
+    def test_unpublish_while_dormant(self):
+        index = PublicationIndex()
+        index.load({"hans": {"a.txt"}})
+        assert index.unpublish("a.txt", "hans")
+        assert not index.unpublish("a.txt", "hans")
+        index.activate("hans")
+        assert index.live == {} and index.dormant == {} and index.by_user == {}
+    
+    def test_publish_without_owner_changes_nothing(self):
+        index = PublicationIndex()
+        with pytest.raises(ValueError):
+            index.publish("orphan.txt", None)
+        assert index.by_user == {} and index.live == {} and index.dormant == {} and index.peer_ids.names == []
+
+
+def test_page_after_caps_page_bytes():
+    """Pages should stop at MAX_PAGE_BYTES and resume after their last name"""
+    names = [f"{i:04}" + "x" * 1000 for i in range(100)]
+    collected, cursor = [], None
+    while True:
+        page, next_cursor = page_after(reversed(names), cursor, 100)
+        assert 0 < len(page) < 100 and sum(len(name) + 1 for name in page) <= MAX_PAGE_BYTES
+        collected += page
+        if next_cursor is None:
+            break
+        cursor = bytes.fromhex(next_cursor).decode()
+    assert collected == names
+
+
+def test_publication_store_requeues_a_failed_batch(tmp_path):
+    """A batch the database refuses is kept, and newer changes to the same rows win on retry"""
+    db_path = str(tmp_path / "server.db")
+    schema = 'CREATE TABLE publications (filename TEXT, username TEXT, PRIMARY KEY (filename, username))'
+    sqlite3.connect(db_path).execute(schema).connection.close()
+    
+    async def scenario():
+        store = PublicationStore(db_path)
+        await store.open()
+        store.add("kept.txt", "hans")
+        store.add("dropped.txt", "hans")
+        await store.run_db(store.conn.execute, 'DROP TABLE publications')
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        store.remove("dropped.txt", "hans")
+        await store.run_db(store.conn.execute, schema)
+        await store.close()
+    
+    asyncio.run(scenario())
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT filename, username FROM publications').fetchall() == [("kept.txt", "hans")]
+
+
+def test_loop_stall_does_not_expire_waiting_heartbeats(monkeypatch):
+    """A client whose heartbeats sat unread while the loop was stalled is not expired; a silent one is"""
+    watchdog = StallWatchdog(server_async.loop_stalls, threshold=0.2, log=lambda line: None)
+    monkeypatch.setattr(server_async, "stall_watchdog", watchdog)
+    
+    async def scenario():
+        task = asyncio.create_task(watchdog.run(poll=0.02))
+        await asyncio.sleep(0.1)
+        waiting, silent = PeerRecord(None, ("127.0.0.1", 1)), PeerRecord(None, ("127.0.0.1", 2))
+        waiting.interval = silent.interval = 0.4  # Expired after 0.6 s without a heartbeat
+        silent.heartbeat -= 1.0
+        time.sleep(1.0)  # The stall: waiting's heartbeats are in its socket, but nothing reads them
+        now = time.time()  # Judged as check_heartbeat would be, before the loop reads anything
+        overdue = heartbeat_overdue(waiting, now), heartbeat_overdue(silent, now)
+        task.cancel()
+        return overdue
+    
+    assert asyncio.run(scenario()) == (False, True)
+
+
+async def http_get(port: int, path: str, token: str = None) -> tuple:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    authorization = f"Authorization: Bearer {token}\r\n" if token else ""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n{authorization}\r\n".encode())
+    head, _, body = (await reader.read()).decode().partition("\r\n\r\n")
+    writer.close()
+    return head.split()[1], body
+
+
+def test_metrics_endpoint(tmp_path):
+    """--metrics-port serves per-command latency, connection and lock metrics, and traces and profiles
+    to holders of the admin token
+    """
+    proc = start_async_server(tmp_path, METRICS_TRACKER_PORT, "--metrics-port", str(METRICS_PORT),
+                              "--trace-sample", "1")
+    token = (tmp_path / "admin.token").read_text().strip()
+    
+    async def scenario():
+        async with TrackerClient("127.0.0.1", METRICS_TRACKER_PORT) as client:
+            await client.auth("hans", "falcon*solo")
+            await client.pub("metered.txt")
+            await client.sch("metered")
+            for path in ("/debug/traces", "/debug/profile?seconds=0.2", "/debug/allocations?seconds=0.2"):
+                assert (await http_get(METRICS_PORT, path))[0] == "401"
+                assert (await http_get(METRICS_PORT, path, "not-the-token"))[0] == "401"
+            return (await http_get(METRICS_PORT, "/metrics"), await http_get(METRICS_PORT, "/debug/traces", token),
+                    await http_get(METRICS_PORT, "/debug/profile?seconds=0.2", token),
+                    await http_get(METRICS_PORT, "/debug/profile?seconds=999", token))
+    
+    try:
+        (status, body), (trace_status, traces), (profile_status, profile), (bad_status, _) = asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    assert status == "200"
+    assert 'tracker_command_duration_seconds_count{command="sch"} 1' in body
+    assert 'tracker_command_duration_seconds_count{command="pub"} 1' in body
+    assert "tracker_open_connections 1" in body
+    assert "tracker_active_clients 1" in body
+    assert "tracker_published_files 1" in body
+    assert "tracker_state_lock_wait_seconds_count" in body
+    assert "# TYPE tracker_event_loop_lag_seconds histogram" in body
+    
+    assert trace_status == "200"
+    sch = [json.loads(line) for line in traces.splitlines() if '"sch"' in line]
+    assert sch and sch[0]["user"] == "hans"
+    assert sch[0]["total_ms"] >= sch[0]["lock_ms"] + sch[0]["write_ms"]
+    assert profile_status == "200" and "function calls" in profile
+    assert bad_status == "400"
+
+
+def test_admin_channel(tmp_path):
+    """The admin port needs the token, reports live stats and can evict a peer"""
+    proc = start_async_server(tmp_path, ADMIN_TRACKER_PORT, "--admin-port", str(ADMIN_PORT))
+    token = (tmp_path / "admin.token").read_text().strip()
+    
+    async def admin(*commands, secret=token):
+        reader, writer = await asyncio.open_connection("127.0.0.1", ADMIN_PORT)
+        replies = []
+        for command in (f"auth {secret}",) + commands:
+            writer.write(f"{command}\n".encode())
+            line = (await reader.readline()).decode().rstrip("\n")
+            replies.append(line)
+            if line == "auth ERR":
+                break
+        writer.close()
+        return replies
+    
+    def payload(reply: str):
+        return json.loads(reply.split(" ", 1)[1])
+    
+    async def scenario():
+        async with TrackerClient("127.0.0.1", ADMIN_TRACKER_PORT) as owner, \
+                   TrackerClient("127.0.0.1", ADMIN_TRACKER_PORT) as other:
+            await owner.auth("hans", "falcon*solo")
+            await owner.register_port(45010)
+            await owner.pub("popular.txt")
+            await owner.pub("quiet.txt")
+            await other.auth("yoda", "wise@!man")
+            await other.get("popular.txt")
+            await other.get("popular.txt")
+            for _ in range(3):
+                await other.get("never_published.txt")  # Not counted as a hot file
+            refused = await admin("stats", secret="wrong")
+            before = await admin("stats", "conns 1", "publishers", "hot 5", "evict hans", "evict hans")
+            await asyncio.sleep(0.2)
+            after = await admin("stats")
+            malformed = await admin("hot \u00b2", "hot -1", "conns " + "9" * 70000)
+            return refused, before, after, malformed, await other.sch("txt")
+    
+    try:
+        refused, before, after, malformed, remaining = asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    assert refused == ["auth ERR"]
+    auth, stats, conns, publishers, hot, evicted, again = before
+    assert auth == "auth OK"
+    assert payload(stats)["authenticated"] == 2 and payload(stats)["live_files"] == 2
+    assert payload(conns)[0]["user"] in ("hans", "yoda") and payload(conns)[0]["bytes_in"] > 0
+    assert payload(publishers) == [["hans", 2]]
+    assert payload(hot) == [["popular.txt", 2]]
+    assert evicted == "evict OK" and again.startswith("evict ERR")
+    assert payload(after[1])["authenticated"] == 1
+    assert malformed == ["auth OK", "hot ERR usage: hot [N]", "hot ERR usage: hot [N]", "ERR line too long"]
+    assert remaining == []
+
+
+def test_record_hashes_names_and_drops_credentials(tmp_path):
+    """--record writes every command with its timing, but no filename, password or token"""
+    proc = start_async_server(tmp_path, RECORD_PORT, "--record", str(tmp_path / "traffic.jsonl"))
+    
+    async def scenario():
+        async with TrackerClient("127.0.0.1", RECORD_PORT) as owner, \
+                   TrackerClient("127.0.0.1", RECORD_PORT) as other:
+            await owner.auth("hans", "falcon*solo")
+            await owner.pub("deathstar_plans.pdf")
+            await other.auth("yoda", "wise@!man")
+            await other.sch("deathstar_plans.pdf owner:hans")
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+    
+    text = (tmp_path / "traffic.jsonl").read_text()
+    for secret in ("deathstar", "falcon", "wise@", "hans", "yoda"):
+        assert secret not in text
+    records = [record for record in load_recording(str(tmp_path / "traffic.jsonl"))
+               if record["cmd"] in ("auth", "pub", "sch")]  # The SDK also sends tok and hbi after auth
+    assert [record["cmd"] for record in records] == ["auth", "pub", "auth", "sch"]
+    auth, pub, _, sch = records
+    assert auth["user"] == pub["user"] == 0 and auth["args"] == []
+    assert sch["args"] == [pub["args"][0], "owner:0"]  # Same name, same hash; owners map to user numbers
+    assert sch["out"] > 0 and sch["ms"] > 0 and sch["conn"] != pub["conn"]
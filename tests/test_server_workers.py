@@ -0,0 +1,64 @@
+"""
+Test server.py --workers: the selectors loop and bounded pool behind the legacy protocol
+"""
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from tests.conftest import REPO_ROOT
+
+USERS = [("hans", "falcon*solo"), ("yoda", "wise@!man"), ("vader", "sithlord**"), ("leia", "$blasterpistol$")]
+
+
+def free_port() -> int:
+    """server.py has no SO_REUSEADDR, so a fixed port would sit in TIME_WAIT between runs"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def request(sock, message: str) -> str:
+    sock.sendall(message.encode())
+    return sock.recv(1024).decode()
+
+
+def test_worker_pool_serves_more_clients_than_threads(tmp_path):
+    """Four clients on two workers each get their replies, in order, from one process with few threads"""
+    port = free_port()
+    shutil.copy(os.path.join(REPO_ROOT, "credentials.example.txt"), tmp_path / "credentials.txt")
+    proc = subprocess.Popen(
+        ["python3", os.path.join(REPO_ROOT, "server.py"), str(port), "--workers", "2"],
+        cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    time.sleep(1)
+    replies = {}
+
+    def client(username: str, password: str):
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            replies[username] = [
+                request(sock, f"auth {username} {password}"),
+                request(sock, f"pub {username}_notes.txt"),
+                request(sock, "lpf"),
+                request(sock, "xit"),
+            ]
+
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as idle:
+            threads = [threading.Thread(target=client, args=user) for user in USERS]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert request(idle, "foo") == "INPUT_ERR"  # An idle connection is still served
+        with open(f"/proc/{proc.pid}/status") as status:
+            server_threads = next(int(line.split()[1]) for line in status if line.startswith("Threads:"))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    for username, _ in USERS:
+        assert replies[username] == ["auth OK", "pub OK", f"lpf {username}_notes.txt", "xit"]
+    assert server_threads <= 4  # Main, heartbeat checker and the two workers
@@ -0,0 +1,262 @@
+"""
+Test the async tracker SDK against server_async.py
+"""
+import asyncio
+import pytest
+
+from tests.conftest import ASYNC_SERVER_PORT
+from tracker_client import AuthError, PeerAddress, TrackerClient, TrackerError, TrackerPool
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestTrackerClient:
+    """Typed protocol methods"""
+    
+    def test_auth_failure_raises(self, async_server_process):
+        """Wrong password should raise AuthError"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client:
+                with pytest.raises(AuthError):
+                    await client.auth("hans", "wrongpassword")
+        run(scenario())
+    
+    def test_publish_search_get(self, async_server_process):
+        """A file published by one client should be found and located by another"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as seeder, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as leecher:
+                await seeder.auth("yoda", "wise@!man")
+                await seeder.register_port(45000)
+                await seeder.pub("sdk_test.txt")
+                await leecher.auth("vader", "sithlord**")
+                
+                assert await seeder.lpf() == ["sdk_test.txt"]
+                assert "sdk_test.txt" in await leecher.sch("sdk_")
+                assert "yoda" in await leecher.lap()
+                assert await leecher.get("sdk_test.txt") == PeerAddress("127.0.0.1", 45000, "sdk_test.txt")
+                assert await leecher.get("missing.txt") is None
+                
+                await seeder.unp("sdk_test.txt")
+                assert await seeder.lpf() == []
+        run(scenario())
+    
+    def test_paginated_lists(self, async_server_process):
+        """lpf and sch should page through large result sets in name order"""
+        async def scenario():
+            names = [f"paged_{i:03}.txt" for i in range(250)]
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as seeder, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as searcher:
+                await seeder.auth("yoda", "wise@!man")
+                await searcher.auth("vader", "sithlord**")
+                for name in reversed(names):
+                    await seeder.pub(name)
+                try:
+                    first = await searcher.page("sch", "paged_", limit=100)
+                    assert first.items == names[:100] and first.cursor is not None
+                    second = await searcher.page("sch", "paged_", limit=100, cursor=first.cursor)
+                    assert second.items == names[100:200]
+                    assert [name async for name in searcher.iter_sch("paged_", page_size=100)] == names
+                    assert [name async for name in seeder.iter_lpf(page_size=7)] == names
+                    assert "yoda" in [peer async for peer in searcher.iter_lap(page_size=1)]
+                    
+                    # Stopping early leaves the connection usable
+                    async for name in searcher.iter_sch("paged_", page_size=10):
+                        break
+                    assert await searcher.page("sch", "no_such_file") == ([], None)
+                    with pytest.raises(TrackerError):
+                        await searcher.page("lap", limit=0)
+                finally:
+                    for name in names:
+                        await seeder.unp(name)
+        run(scenario())
+    
+    def test_long_unpaginated_reply_stays_in_step(self, async_server_process):
+        """A list reply far longer than one socket read is read whole, and the next reply is its own"""
+        async def scenario():
+            names = [f"long_{i:03}_{'x' * 1000}.txt" for i in range(100)]  # About 100 KB of lpf
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as searcher:
+                await client.auth("yoda", "wise@!man")
+                await searcher.auth("vader", "sithlord**")
+                for name in names:
+                    await client.pub(name)
+                try:
+                    assert sorted(await client.lpf()) == names
+                    assert await client.get("missing.txt") is None
+                    assert sorted(await searcher.sch("long_")) == names
+                finally:
+                    for name in names:
+                        await client.unp(name)
+        run(scenario())
+    
+    def test_search_queries(self, async_server_process):
+        """sch should accept globs, regexes and size/owner/limit filters"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as seeder, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as searcher:
+                await seeder.auth("yoda", "wise@!man")
+                await searcher.auth("vader", "sithlord**")
+                await seeder.pub("query_big.iso", 5 * 1024 ** 2)
+                await seeder.pub("query_small.txt", 10)
+                await seeder.pub("big_query.txt")
+                try:
+                    assert await searcher.sch("query_*") == ["query_big.iso", "query_small.txt"]
+                    assert await searcher.sch("query", "size:>1m") == ["query_big.iso"]
+                    assert await searcher.sch("re:^query_.*txt$", "owner:yoda") == ["query_small.txt"]
+                    assert await searcher.sch("query", "owner:hans") == []
+                    assert await searcher.sch("query", "limit:1") == ["query_big.iso"]
+                    assert "big_query.txt" in [name async for name in searcher.iter_sch("*.txt")]
+                    with pytest.raises(TrackerError):
+                        await searcher.sch("re:(a+)+")
+                finally:
+                    for name in ("query_big.iso", "query_small.txt", "big_query.txt"):
+                        await seeder.unp(name)
+        run(scenario())
+    
+    def test_heartbeats_keep_session_alive(self, async_server_process):
+        """An idle client should stay active past the server's heartbeat timeout"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT, heartbeat_interval=1) as idle, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as observer:
+                await idle.auth("r2d2", "do*!@#dedo")
+                await observer.auth("c3p0", "droid#gold")
+                await asyncio.sleep(4)
+                assert "r2d2" in await observer.lap()
+        run(scenario())
+    
+    def test_reconnect_restores_publications(self, async_server_process):
+        """A dropped connection should be restored with its publications"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client:
+                await client.auth("leia", "$blasterpistol$")
+                await client.pub("reconnect_test.txt")
+                client.writer.transport.abort()
+                assert await client.lpf() == ["reconnect_test.txt"]
+        run(scenario())
+
+    
+    def test_reconnect_resumes_session(self, async_server_process):
+        """A reconnect within the grace window should resume by token without re-publishing"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as other:
+                await client.auth("hans", "falcon*solo")
+                await client.register_port(45003)
+                await client.pub("resumed.txt")
+                await other.auth("yoda", "wise@!man")
+                token = client.session_token
+                assert token
+                
+                client._password = "no longer valid"  # Resumption must not need the password
+                client.published.clear()  # ...nor a replay of pub commands
+                client.writer.transport.abort()
+                assert await client.lpf() == ["resumed.txt"]
+                assert client.session_token == token
+                assert await other.get("resumed.txt") == PeerAddress("127.0.0.1", 45003, "resumed.txt")
+        run(scenario())
+    
+    def test_resume_rejects_unknown_token(self, async_server_process):
+        """A forged token should not resume anything"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client:
+                assert await client.request("rsm forged-token") == "rsm ERR"
+        run(scenario())
+    
+    def test_resume_refuses_another_users_session(self, async_server_process):
+        """A connection signed in as one user cannot take over another user's session"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as client, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as other:
+                await client.auth("r2d2", "do*!@#dedo")
+                await other.auth("c3p0", "droid#gold")
+                assert other.session_token
+                assert await client.request(f"rsm {other.session_token}") == "rsm ERR"
+                assert "r2d2" in await other.lap() and "c3p0" in await client.lap()
+        run(scenario())
+    
+    def test_partial_availability_listed_as_source(self, async_server_process):
+        """Pieces advertised with have should be offered to other downloaders by src"""
+        async def scenario():
+            async with TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as partial, \
+                       TrackerClient("127.0.0.1", ASYNC_SERVER_PORT) as downloader:
+                await partial.auth("luke", "light==saber")
+                await partial.register_port(45001)
+                await downloader.auth("obiwan", "(jedimaster)")
+                
+                assert await downloader.src("partial.bin") == []
+                await partial.have("partial.bin", 10 * 1024, 1024, b"\xa0\x00")
+                source, = await downloader.src("partial.bin")
+                assert (source.port, source.file_size, source.piece_size) == (45001, 10 * 1024, 1024)
+                assert [source.has_piece(i) for i in range(3)] == [True, False, True]
+                
+                await partial.withdraw("partial.bin")
+                assert await downloader.src("partial.bin") == []
+                
+                # Withdrawing partial pieces leaves a publication of the same name alone
+                await partial.pub("partial.bin")
+                await partial.have("partial.bin", 10 * 1024, 1024, b"\xa0\x00")
+                await partial.withdraw("partial.bin")
+                assert await partial.lpf() == ["partial.bin"] and "partial.bin" in partial.published
+                assert [source.bitmap for source in await downloader.src("partial.bin")] == [None]
+                await partial.unp("partial.bin")
+        run(scenario())
+
+
+class TestTrackerPool:
+    """Pooled connections"""
+    
+    def test_pool_serves_concurrent_requests(self, async_server_process):
+        """Concurrent requests should be spread over the pooled connections"""
+        async def scenario():
+            credentials = [("obiwan", "(jedimaster)"), ("luke", "light==saber")]
+            async with TrackerPool("127.0.0.1", ASYNC_SERVER_PORT, credentials) as pool:
+                results = await asyncio.gather(*(pool.lap() for _ in range(20)))
+            assert all("obiwan" in peers or "luke" in peers for peers in results)
+        run(scenario())
+
+
+class TestTLSResumption:
+    """Client-side TLS session reuse"""
+    
+    def test_second_connection_resumes_session(self, tmp_path):
+        """ResumableSSLContext should offer the remembered session on the next connect"""
+        import ssl
+        import subprocess
+        from tracker_client import ResumableSSLContext, open_connection
+        
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+             "-nodes", "-keyout", "server.key", "-out", "server.crt", "-days", "1", "-subj", "/CN=localhost"],
+            cwd=tmp_path, check=True, capture_output=True
+        )
+        
+        async def scenario():
+            server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_context.load_cert_chain(tmp_path / "server.crt", tmp_path / "server.key")
+            
+            async def echo(reader, writer):
+                writer.write(await reader.readline())
+                await writer.drain()
+                writer.close()
+            
+            server = await asyncio.start_server(echo, "127.0.0.1", 0, ssl=server_context)
+            port = server.sockets[0].getsockname()[1]
+            client_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            client_context.check_hostname = False
+            client_context.load_verify_locations(tmp_path / "server.crt")
+            
+            reused = []
+            for _ in range(2):
+                reader, writer = await open_connection("127.0.0.1", port, client_context)
+                writer.write(b"ping\n")
+                await reader.readline()
+                reused.append(writer.get_extra_info("ssl_object").session_reused)
+                client_context.remember(("127.0.0.1", port), writer)
+                writer.close()
+            server.close()
+            return reused
+        
+        assert run(scenario()) == [False, True]
@@ -0,0 +1,134 @@
+"""
+    Sampled command traces and on-demand profiling for the tracker
+    Usage: from tracing import Tracer, profile_window, allocation_window
+    coding: utf-8
+    Author: Danny Li
+"""
+import asyncio
+import collections
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from typing import Optional
+
+TRACE_SAMPLE_EVERY = 100  # Trace one command in this many; 0 turns tracing off
+TRACE_BUFFER_SIZE = 2048  # Newest traces kept; older ones are overwritten
+MAX_CAPTURE_SECONDS = 60
+PROFILE_ROWS = 40
+ALLOCATION_ROWS = 30
+
+# The trace of the command the current task is handling, so the lock and send paths can add to it
+current = contextvars.ContextVar("current_trace", default=None)
+capturing = False  # One profile or allocation window at a time
+
+################################################################################
+#################################### TRACES ####################################
+################################################################################
+
+class Trace:
+    """Where one command's time went: parse, state_lock wait, write/drain, and the handler itself"""
+    __slots__ = ("at", "command", "user", "parse", "lock", "write", "total")
+
+    def __init__(self, command: str, user: Optional[str]):
+        self.at = time.time()
+        self.command, self.user = command, user
+        self.parse = self.lock = self.write = self.total = 0.0
+
+    def as_dict(self) -> dict:
+        handler = max(0.0, self.total - self.parse - self.lock - self.write)
+        return {
+            "at": round(self.at, 3), "command": self.command, "user": self.user,
+            "total_ms": round(self.total * 1000, 3), "parse_ms": round(self.parse * 1000, 3),
+            "lock_ms": round(self.lock * 1000, 3), "handler_ms": round(handler * 1000, 3),
+            "write_ms": round(self.write * 1000, 3),
+        }
+
+
+class Tracer:
+    """Samples every Nth command into a fixed-size ring buffer"""
+
+    def __init__(self, sample_every: int = TRACE_SAMPLE_EVERY, capacity: int = TRACE_BUFFER_SIZE):
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.traces = collections.deque(maxlen=capacity)
+
+    def start(self, command: str, user: Optional[str]) -> Optional[Trace]:
+        """A Trace if this command is sampled, else None"""
+        if not self.sample_every:
+            return None
+        self.countdown -= 1
+        if self.countdown:
+            return None
+        self.countdown = self.sample_every
+        return Trace(command, user)
+
+    def finish(self, trace: Trace, total: float):
+        trace.total = total
+        self.traces.append(trace)
+
+    def dump(self) -> str:
+        """Buffered traces as JSON lines, oldest first"""
+        return "".join(json.dumps(trace.as_dict()) + "\n" for trace in list(self.traces))
+
+
+def add_lock_wait(seconds: float):
+    trace = current.get()
+    if trace is not None:
+        trace.lock += seconds
+
+################################################################################
+################################### PROFILING ##################################
+################################################################################
+
+def capture_seconds(params: dict, default: float = 10.0) -> float:
+    seconds = float(params.get("seconds", default))
+    if not 0 < seconds <= MAX_CAPTURE_SECONDS:
+        raise ValueError(f"seconds must be in (0, {MAX_CAPTURE_SECONDS}]")
+    return seconds
+
+
+async def profile_window(seconds: float, sort: str = "cumulative") -> str:
+    """cProfile the event loop thread for seconds and return the top functions"""
+    global capturing
+    if capturing:
+        raise RuntimeError("a capture is already running")
+    if sort not in ("cumulative", "tottime", "ncalls"):
+        raise ValueError("sort must be cumulative, tottime or ncalls")
+    capturing = True
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        capturing = False
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(PROFILE_ROWS)
+    return out.getvalue()
+
+
+async def allocation_window(seconds: float) -> str:
+    """Trace allocations for seconds and return the source lines whose memory grew most"""
+    global capturing
+    if capturing:
+        raise RuntimeError("a capture is already running")
+    capturing = True
+    started_here = not tracemalloc.is_tracing()
+    try:
+        if started_here:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current_size, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+        capturing = False
+    lines = [f"traced now {current_size / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB over {seconds:g}s"]
+    lines.extend(str(stat) for stat in after.compare_to(before, "lineno")[:ALLOCATION_ROWS])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,460 @@
+"""
+    Async client SDK for the P2P file sharing tracker
+    Usage: from tracker_client import TrackerClient, TrackerPool
+    coding: utf-8
+    Author: Danny Li
+"""
+import asyncio
+import contextlib
+import contextvars
+import ssl
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+# Reply types and parsers live in protocol, shared with the servers; they are re-exported from here
+from protocol import (NO_CURSOR, Page, PeerAddress, Source, busy_delay, format_command, frame, parse_command,
+                      parse_get, parse_list, parse_page, parse_sources)
+
+HEARTBEAT_INTERVAL = 2  # Used until the tracker says otherwise, and always against legacy trackers
+HEARTBEAT_REFRESH = 60  # Seconds between asking the tracker for its current heartbeat interval
+MAX_REPLY = 16 * 1024 * 1024  # Longest reply line read before the tracker is taken to be broken
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5
+PAGE_SIZE = 100  # Items per page when iterating lap/lpf/sch
+BUSY_RETRIES = 5  # Times a rate-limited command is retried, after the delay the tracker asks for
+
+################################################################################
+################################### TYPES ######################################
+################################################################################
+
+class TrackerError(Exception):
+    """Tracker rejected a request or the connection could not be restored"""
+
+
+class AuthError(TrackerError):
+    """Tracker rejected the supplied credentials"""
+
+
+class RateLimitedError(TrackerError):
+    """Tracker kept shedding a command under its rate limit"""
+
+################################################################################
+############################# TLS SESSION REUSE ################################
+################################################################################
+
+_session_endpoint = contextvars.ContextVar("tls_session_endpoint", default=None)
+
+
+class ResumableSSLContext(ssl.SSLContext):
+    """Client SSL context that offers each server the TLS session it issued last time.
+
+    asyncio.open_connection cannot take an SSLSession, so the session is injected
+    in wrap_bio, keyed by the endpoint that open_connection below is dialling.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sessions = {}  # {(host, port): ssl.SSLSession}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(_session_endpoint.get())
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember(self, endpoint: tuple, writer):
+        """Keep the connection's session (TLS 1.3 tickets arrive with the first response)"""
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[endpoint] = ssl_object.session
+
+
+async def open_connection(host: str, port: int, ssl_context=None, **kwargs):
+    """asyncio.open_connection that resumes TLS sessions when given a ResumableSSLContext"""
+    token = _session_endpoint.set((host, port))
+    try:
+        return await asyncio.open_connection(host, port, ssl=ssl_context, **kwargs)
+    finally:
+        _session_endpoint.reset(token)
+
+################################################################################
+############################### TRACKER CLIENT #################################
+################################################################################
+
+class TrackerClient:
+    """Single tracker connection with typed protocol methods, heartbeats and reconnects"""
+
+    def __init__(self, host: str, port: int, ssl_context=None,
+                 heartbeat_interval: Optional[float] = None,
+                 reconnect_attempts: int = RECONNECT_ATTEMPTS,
+                 reconnect_delay: float = RECONNECT_DELAY,
+                 udp_heartbeats: bool = False):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.max_heartbeat_interval = heartbeat_interval  # None follows the tracker's hbi
+        self.heartbeat_interval = heartbeat_interval or HEARTBEAT_INTERVAL
+        self.piggyback = False  # Whether the tracker counts any command as a heartbeat
+        self.udp_heartbeats = udp_heartbeats
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.reader = None
+        self.writer = None
+        self.username = None
+        self.upload_port = None
+        self.published = set()  # Live set of filenames, replayed after a reconnect
+        self.file_sizes = {}  # {"filename": bytes} sent with pub, and with its replay
+        self.session_token = None  # Lets a reconnect resume the session instead of re-authenticating
+        self.closed = False
+        self._password = None
+        self._lock = None
+        self._reconnect_lock = None
+        self._connection_id = 0
+        self._heartbeat_task = None
+        self._session_pending = False
+        self._last_beat = 0.0  # Loop time of the last command or heartbeat sent
+        self._next_refresh = 0.0
+        self._udp = None
+        self._udp_key = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Open the control connection to the tracker"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._reconnect_lock = asyncio.Lock()
+        self.reader, self.writer = await open_connection(self.host, self.port, self.ssl_context, limit=MAX_REPLY)
+        self._connection_id += 1
+        self._session_pending = isinstance(self.ssl_context, ResumableSSLContext)
+
+    async def close(self):
+        """Say goodbye to the tracker and release the connection"""
+        self.closed = True
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        if self.writer is None:
+            return
+        try:
+            if self.username:
+                await self._exchange("xit")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.writer.close()
+            with contextlib.suppress(ConnectionError, OSError):
+                await self.writer.wait_closed()
+            self.writer = None
+
+    ############################################################################
+    ################################ TRANSPORT #################################
+    ############################################################################
+
+    async def _send(self, message: str):
+        """Write one newline-framed command (caller holds the connection lock)"""
+        self.writer.write(frame(message))
+        self._last_beat = asyncio.get_event_loop().time()
+        await self.writer.drain()
+
+    async def _exchange(self, message: str) -> str:
+        """Send a command and wait for its single response, which the tracker newline-terminates.
+
+        Commands the tracker sheds with "BUSY <seconds>" are retried after that delay.
+        """
+        for _ in range(BUSY_RETRIES + 1):
+            async with self._lock:
+                await self._send(message)
+                try:
+                    data = (await self.reader.readuntil(b"\n"))[:-1]
+                except asyncio.IncompleteReadError:
+                    data = b""
+                except asyncio.LimitOverrunError:
+                    self.writer.close()  # The rest of the reply would be read as the next one's
+                    raise TrackerError(f"{message.split()[0]} reply longer than {MAX_REPLY} bytes")
+            if not data:
+                raise ConnectionResetError("tracker closed the connection")
+            if self._session_pending:
+                self._session_pending = False
+                self.ssl_context.remember((self.host, self.port), self.writer)
+            reply = data.decode()
+            retry_after = busy_delay(reply)
+            if retry_after is None:
+                return reply
+            await asyncio.sleep(retry_after)
+        raise RateLimitedError(f"tracker kept refusing {message.split()[0]}")
+
+    async def request(self, message: str) -> str:
+        """Send a raw command, reconnecting once if the connection drops"""
+        connection_id = self._connection_id
+        try:
+            return await self._exchange(message)
+        except (ConnectionError, OSError):
+            if self.username is None or self.closed:
+                raise
+        await self.reconnect(connection_id)
+        return await self._exchange(message)
+
+    async def reconnect(self, connection_id: Optional[int] = None):
+        """Re-open the connection and restore auth, upload port and publications"""
+        async with self._reconnect_lock:
+            if connection_id is not None and connection_id != self._connection_id:
+                return  # Another task already reconnected
+            if self.writer is not None:
+                self.writer.close()
+            delay = self.reconnect_delay
+            for attempt in range(self.reconnect_attempts):
+                try:
+                    await self.connect()
+                    if self.session_token and await self._exchange(format_command("rsm", self.session_token)) == "rsm OK":
+                        await self._negotiate_heartbeat()
+                        return  # Peer record, upload port and publications restored server-side
+                    self.session_token = None
+                    if await self._exchange(format_command("auth", self.username, self._password)) != "auth OK":
+                        raise ConnectionResetError("tracker refused re-authentication")
+                    self.session_token = await self._fetch_session_token()
+                    if self.upload_port is not None:
+                        await self._exchange(format_command("port", self.upload_port))
+                    for filename in list(self.published):
+                        await self._exchange(self._pub_command(filename))
+                    await self._negotiate_heartbeat()
+                    return
+                except (ConnectionError, OSError):
+                    if attempt == self.reconnect_attempts - 1:
+                        raise TrackerError(f"could not reconnect to {self.host}:{self.port}")
+                    await asyncio.sleep(delay)
+                    delay *= 2
+
+    async def _heartbeat(self):
+        """Keep the session alive, reconnecting if the connection has dropped.
+
+        Trackers that answer hbi count every command as a heartbeat, so against
+        them a beat is only sent after a full interval without other traffic.
+        """
+        loop = asyncio.get_event_loop()
+        while not self.closed:
+            # Datagrams can be lost, so UDP beats go out twice per interval
+            period = self.heartbeat_interval / 2 if self._udp is not None else self.heartbeat_interval
+            if self.piggyback:
+                await asyncio.sleep(max(0.0, self._last_beat + period - loop.time()))
+                if loop.time() - self._last_beat < period:
+                    continue  # Other traffic already proved we are alive
+            else:
+                await asyncio.sleep(period)
+            connection_id = self._connection_id
+            try:
+                if self.piggyback and loop.time() >= self._next_refresh:
+                    await self._negotiate_heartbeat()  # The hbi exchange doubles as this beat
+                elif self._udp is not None:
+                    self._udp.sendto(f"hbt {self._udp_key}".encode())
+                    self._last_beat = loop.time()
+                else:
+                    async with self._lock:
+                        await self._send("hbt")
+            except (ConnectionError, OSError):
+                try:
+                    await self.reconnect(connection_id)
+                except TrackerError:
+                    return
+
+    async def _negotiate_heartbeat(self):
+        """Adopt the tracker's heartbeat interval and, if offered and wanted, its UDP heartbeat port"""
+        loop = asyncio.get_event_loop()
+        name, args = parse_command(await self._exchange("hbi"))
+        self._next_refresh = loop.time() + HEARTBEAT_REFRESH
+        if name != "hbi" or not args or args[0] == "ERR":
+            self.piggyback = False  # Legacy tracker: only hbt keeps the session alive
+            self.heartbeat_interval = self.max_heartbeat_interval or HEARTBEAT_INTERVAL
+            return
+        self.piggyback = True
+        interval = float(args[0])
+        self.heartbeat_interval = min(interval, self.max_heartbeat_interval or interval)
+        if self.udp_heartbeats and len(args) == 3:
+            self._udp_key = args[2]
+            if self._udp is None:
+                self._udp, _ = await loop.create_datagram_endpoint(
+                    asyncio.DatagramProtocol, remote_addr=(self.host, int(args[1]))
+                )
+
+    ############################################################################
+    ############################### PROTOCOL API ###############################
+    ############################################################################
+
+    async def auth(self, username: str, password: str):
+        """Authenticate and start sending heartbeats"""
+        response = await self._exchange(format_command("auth", username, password))
+        if response != "auth OK":
+            raise AuthError(f"authentication failed for {username}")
+        self.username = username
+        self._password = password
+        self.session_token = await self._fetch_session_token()
+        await self._negotiate_heartbeat()
+        self.closed = False
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+    async def _fetch_session_token(self) -> Optional[str]:
+        """Ask for the token issued at auth (None from trackers without session resumption)"""
+        name, args = parse_command(await self._exchange("tok"))
+        if name == "tok" and len(args) == 1 and args[0] != "ERR":
+            return args[0]
+        return None
+
+    async def register_port(self, upload_port: int):
+        """Tell the tracker which port serves our published files"""
+        response = await self.request(format_command("port", upload_port))
+        if response != "port OK":
+            raise TrackerError(f"tracker rejected upload port {upload_port}")
+        self.upload_port = upload_port
+
+    def _pub_command(self, filename: str) -> str:
+        size = self.file_sizes.get(filename)
+        return format_command("pub", filename) if size is None else format_command("pub", filename, size)
+
+    async def pub(self, filename: str, size: Optional[int] = None):
+        """Publish a file, optionally with its size so size-filtered searches can find it"""
+        if size is not None:
+            self.file_sizes[filename] = size
+        if await self.request(self._pub_command(filename)) != "pub OK":
+            raise TrackerError(f"failed to publish {filename}")
+        self.published.add(filename)
+
+    async def unp(self, filename: str):
+        """Unpublish a file"""
+        self.published.discard(filename)
+        self.file_sizes.pop(filename, None)
+        if await self.request(format_command("unp", filename)) != "unp OK":
+            raise TrackerError(f"failed to unpublish {filename}")
+
+    async def sch(self, pattern: str, *filters: str) -> List[str]:
+        """Search other peers' published files, best matches first.
+
+        pattern is a substring, a glob ("rep*" for a prefix), or "re:<regex>";
+        filters are "size:>1m", "owner:<username>", "limit:<n>" and similar.
+        """
+        response = await self.request(format_command("sch", pattern, *filters))
+        if response == "sch ERR":
+            raise TrackerError(f"bad query {pattern!r}")
+        return parse_list(response)
+
+    async def lap(self) -> List[str]:
+        """List the other active peers"""
+        return parse_list(await self.request("lap"))
+
+    async def lpf(self) -> List[str]:
+        """List the files we have published"""
+        return parse_list(await self.request("lpf"))
+
+    async def page(self, command: str, *args: str, limit: int = PAGE_SIZE,
+                   cursor: Optional[str] = None) -> Page:
+        """Fetch one page of lap, lpf or sch (args is the sch substring)"""
+        page = parse_page(await self.request(format_command(command, *args, limit, cursor or NO_CURSOR)),
+                          command)
+        if page is None:
+            raise TrackerError(f"{command} page refused")
+        return page
+
+    async def iterate(self, command: str, *args: str, page_size: int = PAGE_SIZE) -> AsyncIterator[str]:
+        """Yield every item of lap, lpf or sch, fetching pages only as they are consumed"""
+        cursor = None
+        while True:
+            items, cursor = await self.page(command, *args, limit=page_size, cursor=cursor)
+            for item in items:
+                yield item
+            if cursor is None:
+                return
+
+    def iter_sch(self, pattern: str, *filters: str, page_size: int = PAGE_SIZE) -> AsyncIterator[str]:
+        return self.iterate("sch", pattern, *filters, page_size=page_size)
+
+    def iter_lap(self, page_size: int = PAGE_SIZE) -> AsyncIterator[str]:
+        return self.iterate("lap", page_size=page_size)
+
+    def iter_lpf(self, page_size: int = PAGE_SIZE) -> AsyncIterator[str]:
+        return self.iterate("lpf", page_size=page_size)
+
+    async def get(self, filename: str) -> Optional[PeerAddress]:
+        """Locate a peer serving filename, or None if nobody is"""
+        return parse_get(await self.request(format_command("get", filename)))
+
+    async def have(self, filename: str, file_size: int, piece_size: int, bitmap: bytes):
+        """Advertise the pieces of an in-progress download that we can already serve"""
+        response = await self.request(format_command("have", filename, file_size, piece_size, bytes(bitmap).hex()))
+        if response != "have OK":
+            raise TrackerError(f"tracker rejected availability for {filename}")
+
+    async def withdraw(self, filename: str):
+        """Stop advertising the pieces of filename, leaving any publication of it in place"""
+        if await self.request(format_command("wdr", filename)) != "wdr OK":
+            raise TrackerError(f"tracker rejected withdrawal of {filename}")
+
+    async def src(self, filename: str) -> List[Source]:
+        """List live full and partial seeders of filename (empty if the tracker has none)"""
+        reply = await self.request(format_command("src", filename))
+        try:
+            return parse_sources(reply)
+        except (ValueError, IndexError):
+            raise TrackerError(f"malformed src reply for {filename}: {reply[:80]!r}")
+
+################################################################################
+################################ TRACKER POOL ##################################
+################################################################################
+
+class TrackerPool:
+    """Fixed set of authenticated tracker connections shared by concurrent tasks"""
+
+    def __init__(self, host: str, port: int, credentials: Iterable[Tuple[str, str]], **client_options):
+        self.credentials = list(credentials)
+        self.clients = [TrackerClient(host, port, **client_options) for _ in self.credentials]
+        self._idle = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """Connect and authenticate every pooled client"""
+        self._idle = asyncio.Queue()
+
+        async def open_client(client, username, password):
+            await client.connect()
+            await client.auth(username, password)
+            self._idle.put_nowait(client)
+
+        await asyncio.gather(*(
+            open_client(client, username, password)
+            for client, (username, password) in zip(self.clients, self.credentials)
+        ))
+
+    async def close(self):
+        """Close every pooled client"""
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Borrow an idle client for a sequence of requests"""
+        client = await self._idle.get()
+        try:
+            yield client
+        finally:
+            self._idle.put_nowait(client)
+
+    async def sch(self, pattern: str, *filters: str) -> List[str]:
+        async with self.acquire() as client:
+            return await client.sch(pattern, *filters)
+
+    async def lap(self) -> List[str]:
+        async with self.acquire() as client:
+            return await client.lap()
+
+    async def get(self, filename: str) -> Optional[PeerAddress]:
+        async with self.acquire() as client:
+            return await client.get(filename)